@@ -1,85 +1,655 @@
 # airtable_cache.py
+import os
 import time
-from threading import Lock
+import pickle
+import sqlite3
+import logging
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from threading import Lock, Thread, local
 
-_lock = Lock()
-_cache = {}
+logger = logging.getLogger(__name__)
+if not logger.hasHandlers():
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
 
 MONTH_CACHE_TTL_SEC = 90  # 例：30秒（10でも60でもOK）
 
+# キャッシュの保存先（バックエンド）
+#   memory : プロセス内 dict（既定）。gunicorn の複数ワーカー間では共有されない
+#   sqlite : 同一ホスト内の全ワーカーで共有する SQLite(WAL) ファイル。外部サービス不要
+CACHE_BACKEND = os.environ.get("AIRTABLE_CACHE_BACKEND", "memory").strip().lower()
+CACHE_SQLITE_PATH = os.environ.get("AIRTABLE_CACHE_SQLITE_PATH", "airtable_cache.sqlite3")
+
+# メモリ上限（超えたら最も長く使われていないエントリから追い出す: LRU）
+CACHE_MAX_ENTRIES = int(os.environ.get("AIRTABLE_CACHE_MAX_ENTRIES", "2000"))
+CACHE_MAX_BYTES = int(os.environ.get("AIRTABLE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 推定サイズ合計
+# 期限切れエントリを定期的に掃除する間隔（秒）。0 以下で無効
+CACHE_SWEEP_INTERVAL_SEC = int(os.environ.get("AIRTABLE_CACHE_SWEEP_INTERVAL_SEC", "60"))
+
+_stats_lock = Lock()
+_stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "swept": 0}
+
+def _count(name: str, n: int = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+def _estimate_size(value) -> int:
+    """
+    値のおおよそのバイト数。上限管理の目安にのみ使う。
+    MonthSnapshot は作成時に見積もった nbytes を使う（書き込みのたびに月全体を pickle しない）。
+    それ以外の値は pickle 後の長さ。
+    """
+    nbytes = getattr(value, "nbytes", None)
+    if nbytes is not None:
+        return nbytes
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 1024
+
+
+class MemoryCacheBackend:
+    """
+    プロセス内 dict + Lock のキャッシュ（従来の実装）。
+    エントリ数と推定バイト数に上限を持ち、超えた分は LRU で追い出す。
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self._lock = Lock()
+        self._cache = OrderedDict()  # key -> (value, expire_at, size, stored_at)。末尾ほど最近使われた
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._bytes = 0
+
+    def get(self, key: str):
+        """(value, expire_at, stored_at) を返す。無ければ None。"""
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            self._cache.move_to_end(key)
+            return item[0], item[1], item[3]
+
+    def set(self, key: str, value, expire_at: float, stored_at: float):
+        size = _estimate_size(value)
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._cache[key] = (value, expire_at, size, stored_at)
+            self._bytes += size
+            self._evict_locked()
+
+    def update(self, key: str, fn, expire_at: float, now: float):
+        """
+        値を fn(value) の戻り値に置き換える（stored_at は引き継ぐ）。無い/期限切れ/fn が None なら何もしない。
+        fn の実行中にロックは持たず、書き込む直前にエントリが読んだときのままか確かめる（比較交換）。
+        他の書き込みが入っていたら最新の値で fn をやり直すので、同時の差分反映が互いを上書きしない。
+        """
+        while True:
+            with self._lock:
+                item = self._cache.get(key)
+            if item is None or item[1] < now:
+                return None
+            value = fn(item[0])
+            if value is None:
+                return None
+            size = _estimate_size(value)
+            with self._lock:
+                if self._cache.get(key) is not item:
+                    continue  # 読んだ後に他のスレッドが書き換えた
+                self._cache.pop(key)
+                self._bytes -= item[2]
+                self._cache[key] = (value, expire_at, size, item[3])
+                self._bytes += size
+                self._evict_locked()
+                return value
+
+    def delete(self, key: str):
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+
+    def delete_expired(self, key: str, now: float):
+        """期限切れの場合のみ削除する（判定と削除の間に他スレッドが書いた新しい値は消さない）。"""
+        with self._lock:
+            item = self._cache.get(key)
+            if item and item[1] < now:
+                self._cache.pop(key, None)
+                self._bytes -= item[2]
+
+    def sweep(self, now: float) -> int:
+        """期限切れエントリをまとめて削除し、削除件数を返す。"""
+        with self._lock:
+            expired = [k for k, item in self._cache.items() if item[1] < now]
+            for k in expired:
+                self._bytes -= self._cache.pop(k)[2]
+            return len(expired)
+
+    def _evict_locked(self):
+        # 直近に書いた1件は残す（単体で上限を超える巨大な値でも直後の読み出しは当たるように）
+        while len(self._cache) > 1 and (len(self._cache) > self.max_entries or self._bytes > self.max_bytes):
+            _, item = self._cache.popitem(last=False)
+            self._bytes -= item[2]
+            _count("evictions")
+
+    def info(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._cache), "bytes": self._bytes,
+                    "max_entries": self.max_entries, "max_bytes": self.max_bytes}
+
+
+class SQLiteCacheBackend:
+    """
+    SQLite(WAL) ファイルを使ったワーカー間共有キャッシュ。
+    値は pickle で保存する（同一ホスト内の自プロセス同士でのみ読み書きする前提）。
+    接続はスレッドごとに持つ（sqlite3 の接続はスレッド間で共有しない）。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " expire_at REAL NOT NULL,"
+            " stored_at REAL NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(cache)")]
+        if "stored_at" not in columns:  # 旧スキーマのファイルを引き継いだ場合
+            conn.execute("ALTER TABLE cache ADD COLUMN stored_at REAL NOT NULL DEFAULT 0")
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        # fork 後の子プロセスでは親の接続を使わない
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str):
+        row = self._conn().execute(
+            "SELECT value, expire_at, stored_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0]), row[1], row[2]
+
+    def set(self, key: str, value, expire_at: float, stored_at: float):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._conn().execute(
+            "INSERT OR REPLACE INTO cache (key, value, expire_at, stored_at) VALUES (?, ?, ?, ?)",
+            (key, blob, expire_at, stored_at)
+        )
+
+    def update(self, key: str, fn, expire_at: float, now: float):
+        """
+        値を fn(value) の戻り値に置き換える（stored_at は引き継ぐ）。無い/期限切れ/fn が None なら何もしない。
+        読み取りから書き込みまでを1つの BEGIN IMMEDIATE トランザクションで行うので、
+        他のワーカー・スレッドの差分反映と読み書きが交差しない（後から来た方は書き込み済みの値を読む）。
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value, expire_at FROM cache WHERE key = ?", (key,)).fetchone()
+            value = None
+            if row is not None and row[1] >= now:
+                value = fn(pickle.loads(row[0]))
+            if value is not None:
+                conn.execute(
+                    "UPDATE cache SET value = ?, expire_at = ? WHERE key = ?",
+                    (pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expire_at, key)
+                )
+            conn.execute("COMMIT")
+            return value
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def delete_expired(self, key: str, now: float):
+        self._conn().execute("DELETE FROM cache WHERE key = ? AND expire_at < ?", (key, now))
+
+    def sweep(self, now: float) -> int:
+        """期限切れ行を削除し、件数上限を超えていれば期限の近いものから削る。"""
+        conn = self._conn()
+        removed = conn.execute("DELETE FROM cache WHERE expire_at < ?", (now,)).rowcount
+        over = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - CACHE_MAX_ENTRIES
+        if over > 0:
+            conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expire_at LIMIT ?)", (over,)
+            )
+            _count("evictions", over)
+        return removed
+
+    def info(self) -> dict:
+        entries = self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {"entries": entries, "path": self.path, "max_entries": CACHE_MAX_ENTRIES}
+
+
+def _create_backend():
+    if CACHE_BACKEND == "sqlite":
+        try:
+            backend = SQLiteCacheBackend(CACHE_SQLITE_PATH)
+            logger.info(f"Airtableキャッシュ: SQLiteバックエンドを使用します ({CACHE_SQLITE_PATH})")
+            return backend
+        except Exception as e:
+            logger.error(f"SQLiteキャッシュの初期化に失敗しました。メモリキャッシュを使用します: {e}", exc_info=True)
+    elif CACHE_BACKEND != "memory":
+        logger.warning(f"不明な AIRTABLE_CACHE_BACKEND '{CACHE_BACKEND}' です。メモリキャッシュを使用します。")
+    return MemoryCacheBackend()
+
+
+_backend = _create_backend()
+
+def set_cache_backend(backend):
+    """キャッシュのバックエンドを差し替える（get/set/update/delete/delete_expired/sweep/info を持つオブジェクト）。
+    get は (value, expire_at, stored_at) を返し、set は (key, value, expire_at, stored_at) を受け取る。
+    update(key, fn, expire_at, now) は読み取り→fn→書き込みを他の書き込みと交差させずに行う。"""
+    global _backend
+    _backend = backend
+
+def get_cache_backend():
+    return _backend
+
+def sweep_expired() -> int:
+    """期限切れエントリを一括削除する（スイーパースレッドから定期的に呼ばれる）。"""
+    removed = _backend.sweep(time.time())
+    if removed:
+        _count("swept", removed)
+    return removed
+
+_sweeper_lock = Lock()
+_sweeper_pid = None
+
+def _sweeper_loop():
+    while True:
+        time.sleep(CACHE_SWEEP_INTERVAL_SEC)
+        try:
+            removed = sweep_expired()
+            if removed:
+                logger.debug(f"[CACHE SWEEP] removed {removed} expired entries")
+        except Exception as e:
+            logger.warning(f"キャッシュの期限切れ掃除に失敗（無視）: {e}")
+
+def _ensure_sweeper():
+    """このプロセスでスイーパースレッドが未起動なら起動する（fork 後のワーカーでも1回ずつ起動される）。"""
+    global _sweeper_pid
+    if CACHE_SWEEP_INTERVAL_SEC <= 0 or _sweeper_pid == os.getpid():
+        return
+    with _sweeper_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        Thread(target=_sweeper_loop, name="airtable-cache-sweeper", daemon=True).start()
+        _sweeper_pid = os.getpid()
+
+def cache_stats() -> dict:
+    """ヒット/ミス/追い出し等のカウンタとバックエンドの使用量を返す（このプロセス分）。"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else None
+    stats["backend"] = type(_backend).__name__
+    try:
+        stats.update(_backend.info())
+    except Exception:
+        pass
+    return stats
+
 def month_key(person_id: str, year: int, month: int) -> str:
     return f"airtable:month:{person_id}:{year:04d}-{month:02d}"
 
+def cache_get_entry(key: str):
+    """
+    (value, stored_at) を返す。無い/期限切れなら None。
+    stored_at は値を Airtable から取得した時刻（stale-while-revalidate の鮮度判定に使う）。
+    """
+    now = time.time()
+    item = _backend.get(key)
+    if not item:
+        _count("misses")
+        return None
+    value, expire_at, stored_at = item
+    if expire_at < now:
+        _backend.delete_expired(key, now)
+        _count("expired")
+        _count("misses")
+        return None
+    _count("hits")
+    return value, stored_at
+
 def cache_get(key: str):
+    entry = cache_get_entry(key)
+    return entry[0] if entry is not None else None
+
+def cache_set(key: str, value, ttl_sec: int, stored_at: float = None):
+    """stored_at を渡すと取得時刻を引き継ぐ（差分更新で鮮度をリセットしないため）。省略時は現在時刻。"""
+    _ensure_sweeper()
     now = time.time()
-    with _lock:
-        item = _cache.get(key)
-        if not item:
-            return None
-        value, expire_at = item
-        if expire_at < now:
-            _cache.pop(key, None)
-            return None
-        return value
+    expire_at = now + ttl_sec
+    _backend.set(key, value, expire_at, stored_at if stored_at is not None else now)
 
-def cache_set(key: str, value, ttl_sec: int):
-    expire_at = time.time() + ttl_sec
-    with _lock:
-        _cache[key] = (value, expire_at)
+def cache_update(key: str, fn, ttl_sec: int):
+    """
+    key の値を fn(value) の戻り値で置き換え、新しい値を返す（取得時刻 stored_at は引き継ぐ）。
+    無い/期限切れ、または fn が None を返した場合は何もせず None。
+    同じキーへの同時の更新は直列化される（fn は最新の値で呼ばれ直すことがあるので副作用を持たせないこと）。
+    """
+    _ensure_sweeper()
+    now = time.time()
+    value = _backend.update(key, fn, now + ttl_sec, now)
+    _count("hits" if value is not None else "misses")
+    return value
 
 def cache_delete(key: str):
-    with _lock:
-        _cache.pop(key, None)
+    _backend.delete(key)
 
 # --- ここから追加：キャッシュの行操作（Airtable追加コールなし） ---
 
-def month_cache_remove_record(person_id: str, year: int, month: int, record_id: str,
-                              ttl_sec: int = MONTH_CACHE_TTL_SEC) -> bool:
-    ...
+# レコードID -> そのレコードを含む月キャッシュのキー（編集画面をキャッシュから出すための索引）。
+# 月キャッシュを書き込む month_cache_* がすべて更新する。索引はヒントで、引くときは必ず月キャッシュで確かめる。
+RECORD_LOCATOR_MAX = int(os.environ.get("AIRTABLE_RECORD_LOCATOR_MAX", "100000"))
+_locator_lock = Lock()
+_record_locator = OrderedDict()
 
-    """当月キャッシュが存在する場合、その中の record_id を1件削除して保存し直す。"""
-    key = month_key(person_id, year, month)
-    rows = cache_get(key)
-    if rows is None:
+def month_row_subtotal(row: dict) -> float:
+    """一覧の行1件の金額（単価 × 数量）。単価が「不明」や数値でない場合は 0。"""
+    try:
+        unit_price_str = str(row.get("UnitPrice", "0")).strip()
+        unit_price = float(unit_price_str) if unit_price_str and unit_price_str != "不明" else 0.0
+        work_output_str = str(row.get("WorkOutput", "0")).strip()
+        work_output = int(work_output_str) if work_output_str else 0
+        return unit_price * work_output
+    except ValueError:
+        return 0
+
+def _row_minutes(row: dict) -> float:
+    """「分給」工程の行の数量（分）。それ以外の行は 0。"""
+    if "分給" not in row.get("WorkProcess", ""):
+        return 0.0
+    value = str(row.get("WorkOutput", "0")).strip()
+    if value and value.replace('.', '', 1).isdigit():
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return 0.0
+
+def _prepare_row(row: dict) -> dict:
+    # 表示用の小計は行と一緒に持つ（描画のたびに計算しない）
+    row["subtotal"] = month_row_subtotal(row)
+    return row
+
+def _workday_sort_key(row: dict) -> str:
+    return row.get("WorkDay", "9999-12-31")
+
+def _row_nbytes(row: dict) -> int:
+    """
+    行1件のおおよそのバイト数（各値の文字列長 + 1項目あたりの固定分）。キャッシュの上限管理用の見積もりで、
+    従来の pickle 後の長さと同程度になるようにしてある（キー名は pickle で共有されるので数えない）。
+    """
+    return 16 + sum(len(str(v)) + 4 for v in row.values())
+
+
+class MonthAggregates:
+    """
+    1か月分の集計（合計金額・稼働日数・分給の合計）。
+    行の追加/削除のたびに差分で更新するので、一覧の集計欄は全行を走査せずに出せる。
+    """
+    __slots__ = ("total_amount", "workoutput_total", "workday_counts")
+
+    def __init__(self, total_amount: float = 0.0, workoutput_total: float = 0.0, workday_counts: dict = None):
+        self.total_amount = total_amount
+        self.workoutput_total = workoutput_total
+        self.workday_counts = workday_counts if workday_counts is not None else {}  # 作業日 -> 行数
+
+    @classmethod
+    def from_rows(cls, rows) -> "MonthAggregates":
+        agg = cls()
+        for r in rows:
+            agg.add_row(r)
+        return agg
+
+    def copy(self) -> "MonthAggregates":
+        return MonthAggregates(self.total_amount, self.workoutput_total, dict(self.workday_counts))
+
+    def add_row(self, row: dict, sign: int = 1):
+        """row を集計に足す（sign=-1 で引く）。row は _prepare_row 済みであること。"""
+        self.total_amount += sign * row.get("subtotal", 0)
+        self.workoutput_total += sign * _row_minutes(row)
+        workday = row.get("WorkDay")
+        if workday != "9999-12-31":
+            count = self.workday_counts.get(workday, 0) + sign
+            if count > 0:
+                self.workday_counts[workday] = count
+            else:
+                self.workday_counts.pop(workday, None)
+
+    @property
+    def workdays_count(self) -> int:
+        return len(self.workday_counts)
+
+    def matches(self, other: "MonthAggregates") -> bool:
+        """全件再計算した結果との比較用（浮動小数の差分更新による誤差は許容する）。"""
+        return (abs(self.total_amount - other.total_amount) < 1e-6
+                and abs(self.workoutput_total - other.workoutput_total) < 1e-6
+                and self.workday_counts == other.workday_counts)
+
+    def as_dict(self) -> dict:
+        return {
+            "total_amount": self.total_amount,
+            "workdays_count": self.workdays_count,
+            "workoutput_total": self.workoutput_total,
+        }
+
+
+class MonthSnapshot:
+    """
+    月キャッシュに保存する値：WorkDay 順の一覧行と、その集計。
+    行は id で引ける索引と WorkDay のキー列を持ち、変更は二分探索で挿入/削除する（全件走査・再ソートしない）。
+    保存した後は書き換えない。変更は with_changes() で新しいスナップショットを作って保存し直すので、
+    読み手が更新途中の月を見ることはない。行のリストとしてそのまま for で回せる。
+    """
+    __slots__ = ("rows", "keys", "index", "aggregates", "nbytes")
+
+    def __init__(self, rows=()):
+        rows = sorted((_prepare_row(r) for r in rows), key=_workday_sort_key)  # 取得結果はほぼ整列済み
+        self._publish(rows, [_workday_sort_key(r) for r in rows], {str(r.get("id")): r for r in rows},
+                      MonthAggregates.from_rows(rows), sum(_row_nbytes(r) for r in rows))
+
+    def _publish(self, rows: list, keys: list, index: dict, aggregates: MonthAggregates, nbytes: int):
+        self.rows = tuple(rows)
+        self.keys = tuple(keys)
+        self.index = index
+        self.aggregates = aggregates
+        self.nbytes = nbytes  # 推定バイト数（キャッシュの上限管理用。集計と同じく差分で更新する）
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def find(self, record_id: str):
+        return self.index.get(str(record_id))
+
+    def with_changes(self, upserts=(), remove_ids=()) -> "MonthSnapshot":
+        """
+        行の追加/置換（upserts）と削除（remove_ids）を反映した新しいスナップショット。集計は差分で更新する。
+        同じ id が upserts と remove_ids の両方にある場合は削除を優先する。
+        """
+        upserts = {str(r.get("id")): _prepare_row(dict(r)) for r in upserts}  # 同じ id は後勝ち
+        rows, keys, index = list(self.rows), list(self.keys), dict(self.index)
+        aggregates = self.aggregates.copy()
+        nbytes = getattr(self, "nbytes", None)  # 以前の形式で保存されたものには無い
+        if nbytes is None:
+            nbytes = sum(_row_nbytes(r) for r in rows)
+
+        def position(row: dict) -> int:
+            i = bisect_left(keys, _workday_sort_key(row))
+            while rows[i] is not row:  # 同じ作業日の行の中から探す
+                i += 1
+            return i
+
+        removed = [str(i) for i in remove_ids]
+        for rid in removed:
+            upserts.pop(rid, None)  # 削除が優先（削除した行を upserts で戻さない）
+        for rid in dict.fromkeys(removed + list(upserts)):
+            old = index.pop(rid, None)
+            if old is None:
+                continue
+            aggregates.add_row(old, -1)
+            nbytes -= _row_nbytes(old)
+            new = upserts.get(rid)
+            if new is not None and _workday_sort_key(new) == _workday_sort_key(old):
+                # 作業日が変わらない更新はその場で置き換える（並びはそのまま）
+                rows[position(old)] = new
+                index[rid] = new
+                aggregates.add_row(new)
+                nbytes += _row_nbytes(new)
+                del upserts[rid]
+                continue
+            i = position(old)
+            del rows[i]
+            del keys[i]
+
+        for rid, row in upserts.items():
+            key = _workday_sort_key(row)
+            i = bisect_right(keys, key)  # 同じ作業日の中では後ろに入れる（従来の追加後の安定ソートと同じ並び）
+            rows.insert(i, row)
+            keys.insert(i, key)
+            index[rid] = row
+            aggregates.add_row(row)
+            nbytes += _row_nbytes(row)
+
+        snapshot = MonthSnapshot.__new__(MonthSnapshot)
+        snapshot._publish(rows, keys, index, aggregates, nbytes)
+        return snapshot
+
+    def check_aggregates(self) -> bool:
+        """差分更新した集計が全件再計算と一致するか（デバッグ用）。不一致なら警告を出して False。"""
+        full = MonthAggregates.from_rows(self.rows)
+        if self.aggregates.matches(full):
+            return True
+        logger.warning(f"月集計の不一致: cached={self.aggregates.as_dict()} recomputed={full.as_dict()}")
         return False
-    new_rows = [r for r in rows if str(r.get("id")) != str(record_id)]
-    if len(new_rows) == len(rows):
-        # 見つからなかった（キャッシュ不整合 or 未キャッシュ）
+
+def _as_snapshot(value) -> MonthSnapshot:
+    # 以前の形式（行のリスト）で保存されたエントリも扱えるようにする
+    return value if isinstance(value, MonthSnapshot) else MonthSnapshot(value)
+
+def _store_month_rows(key: str, snapshot: MonthSnapshot, ttl_sec: int, stored_at: float = None):
+    """月キャッシュを保存し、全行の所在を索引に登録する（差分反映では cache_update と _locate_rows を使う）。"""
+    cache_set(key, snapshot, ttl_sec, stored_at=stored_at)
+    _locate_rows(key, snapshot.index)
+
+def _locate_rows(key: str, located_ids):
+    """行の所在（レコードID -> 月キャッシュのキー）を索引に登録する。"""
+    with _locator_lock:
+        for rid in located_ids:
+            rid = str(rid)
+            _record_locator[rid] = key
+            _record_locator.move_to_end(rid)
+        while len(_record_locator) > RECORD_LOCATOR_MAX:
+            _record_locator.popitem(last=False)
+
+def month_cache_store(person_id: str, year: int, month: int, rows, ttl_sec: int = MONTH_CACHE_TTL_SEC,
+                      stored_at: float = None) -> MonthSnapshot:
+    """
+    Airtable（またはミラー）から取得した1か月分（WorkDay 順）を集計付きで保存し、そのスナップショットを返す。
+    stored_at は取得開始時刻。
+    """
+    snapshot = _as_snapshot(rows)
+    _store_month_rows(month_key(person_id, year, month), snapshot, ttl_sec, stored_at)
+    return snapshot
+
+def month_cache_find_record(person_id: str, record_id: str, year: int = None, month: int = None,
+                            max_age_sec: float = None):
+    """
+    月キャッシュからレコード1件（一覧表示用の行）を探して返す。無ければ None。
+    索引にある月を先に、次に year/month（一覧で表示していた月）を見る。
+    max_age_sec を渡すと、Airtable から取得してからそれより時間が経った月は見ない
+    （差分更新用に残しているだけの古い月の内容を返さない）。
+    """
+    with _locator_lock:
+        located = _record_locator.get(str(record_id))
+    candidates = []
+    if located and located.startswith(f"airtable:month:{person_id}:"):
+        candidates.append(located)  # 他人の月キャッシュは見ない
+    if year and month:
+        candidates.append(month_key(person_id, year, month))
+    for key in dict.fromkeys(candidates):
+        entry = cache_get_entry(key)
+        if entry is None:
+            continue
+        if max_age_sec is not None and time.time() - entry[1] > max_age_sec:
+            continue
+        row = _as_snapshot(entry[0]).find(record_id)
+        if row is not None:
+            return dict(row)
+    return None
+
+def month_cache_apply(person_id: str, year: int, month: int, upserts=(), remove_ids=(),
+                      ttl_sec: int = MONTH_CACHE_TTL_SEC) -> bool:
+    """
+    一括編集用：当月キャッシュが存在する場合、行の追加/置換（upserts）と削除（remove_ids）を
+    まとめて反映し、1回だけ保存し直す。
+    """
+    key = month_key(person_id, year, month)
+    upserts, remove_ids = list(upserts), list(remove_ids)
+    if cache_update(key, lambda value: _as_snapshot(value).with_changes(upserts, remove_ids), ttl_sec) is None:
         return False
-    new_rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
-    cache_set(key, new_rows, ttl_sec)
+    _locate_rows(key, [r.get("id") for r in upserts])
     return True
 
-def month_cache_update_record(person_id: str, year: int, month: int, record_id: str, fields: dict,
+def month_cache_add_record(person_id: str, year: int, month: int, row: dict, replace_id: str = None,
+                           ttl_sec: int = MONTH_CACHE_TTL_SEC) -> bool:
+    """
+    当月キャッシュが存在する場合、row を追加して保存し直す（新規作成の差分反映用）。
+    同じ id の行、および replace_id の行（送信待ちの仮行など）は row で置き換える。
+    """
+    return month_cache_apply(person_id, year, month, [row], [replace_id] if replace_id else [], ttl_sec)
+
+def month_cache_remove_record(person_id: str, year: int, month: int, record_id: str,
                               ttl_sec: int = MONTH_CACHE_TTL_SEC) -> bool:
-    ...
+    """当月キャッシュが存在する場合、その中の record_id を1件削除して保存し直す。"""
+    def remove(value):
+        snapshot = _as_snapshot(value)
+        if snapshot.find(record_id) is None:
+            return None  # 見つからなかった（キャッシュ不整合 or 未キャッシュ）
+        return snapshot.with_changes(remove_ids=[record_id])
 
+    return cache_update(month_key(person_id, year, month), remove, ttl_sec) is not None
+
+def month_cache_update_record(person_id: str, year: int, month: int, record_id: str, fields: dict,
+                              ttl_sec: int = MONTH_CACHE_TTL_SEC) -> bool:
     """
     当月キャッシュが存在する場合、その中の record_id を更新して保存し直す。
     fields例: {"WorkDay": "...", "WorkOutput": 123}
     """
-    key = month_key(person_id, year, month)
-    rows = cache_get(key)
-    if rows is None:
-        return False
-
-    updated = False
-    new_rows = []
-    for r in rows:
-        if str(r.get("id")) == str(record_id):
-            rr = dict(r)
-            rr.update(fields)
-            new_rows.append(rr)
-            updated = True
-        else:
-            new_rows.append(r)
-
-    if not updated:
-        return False
+    def update(value):
+        snapshot = _as_snapshot(value)
+        row = snapshot.find(record_id)
+        if row is None:
+            return None
+        updated = dict(row)
+        updated.update(fields)
+        return snapshot.with_changes([updated])
 
-    new_rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
-    cache_set(key, new_rows, ttl_sec)
-    return True
+    return cache_update(month_key(person_id, year, month), update, ttl_sec) is not None
 
 def month_cache_move_record(person_id: str, from_year: int, from_month: int, to_year: int, to_month: int, record_id: str, fields: dict,
                             ttl_sec: int = MONTH_CACHE_TTL_SEC) -> bool:
@@ -91,48 +661,29 @@ def month_cache_move_record(person_id: str, from_year: int, from_month: int, to_
     """
     from_key = month_key(person_id, from_year, from_month)
     to_key   = month_key(person_id, to_year, to_month)
+    moved = {}
 
-    from_rows = cache_get(from_key)
-    to_rows   = cache_get(to_key)
+    # 1) from側から取り出す（fromに存在していたら保存し直し）
+    def take(value):
+        snapshot = _as_snapshot(value)
+        found = snapshot.find(record_id)
+        if found is None:
+            return None
+        moved["row"] = dict(found)
+        return snapshot.with_changes(remove_ids=[record_id])
 
-    if from_rows is None and to_rows is None:
-        return False
+    cache_update(from_key, take, ttl_sec)
 
-    moved_row = None
+    # 2) to側へ入れる（toキャッシュがある場合のみ。既に同IDが居たら置換）
+    def put(value):
+        # fromに無い場合は最小情報で追加（必要な列は records表示に足りるもの）
+        row = dict(moved.get("row") or {"id": record_id})
+        row.update(fields)
+        return _as_snapshot(value).with_changes([row])
 
-    # 1) from側から取り出す
-    if from_rows is not None:
-        kept = []
-        for r in from_rows:
-            if str(r.get("id")) == str(record_id):
-                moved_row = dict(r)
-            else:
-                kept.append(r)
-        # fromに存在していたら保存し直し
-        if moved_row is not None:
-            kept.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
-            cache_set(from_key, kept, ttl_sec)
-
-    # 2) to側へ入れる（toキャッシュがある場合のみ）
-    if to_rows is not None:
-        if moved_row is None:
-            # fromに無い場合は最小情報で追加（必要な列は records表示に足りるもの）
-            moved_row = {"id": record_id}
-        moved_row.update(fields)
-        # 既に同IDが居たら置換
-        new_to = []
-        replaced = False
-        for r in to_rows:
-            if str(r.get("id")) == str(record_id):
-                new_to.append(dict(moved_row))
-                replaced = True
-            else:
-                new_to.append(r)
-        if not replaced:
-            new_to.append(dict(moved_row))
-        new_to.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
-        cache_set(to_key, new_to, ttl_sec)
+    if cache_update(to_key, put, ttl_sec) is not None:
+        _locate_rows(to_key, [record_id])
         return True
 
     # toキャッシュが無い場合は fromだけ整えた（or 何もできなかった）
-    return moved_row is not None
+    return "row" in moved
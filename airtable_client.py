@@ -0,0 +1,240 @@
+# airtable_client.py
+import os
+import time
+import random
+import logging
+from threading import Condition, Lock
+from urllib.parse import urlparse
+
+import requests
+from flask import has_request_context
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+if not logger.hasHandlers():
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+# ==== 接続プール設定 ====
+# プールサイズはワーカー内の同時リクエストスレッド数に合わせる（Waitress の既定は 4 スレッド）
+AIRTABLE_POOL_SIZE = int(os.environ.get("AIRTABLE_POOL_SIZE") or os.environ.get("WEB_THREADS") or 8)
+# 接続（TCP/TLS）タイムアウトは短く、読み取りタイムアウトは呼び出し側ごとに指定する
+AIRTABLE_CONNECT_TIMEOUT = float(os.environ.get("AIRTABLE_CONNECT_TIMEOUT", "3.05"))
+AIRTABLE_READ_TIMEOUT = float(os.environ.get("AIRTABLE_READ_TIMEOUT", "10"))
+
+# ==== レート制限（Airtable は 1ベースあたり約 5 req/s。超えると 429 で 30 秒待たされる） ====
+# gunicorn の複数ワーカーで合計が上限を超えないよう、既定ではワーカー数で割る
+AIRTABLE_RATE_PER_SEC = float(
+    os.environ.get("AIRTABLE_RATE_PER_SEC")
+    or 5.0 / max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+)
+AIRTABLE_RATE_BURST = float(os.environ.get("AIRTABLE_RATE_BURST", str(max(1.0, AIRTABLE_RATE_PER_SEC))))
+AIRTABLE_RATE_MAX_WAIT_SEC = float(os.environ.get("AIRTABLE_RATE_MAX_WAIT_SEC", "15"))  # 送信枠待ちの上限
+AIRTABLE_MAX_RETRIES = int(os.environ.get("AIRTABLE_MAX_RETRIES", "3"))                 # 429/503 の再試行回数
+AIRTABLE_BACKOFF_BASE_SEC = float(os.environ.get("AIRTABLE_BACKOFF_BASE_SEC", "0.5"))
+AIRTABLE_BACKOFF_MAX_SEC = float(os.environ.get("AIRTABLE_BACKOFF_MAX_SEC", "30"))
+# 画面のリクエスト中（ユーザーが応答を待っている）は、送信枠待ちと再試行の待ちの合計をこの秒数までにする。
+# バックグラウンド（先読み・再取得・書き込みキュー・ミラー同期）は上の上限どおりに待つ
+AIRTABLE_INTERACTIVE_RETRY_BUDGET_SEC = float(os.environ.get("AIRTABLE_INTERACTIVE_RETRY_BUDGET_SEC", "10"))
+RETRY_STATUS_CODES = (429, 503)
+
+_session = None
+_session_pid = None
+_session_lock = Lock()
+
+
+class AirtableRateLimitTimeout(requests.exceptions.RequestException):
+    """送信枠の待ち時間が上限を超えた（requests の例外として既存のエラー処理で扱える）。"""
+
+
+class _TokenBucket:
+    """
+    ベースごとのトークンバケット。acquire() は送信してよくなるまで待つ（待っている間は行列に並ぶ）。
+    429 を受けたら pause() で全スレッドの送信を止める。
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.cond = Condition(Lock())
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, max_wait: float) -> float:
+        """送信枠を1つ取る。待った秒数を返す。max_wait を超えそうなら AirtableRateLimitTimeout。"""
+        started = time.monotonic()
+        deadline = started + max_wait
+        with self.cond:
+            _stats_add(waiting=1)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now >= self.paused_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        return now - started
+                    wait = max(self.paused_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0)
+                    if now + wait > deadline:
+                        raise AirtableRateLimitTimeout(
+                            f"Airtable の送信枠待ちが {max_wait:.0f} 秒を超えるため中止しました（混雑中）"
+                        )
+                    self.cond.wait(wait)
+            finally:
+                _stats_add(waiting=-1)
+
+    def pause(self, seconds: float):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+_buckets = {}
+_buckets_lock = Lock()
+
+_stats_lock = Lock()
+_stats = {
+    "requests": 0, "waiting": 0, "max_waiting": 0, "throttled": 0,
+    "wait_total_sec": 0.0, "wait_max_sec": 0.0, "retries": 0, "status_429": 0, "wait_timeouts": 0,
+    "budget_exhausted": 0,
+}
+
+def _stats_add(**deltas):
+    with _stats_lock:
+        for name, delta in deltas.items():
+            _stats[name] += delta
+        _stats["max_waiting"] = max(_stats["max_waiting"], _stats["waiting"])
+
+def _record_wait(waited: float):
+    with _stats_lock:
+        _stats["requests"] += 1
+        if waited > 0.001:
+            _stats["throttled"] += 1
+            _stats["wait_total_sec"] += waited
+            _stats["wait_max_sec"] = max(_stats["wait_max_sec"], waited)
+
+def _bucket_for(url: str) -> _TokenBucket:
+    # https://api.airtable.com/v0/{baseId}/{table}... のベースIDごとに1つ
+    parts = urlparse(url).path.split("/")
+    base_id = parts[2] if len(parts) > 2 else ""
+    with _buckets_lock:
+        bucket = _buckets.get(base_id)
+        if bucket is None:
+            bucket = _TokenBucket(AIRTABLE_RATE_PER_SEC, AIRTABLE_RATE_BURST)
+            _buckets[base_id] = bucket
+        return bucket
+
+def _retry_delay(response, attempt: int) -> float:
+    """Retry-After があればそれに従い、無ければ指数バックオフ（フルジッター）。"""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(AIRTABLE_BACKOFF_MAX_SEC, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(AIRTABLE_BACKOFF_MAX_SEC, AIRTABLE_BACKOFF_BASE_SEC * (2 ** attempt)))
+
+def airtable_client_stats() -> dict:
+    """送信枠の待ち行列の長さ・待ち時間・429 回数など（このプロセス分）。/api/metrics 用。"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["wait_total_sec"] = round(stats["wait_total_sec"], 3)
+    stats["wait_max_sec"] = round(stats["wait_max_sec"], 3)
+    stats["wait_avg_sec"] = round(stats["wait_total_sec"] / stats["throttled"], 3) if stats["throttled"] else 0.0
+    stats["rate_per_sec"] = AIRTABLE_RATE_PER_SEC
+    stats["burst"] = AIRTABLE_RATE_BURST
+    stats["pool_size"] = AIRTABLE_POOL_SIZE
+    stats["interactive_retry_budget_sec"] = AIRTABLE_INTERACTIVE_RETRY_BUDGET_SEC
+    return stats
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    # 接続エラー（リクエスト未送信）の場合のみ再試行する。POST の二重送信は起きない
+    retry = Retry(total=2, connect=2, read=0, status=0, redirect=0, backoff_factor=0.2)
+    adapter = HTTPAdapter(
+        pool_connections=1,              # 接続先は api.airtable.com のみ
+        pool_maxsize=AIRTABLE_POOL_SIZE,
+        pool_block=False,                # 溢れた場合は一時接続で続行（待たせない）
+        max_retries=retry
+    )
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    プロセス共通の keep-alive セッションを返す（スレッド間で共有）。
+    fork 後の子プロセスでは親のソケットを使わないよう作り直す。
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            _session = _create_session()
+            _session_pid = pid
+            logger.info(f"Airtable HTTPセッションを作成しました (pool_maxsize={AIRTABLE_POOL_SIZE}, pid={pid})")
+        return _session
+
+
+def airtable_request(method: str, url: str, read_timeout: float = None, max_total_sec: float = None,
+                     **kwargs) -> requests.Response:
+    """
+    共有セッション経由で Airtable にリクエストを送る。
+    送信前にベースごとの送信枠（トークンバケット）を待ち、429/503 の場合は Retry-After または
+    ジッター付き指数バックオフで再試行する（429 はリクエストが処理されていないので POST でも安全）。
+    max_total_sec は送信枠待ちと再試行の待ちの合計の上限。省略時は Flask のリクエスト中なら
+    AIRTABLE_INTERACTIVE_RETRY_BUDGET_SEC、それ以外（バックグラウンドのスレッド）は上限なし。
+    上限内に再試行できない場合は最後の 429/503 の応答をそのまま返す。
+    timeout は (接続, 読み取り) の組で指定する。例外・ステータスの扱いは requests と同じ。
+    """
+    timeout = (AIRTABLE_CONNECT_TIMEOUT, read_timeout if read_timeout is not None else AIRTABLE_READ_TIMEOUT)
+    if max_total_sec is None and has_request_context():
+        max_total_sec = AIRTABLE_INTERACTIVE_RETRY_BUDGET_SEC
+    deadline = time.monotonic() + max_total_sec if max_total_sec is not None else None
+    bucket = _bucket_for(url)
+    attempt = 0
+    while True:
+        max_wait = AIRTABLE_RATE_MAX_WAIT_SEC
+        if deadline is not None:
+            max_wait = min(max_wait, max(0.0, deadline - time.monotonic()))
+        try:
+            waited = bucket.acquire(max_wait)
+        except AirtableRateLimitTimeout:
+            _stats_add(wait_timeouts=1)
+            logger.warning(f"Airtable 送信枠待ちタイムアウト: {method} {url}")
+            raise
+        _record_wait(waited)
+
+        response = get_session().request(method, url, timeout=timeout, **kwargs)
+        if response.status_code not in RETRY_STATUS_CODES:
+            return response
+
+        delay = _retry_delay(response, attempt)
+        if response.status_code == 429:
+            _stats_add(status_429=1)
+            bucket.pause(delay)  # 同じベースへの他スレッドの送信も止める
+        if attempt >= AIRTABLE_MAX_RETRIES:
+            logger.warning(f"Airtable HTTP {response.status_code}: 再試行上限に達しました: {method} {url}")
+            return response
+        if deadline is not None and time.monotonic() + delay > deadline:
+            _stats_add(budget_exhausted=1)
+            logger.warning(f"Airtable HTTP {response.status_code}: 待ち時間の上限 ({max_total_sec:.0f}秒) を超えるため"
+                           f"再試行しません: {method} {url}")
+            return response
+        attempt += 1
+        _stats_add(retries=1)
+        logger.warning(f"Airtable HTTP {response.status_code}: {delay:.2f}秒後に再試行します ({attempt}/{AIRTABLE_MAX_RETRIES}): {method} {url}")
+        response.close()
+        time.sleep(delay)
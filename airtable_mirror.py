@@ -0,0 +1,350 @@
+# airtable_mirror.py
+"""
+Airtable の個人テーブル（TablePersonID_{pid}）のローカル SQLite ミラー（AIRTABLE_MIRROR=1 のときのみ使用）。
+
+- 初回は全件を取得し、以後は LAST_MODIFIED_TIME() が前回同期より新しいレコードだけを取得して反映する。
+- 削除は差分取得では分からないため、一定間隔で ID だけの一覧を取得して消えたレコードを削除する。
+  アプリ自身の作成・更新・削除は airtable_service から直接反映する。
+- 月一覧は (person_id, workday) のインデックスで範囲検索する。同期が遅れている場合は None を返し、
+  呼び出し側は従来通り Airtable から取得する。「遅れていない」とは、最後の差分同期と最後の削除検出の
+  両方が MIRROR_MAX_LAG_SEC 以内であること（Airtable で直接行われた追加・更新・削除の反映遅れの上限）。
+
+同期はロックファイルを取れた1プロセスだけが行い、他のワーカーは同じファイルを読むだけ。
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+from threading import Event, Lock, Thread, local
+
+import airtable_service  # 相互 import（属性は呼び出し時にだけ参照する）
+
+logger = logging.getLogger(__name__)
+if not logger.hasHandlers():
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+# ==== 設定 ====
+MIRROR_ENABLED = os.environ.get("AIRTABLE_MIRROR", "0") == "1"
+MIRROR_PATH = os.environ.get("AIRTABLE_MIRROR_PATH", "airtable_mirror.sqlite3")
+MIRROR_SYNC_INTERVAL_SEC = float(os.environ.get("AIRTABLE_MIRROR_SYNC_SEC", "15"))
+# 最後の同期開始からこの秒数を超えたミラーは「遅れている」とみなし、月一覧は Airtable から直接取得する
+MIRROR_MAX_LAG_SEC = float(os.environ.get("AIRTABLE_MIRROR_MAX_LAG_SEC", "60"))
+# 削除検出（ID だけの全件一覧）の間隔。差分同期では削除が分からないので、ミラーから返すのは
+# 削除検出も MIRROR_MAX_LAG_SEC 以内に済んでいる人だけ。同期間隔を足しても遅れの上限に収まるよう既定は半分
+MIRROR_RECONCILE_SEC = float(os.environ.get("AIRTABLE_MIRROR_RECONCILE_SEC", str(MIRROR_MAX_LAG_SEC / 2)))
+if MIRROR_ENABLED and MIRROR_RECONCILE_SEC + MIRROR_SYNC_INTERVAL_SEC > MIRROR_MAX_LAG_SEC:
+    logger.warning(
+        f"AIRTABLE_MIRROR_RECONCILE_SEC ({MIRROR_RECONCILE_SEC:.0f}s) + 同期間隔 ({MIRROR_SYNC_INTERVAL_SEC:.0f}s) が "
+        f"AIRTABLE_MIRROR_MAX_LAG_SEC ({MIRROR_MAX_LAG_SEC:.0f}s) を超えています。削除検出が遅れている間は"
+        f"ミラーを使わず Airtable から取得します"
+    )
+# 最後に閲覧されてからこの秒数以内の人だけ同期し続ける
+MIRROR_ACTIVE_SEC = float(os.environ.get("AIRTABLE_MIRROR_ACTIVE_SEC", "3600"))
+# 差分取得の基準時刻を前回の同期開始より少し戻す（Airtable とのサーバー時刻のずれ対策。重複取得は上書きで吸収）
+MIRROR_WATERMARK_OVERLAP_SEC = float(os.environ.get("AIRTABLE_MIRROR_OVERLAP_SEC", "120"))
+MIRROR_MAX_PAGES = int(os.environ.get("AIRTABLE_MIRROR_MAX_PAGES", "200"))
+
+MIRROR_FIELDS = ["WorkDay", "WorkCord", "WorkName", "WorkProcess", "UnitPrice", "WorkOutput", "BookName"]
+
+_local = local()
+_schema_lock = Lock()
+_schema_ready = False
+
+_sync_wakeup = Event()
+_syncer_pid = None
+_syncer_lock = Lock()
+
+
+def _conn() -> sqlite3.Connection:
+    """スレッドごとの接続（fork 後は作り直す）。"""
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        conn = sqlite3.connect(MIRROR_PATH, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.pid = os.getpid()
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS records ("
+                    " person_id TEXT NOT NULL,"
+                    " id TEXT NOT NULL,"
+                    " workday TEXT NOT NULL,"
+                    " row TEXT NOT NULL,"  # 一覧表示用の行（JSON）
+                    " PRIMARY KEY (person_id, id))"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS records_month ON records (person_id, workday)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sync_state ("
+                    " person_id TEXT PRIMARY KEY,"
+                    " watermark REAL,"          # 次回の差分取得の基準（UNIX 時刻）
+                    " synced_at REAL,"          # 最後に同期を開始した時刻（成功したもののみ）
+                    " reconciled_at REAL,"      # 最後に削除検出をした時刻
+                    " last_read_at REAL)"       # 最後に月一覧を読まれた時刻（同期対象の判定用）
+                )
+                # アプリで削除したID。削除前に取得を始めた同期がそのレコードを書き戻さないようにする
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS tombstones ("
+                    " person_id TEXT NOT NULL,"
+                    " id TEXT NOT NULL,"
+                    " deleted_at REAL NOT NULL,"
+                    " PRIMARY KEY (person_id, id))"
+                )
+                _schema_ready = True
+    return conn
+
+
+def _month_range(year: int, month: int):
+    start = f"{year:04d}-{month:02d}-01"
+    end = f"{year + 1:04d}-01-01" if month == 12 else f"{year:04d}-{month + 1:02d}-01"
+    return start, end
+
+
+def _touch(person_id: str):
+    _conn().execute(
+        "INSERT INTO sync_state (person_id, last_read_at) VALUES (?, ?)"
+        " ON CONFLICT(person_id) DO UPDATE SET last_read_at = excluded.last_read_at",
+        (str(person_id), time.time())
+    )
+
+
+def mirror_synced_at(person_id: str):
+    """
+    指定した人のミラーがどの時刻までの Airtable を反映しているか（未同期なら None）。
+    差分同期の開始時刻と削除検出の開始時刻の古い方（差分同期だけでは削除を反映できないため）。
+    """
+    row = _conn().execute(
+        "SELECT synced_at, reconciled_at FROM sync_state WHERE person_id = ?", (str(person_id),)
+    ).fetchone()
+    if not row or row[0] is None or row[1] is None:
+        return None
+    return min(row[0], row[1])
+
+
+def mirror_month_rows(person_id: str, year: int, month: int):
+    """
+    ミラーから指定月の行を返す（WorkDay 順）。戻り値は (rows, synced_at)。synced_at は mirror_synced_at() の値。
+    ミラー無効・未同期・同期遅れ（差分同期か削除検出が MIRROR_MAX_LAG_SEC より古い）の場合は None
+    （呼び出し側は Airtable から直接取得する）。
+    """
+    if not MIRROR_ENABLED:
+        return None
+    ensure_syncer()
+    try:
+        _touch(person_id)
+        synced_at = mirror_synced_at(person_id)
+        if synced_at is None or time.time() - synced_at > MIRROR_MAX_LAG_SEC:
+            _sync_wakeup.set()  # 同期担当のプロセスなら直ちに同期する
+            return None
+        start, end = _month_range(year, month)
+        rows = _conn().execute(
+            "SELECT row FROM records WHERE person_id = ? AND workday >= ? AND workday < ? ORDER BY workday",
+            (str(person_id), start, end)
+        ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"ミラーの読み取りに失敗（Airtable から取得します）: {e}")
+        return None
+    return [json.loads(r[0]) for r in rows], synced_at
+
+
+# ==== アプリ自身の書き込みの反映 ====
+def mirror_upsert_rows(person_id: str, rows):
+    if not MIRROR_ENABLED or not rows:
+        return
+    try:
+        conn = _conn()
+        conn.executemany(
+            "INSERT OR REPLACE INTO records (person_id, id, workday, row) VALUES (?, ?, ?, ?)",
+            [(str(person_id), str(r["id"]), str(r.get("WorkDay", "9999-12-31")), json.dumps(r, ensure_ascii=False))
+             for r in rows]
+        )
+    except sqlite3.Error as e:
+        logger.warning(f"ミラーへの反映に失敗（次回の同期で反映されます）: {e}")
+
+
+def mirror_patch_record(person_id: str, record_id: str, fields: dict):
+    """一覧の行の一部（WorkDay / WorkOutput など）だけを書き換える。"""
+    if not MIRROR_ENABLED:
+        return
+    try:
+        found = _conn().execute(
+            "SELECT row FROM records WHERE person_id = ? AND id = ?", (str(person_id), str(record_id))
+        ).fetchone()
+        if found:
+            row = json.loads(found[0])
+            row.update(fields)
+            mirror_upsert_rows(person_id, [row])
+    except sqlite3.Error as e:
+        logger.warning(f"ミラーへの反映に失敗（次回の同期で反映されます）: {e}")
+
+
+def mirror_remove_records(person_id: str, record_ids):
+    if not MIRROR_ENABLED or not record_ids:
+        return
+    now = time.time()
+    try:
+        conn = _conn()
+        conn.executemany(
+            "DELETE FROM records WHERE person_id = ? AND id = ?", [(str(person_id), str(i)) for i in record_ids]
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO tombstones (person_id, id, deleted_at) VALUES (?, ?, ?)",
+            [(str(person_id), str(i), now) for i in record_ids]
+        )
+    except sqlite3.Error as e:
+        logger.warning(f"ミラーからの削除に失敗（次回の削除検出で反映されます）: {e}")
+
+
+# ==== 同期 ====
+def sync_person(person_id: str, full: bool = False) -> int:
+    """
+    1人分のテーブルを同期する。未同期または full=True なら全件、それ以外は前回以降に更新されたものだけ。
+    反映した件数を返す。失敗時は例外（同期状態は更新しない）。
+    """
+    person_id = str(person_id)
+    url = airtable_service._build_airtable_url(person_id)
+    if not url:
+        return 0
+    state = _conn().execute(
+        "SELECT watermark, reconciled_at FROM sync_state WHERE person_id = ?", (person_id,)
+    ).fetchone()
+    watermark, reconciled_at = state if state else (None, None)
+    full = full or watermark is None
+
+    started = time.time()
+    params = {"fields[]": MIRROR_FIELDS}
+    if not full:
+        params["filterByFormula"] = f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{airtable_service._airtable_time(watermark)}'))"
+    rows = [airtable_service._process_month_record(rec) for rec in airtable_service.list_all_records(url, params, MIRROR_MAX_PAGES)]
+
+    # 削除検出：全件同期では全件の置き換えで済む。差分同期では間隔ごとに ID だけの一覧と突き合わせる
+    live_ids = None
+    if not full and (reconciled_at is None or started - reconciled_at > MIRROR_RECONCILE_SEC):
+        live_ids = {rec["id"] for rec in airtable_service.list_all_records(url, {"fields[]": ["WorkDay"]}, MIRROR_MAX_PAGES)}
+
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if full:
+            conn.execute("DELETE FROM records WHERE person_id = ?", (person_id,))
+        # 取得中にアプリで削除したレコードは書き戻さない
+        deleted = {r[0] for r in conn.execute(
+            "SELECT id FROM tombstones WHERE person_id = ? AND deleted_at >= ?", (person_id, started)
+        )}
+        if deleted:
+            rows = [r for r in rows if str(r["id"]) not in deleted]
+        conn.execute("DELETE FROM tombstones WHERE deleted_at < ?", (started - 86400,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO records (person_id, id, workday, row) VALUES (?, ?, ?, ?)",
+            [(person_id, str(r["id"]), str(r.get("WorkDay", "9999-12-31")), json.dumps(r, ensure_ascii=False))
+             for r in rows]
+        )
+        removed = 0
+        if live_ids is not None:
+            stored_ids = [r[0] for r in conn.execute("SELECT id FROM records WHERE person_id = ?", (person_id,))]
+            gone = [(person_id, i) for i in stored_ids if i not in live_ids]
+            conn.executemany("DELETE FROM records WHERE person_id = ? AND id = ?", gone)
+            removed = len(gone)
+        conn.execute(
+            "INSERT INTO sync_state (person_id, watermark, synced_at, reconciled_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(person_id) DO UPDATE SET watermark = excluded.watermark, synced_at = excluded.synced_at,"
+            " reconciled_at = COALESCE(excluded.reconciled_at, sync_state.reconciled_at)",
+            (person_id, started - MIRROR_WATERMARK_OVERLAP_SEC, started,
+             started if (full or live_ids is not None) else None)
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    if full or rows or removed:
+        logger.info(f"[MIRROR] PersonID={person_id} {'全件' if full else '差分'}同期: {len(rows)}件反映, {removed}件削除, "
+                    f"{(time.time() - started) * 1000:.0f}ms")
+    return len(rows)
+
+
+def sync_active_persons() -> int:
+    """最近閲覧された人のテーブルを順に同期する。同期できた人数を返す。"""
+    cutoff = time.time() - MIRROR_ACTIVE_SEC
+    person_ids = [r[0] for r in _conn().execute(
+        "SELECT person_id FROM sync_state WHERE last_read_at >= ? ORDER BY synced_at IS NOT NULL, synced_at",
+        (cutoff,)
+    )]
+    synced = 0
+    for person_id in person_ids:
+        try:
+            sync_person(person_id)
+            synced += 1
+        except Exception as e:
+            logger.warning(f"[MIRROR] PersonID={person_id} の同期に失敗（次回再試行）: {e}")
+    return synced
+
+
+def _sync_once():
+    """ロックファイルを取れたプロセスだけが同期する（複数ワーカーで同じ同期を重ねない）。"""
+    try:
+        import fcntl
+    except ImportError:  # Windows 等
+        sync_active_persons()
+        return
+    with open(f"{MIRROR_PATH}.lock", "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return  # 他のワーカーが同期中
+        try:
+            sync_active_persons()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _syncer_loop():
+    while True:
+        _sync_wakeup.wait(MIRROR_SYNC_INTERVAL_SEC)
+        _sync_wakeup.clear()
+        try:
+            _sync_once()
+        except Exception as e:
+            logger.error(f"[MIRROR] 同期スレッドでエラー: {e}", exc_info=True)
+
+
+def ensure_syncer():
+    """このプロセスの同期スレッドを起動する（ミラー無効時・起動済みなら何もしない）。"""
+    global _syncer_pid
+    if not MIRROR_ENABLED or _syncer_pid == os.getpid():
+        return
+    with _syncer_lock:
+        if _syncer_pid == os.getpid():
+            return
+        Thread(target=_syncer_loop, name="airtable-mirror-sync", daemon=True).start()
+        _syncer_pid = os.getpid()
+        logger.info(f"[MIRROR] 同期スレッドを起動しました (間隔 {MIRROR_SYNC_INTERVAL_SEC}s, {MIRROR_PATH})")
+
+
+def mirror_stats() -> dict:
+    """/api/metrics 用。"""
+    if not MIRROR_ENABLED:
+        return {"enabled": False}
+    conn = _conn()
+    now = time.time()
+    synced, oldest = conn.execute(
+        "SELECT COUNT(*), MIN(MIN(synced_at, reconciled_at)) FROM sync_state"
+        " WHERE synced_at IS NOT NULL AND reconciled_at IS NOT NULL AND last_read_at >= ?",
+        (now - MIRROR_ACTIVE_SEC,)
+    ).fetchone()
+    return {
+        "enabled": True,
+        "path": MIRROR_PATH,
+        "records": conn.execute("SELECT COUNT(*) FROM records").fetchone()[0],
+        "active_persons_synced": synced,
+        "max_lag_sec": round(now - oldest, 1) if oldest else None,
+        "max_lag_limit_sec": MIRROR_MAX_LAG_SEC,
+        "reconcile_sec": MIRROR_RECONCILE_SEC,
+    }
@@ -1,13 +1,22 @@
 # airtable_service.py
 import os
+import time
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from threading import Lock
 
 
-from airtable_cache import cache_get, cache_set, cache_delete, month_key, MONTH_CACHE_TTL_SEC
+from airtable_cache import (
+    cache_delete, cache_get_entry, month_key,
+    month_cache_add_record, month_cache_apply, month_cache_find_record, month_cache_store, MONTH_CACHE_TTL_SEC,
+    MonthAggregates, MonthSnapshot
+)
+from airtable_client import airtable_request
+from singleflight import SingleFlight
+import airtable_mirror
 
 
-MONTH_CACHE_TTL = 60  # まず60秒でOK（30〜300秒で調整）
 # このモジュール用のロガーを設定
 logger = logging.getLogger(__name__)
 # 基本的なロガー設定 (app.py側の設定とは独立して、このモジュール単体でもログ出力できるように)
@@ -49,6 +58,36 @@ def _build_airtable_url(person_id: str, record_id: str = None) -> str | None:
         return f"{base_url}/{record_id}"
     return base_url
 
+def build_record_fields(workcord: str, workname: str, bookname: str, workoutput: int,
+                        workprocess: str, unitprice: float, workday: str, person_id: str = None) -> dict:
+    """入力値から Airtable に送る fields を組み立てる（WorkCord は数値化できなければ 0）。"""
+    try:
+        workcord_int = int(workcord) if workcord else 0
+    except ValueError:
+        logger.warning(f"WorkCord '{workcord}' を整数に変換できませんでした。0として扱います。 (PersonID: {person_id})")
+        workcord_int = 0
+    return {
+        "WorkCord": workcord_int,
+        "WorkName": str(workname),
+        "BookName": str(bookname),
+        "WorkOutput": int(workoutput),
+        "WorkProcess": str(workprocess),
+        "UnitPrice": float(unitprice),
+        "WorkDay": workday
+    }
+
+def month_row_from_fields(record_id: str, fields: dict) -> dict:
+    """送信した fields から一覧表示用の行を作る（_process_month_record と同じ形）。"""
+    return {
+        "id": record_id,
+        "WorkDay": fields.get("WorkDay", "9999-12-31"),
+        "WorkCD": fields.get("WorkCord", "不明"),
+        "WorkName": fields.get("WorkName", "不明"),
+        "WorkProcess": fields.get("WorkProcess", "不明"),
+        "UnitPrice": fields.get("UnitPrice", "不明"),
+        "WorkOutput": fields.get("WorkOutput", "0"),
+    }
+
 def create_airtable_record(person_id: str, workcord: str, workname: str, bookname: str,
                            workoutput: int, workprocess: str, unitprice: float, workday: str):
     """Airtableに新しいレコードを作成。成功時に当月キャッシュがあれば差分追加で更新する。"""
@@ -56,27 +95,14 @@ def create_airtable_record(person_id: str, workcord: str, workname: str, booknam
     if not url:
         return None, "⚠ AirtableのURL構築に失敗しました（設定不備の可能性）。", None
 
-    try:
-        workcord_int = int(workcord) if workcord else 0
-    except ValueError:
-        logger.warning(f"WorkCord '{workcord}' を整数に変換できませんでした。0として扱います。 (PersonID: {person_id})")
-        workcord_int = 0
-
     data = {
-        "fields": {
-            "WorkCord": workcord_int,
-            "WorkName": str(workname),
-            "BookName": str(bookname),
-            "WorkOutput": int(workoutput),
-            "WorkProcess": str(workprocess),
-            "UnitPrice": float(unitprice),
-            "WorkDay": workday
-        }
+        "fields": build_record_fields(workcord, workname, bookname, workoutput, workprocess, unitprice, workday,
+                                      person_id=person_id)
     }
 
     try:
         logger.info(f"Airtableへのレコード作成開始: URL={url}, PersonID={person_id}")
-        response = requests.post(url, headers=HEADERS, json=data, timeout=10)
+        response = airtable_request("POST", url, headers=HEADERS, json=data, read_timeout=10)
         response.raise_for_status()
         resp_json = response.json()
         new_id = resp_json.get("id")
@@ -88,25 +114,11 @@ def create_airtable_record(person_id: str, workcord: str, workname: str, booknam
 
         # ✅ キャッシュが存在するなら “差分追加” して更新（次の records でGETしない）
         try:
-            from airtable_cache import cache_get, cache_set, month_key
-            CACHE_TTL_SEC = 300
             y = int(workday[:4]); m = int(workday[5:7])
-            key = month_key(person_id, y, m)
-            cached = cache_get(key)
-            if cached is not None:
-                new_row = {
-                    "id": new_id,
-                    "WorkDay": workday,
-                    "WorkCD": workcord_int,
-                    "WorkName": str(workname),
-                    "WorkProcess": str(workprocess),
-                    "UnitPrice": float(unitprice),
-                    "WorkOutput": int(workoutput),
-                }
-                cached2 = list(cached) + [new_row]
-                cached2.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
-                cache_set(key, cached2, CACHE_TTL_SEC)
-                logger.info(f"[CACHE WRITE-THROUGH] appended new record to {key}")
+            new_row = month_row_from_fields(new_id, data["fields"])
+            airtable_mirror.mirror_upsert_rows(person_id, [new_row])
+            if month_cache_add_record(person_id, y, m, new_row, ttl_sec=MONTH_CACHE_RETAIN_SEC):
+                logger.info(f"[CACHE WRITE-THROUGH] appended new record to {month_key(person_id, y, m)}")
         except Exception as e:
             logger.warning(f"キャッシュ差分更新に失敗（無視して継続）: {e}")
 
@@ -137,67 +149,530 @@ def create_airtable_record(person_id: str, workcord: str, workname: str, booknam
 
 
 
-def get_airtable_records_for_month(person_id: str, target_year: int, target_month: int, force_refresh: bool = False):
-    """指定されたPersonIDと年月のレコードをAirtableから取得（短TTLキャッシュ + 強制更新対応）。"""
+# 1か月分の取得で辿るページ数の上限（1ページ100件）。暴走防止用
+MONTH_MAX_PAGES = int(os.environ.get("AIRTABLE_MONTH_MAX_PAGES", "20"))
+
+
+class MonthTruncatedError(RuntimeError):
+    """
+    1か月分の取得がページ数の上限（MONTH_MAX_PAGES）に達して打ち切られた。
+    取得できたページは yield 済みだが、月としては不完全なのでキャッシュしない（合計も正しくない）。
+    """
+
+
+class MonthFetchError(RuntimeError):
+    """
+    1か月分の取得が途中のページで失敗した（タイムアウト・5xx など）。
+    それまでのページは yield 済みなので、呼び出し側は一部だけの月として扱うこと（キャッシュはしない）。
+    """
+
+# ==== 月キャッシュの鮮度（stale-while-revalidate） ====
+# SOFT_TTL を過ぎた月はキャッシュをそのまま返しつつ、裏で1回だけ再取得する。
+# HARD_TTL を過ぎた月は古すぎるので、従来通りその場で Airtable から取得する。
+MONTH_SOFT_TTL_SEC = int(os.environ.get("AIRTABLE_MONTH_SOFT_TTL_SEC", "10"))
+MONTH_HARD_TTL_SEC = int(os.environ.get("AIRTABLE_MONTH_HARD_TTL_SEC", str(MONTH_CACHE_TTL_SEC)))
+MONTH_SWR_ENABLED = os.environ.get("AIRTABLE_MONTH_SWR", "1") != "0"
+
+# ==== 差分更新（delta refresh） ====
+# 期限切れの月を取り直すとき、前回取得以降に更新されたレコードだけを取得してキャッシュに反映する。
+# 削除は ID だけの一覧（1件あたり数十バイト）と突き合わせて検出する。
+MONTH_DELTA_ENABLED = os.environ.get("AIRTABLE_MONTH_DELTA", "1") != "0"
+# 前回取得の開始時刻からさらにこの秒数さかのぼって更新を探す（Airtable とのサーバー時刻のずれ対策）
+MONTH_DELTA_OVERLAP_SEC = float(os.environ.get("AIRTABLE_MONTH_DELTA_OVERLAP_SEC", "60"))
+# 差分更新の元にするため、HARD_TTL を過ぎた月もこの秒数まではキャッシュに残す（古いまま表示はしない）
+MONTH_CACHE_RETAIN_SEC = (
+    max(MONTH_HARD_TTL_SEC, int(os.environ.get("AIRTABLE_MONTH_RETAIN_SEC", "3600")))
+    if MONTH_DELTA_ENABLED else MONTH_HARD_TTL_SEC
+)
+
+# 同じ月の取得を同時に1回に絞る。後続は先行取得の結果を待つ（最大この秒数）
+_month_flight = SingleFlight()
+MONTH_COALESCE_WAIT_SEC = float(os.environ.get("AIRTABLE_COALESCE_WAIT_SEC", "20"))
+
+_refresh_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("AIRTABLE_REFRESH_WORKERS", "2")),
+    thread_name_prefix="airtable-month-refresh"
+)
+_refreshing = set()  # 再取得中の month_key（同じ月の再取得を重ねない）
+_refreshing_lock = Lock()
+
+def _refresh_month_in_background(person_id: str, target_year: int, target_month: int, key: str):
+    try:
+        for _ in iter_airtable_records_for_month(person_id, target_year, target_month, force_refresh=True):
+            pass
+        logger.info(f"[CACHE REVALIDATED] {key}")
+    except Exception as e:
+        logger.warning(f"バックグラウンド再取得に失敗（古いキャッシュを継続使用）: {key} {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+def _schedule_month_refresh(person_id: str, target_year: int, target_month: int, key: str) -> bool:
+    """指定月のバックグラウンド再取得を予約する。既に予約/実行中なら何もしない。"""
+    with _refreshing_lock:
+        if key in _refreshing:
+            return False
+        _refreshing.add(key)
+    try:
+        _refresh_executor.submit(_refresh_month_in_background, person_id, target_year, target_month, key)
+    except RuntimeError:  # インタプリタ終了中など
+        with _refreshing_lock:
+            _refreshing.discard(key)
+        return False
+    return True
+
+def list_all_records(url: str, params: dict, max_pages: int = MONTH_MAX_PAGES):
+    """offset を辿って全ページのレコード（Airtable の生の形）を yield する。上限を超えたら RuntimeError。"""
+    params = dict(params, pageSize=100)
+    for _ in range(max_pages):
+        response = airtable_request("GET", url, headers=HEADERS, params=params, read_timeout=15)
+        response.raise_for_status()
+        body = response.json()
+        yield from body.get("records", [])
+        offset = body.get("offset")
+        if not offset:
+            return
+        params["offset"] = offset
+    raise RuntimeError(f"ページ数上限 ({max_pages}) を超えたため取得を中断しました: {url}")
+
+def _month_formula(target_year: int, target_month: int) -> str:
+    return f"AND(YEAR({{WorkDay}})={target_year}, MONTH({{WorkDay}})={target_month})"
+
+def _airtable_time(ts: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(ts))
+
+def _delta_refresh_month(person_id: str, target_year: int, target_month: int, url: str, cached_rows: list,
+                         stored_at: float):
+    """
+    キャッシュ済みの月を差分で更新した MonthSnapshot を返す（キャッシュにも保存する）。
+    1) 前回取得以降に更新されたレコード（月を問わない。他の月から移ってきた行・出ていった行も拾う）
+    2) 当月の ID だけの一覧 → キャッシュにあって一覧に無い行は削除されたものとして外す
+    差分と一覧が食い違う（取得の合間に追加された等）場合は None を返し、呼び出し側で全件取得する。
+    """
+    fetch_started = time.time()
+    watermark = _airtable_time(stored_at - MONTH_DELTA_OVERLAP_SEC)
+    changed = [
+        _process_month_record(rec) for rec in list_all_records(url, {
+            "filterByFormula": f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{watermark}'))",
+            "fields[]": ["WorkDay","WorkCord","WorkName","WorkProcess","UnitPrice","WorkOutput","BookName"],
+        })
+    ]
+    live_ids = {rec["id"] for rec in list_all_records(url, {
+        "filterByFormula": _month_formula(target_year, target_month),
+        "fields[]": ["WorkDay"],
+    })}
+
+    merged = {str(r["id"]): r for r in cached_rows if not r.get("pending") and str(r["id"]) in live_ids}
+    removed = sum(1 for r in cached_rows if not r.get("pending") and str(r["id"]) not in live_ids)
+    for row in changed:
+        if month_of_row(row) == (target_year, target_month):
+            merged[str(row["id"])] = row
+        else:
+            merged.pop(str(row["id"]), None)  # 他の月へ移動した
+    if set(merged) != live_ids:
+        logger.info(f"[DELTA] {person_id} {target_year}-{target_month:02d} 差分と一覧が一致しないため全件取得します")
+        return None
+
+    rows = list(merged.values()) + _pending_rows_for_month(person_id, target_year, target_month)
+    rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
+    key = month_key(person_id, target_year, target_month)
+    snapshot = month_cache_store(person_id, target_year, target_month, rows, MONTH_CACHE_RETAIN_SEC,
+                                 stored_at=fetch_started)
+    logger.info(f"[DELTA] {key} 更新{len(changed)}件 削除{removed}件 -> {len(rows)}件 "
+                f"{(time.time() - fetch_started) * 1000:.0f}ms")
+    return snapshot
+
+def _process_month_record(record: dict) -> dict:
+    """Airtable のレコード1件を一覧表示用の dict に変換する。"""
+    return month_row_from_fields(record.get("id", "不明なID"), record.get("fields", {}))
+
+def _pending_rows_for_month(person_id: str, target_year: int, target_month: int) -> list:
+    """write-behind 有効時、ジャーナルに残っている未送信の行（write_behind は本モジュールを使うので遅延 import）。"""
+    try:
+        import write_behind
+        if not write_behind.WRITE_BEHIND_ENABLED:
+            return []
+        return write_behind.pending_rows_for_month(person_id, target_year, target_month)
+    except Exception as e:
+        logger.warning(f"送信待ち行の取得に失敗（無視）: {e}")
+        return []
+
+def iter_airtable_records_for_month(person_id: str, target_year: int, target_month: int, force_refresh: bool = False,
+                                    use_mirror: bool = True):
+    """
+    指定されたPersonIDと年月のレコードをページ単位で yield するジェネレータ（stale-while-revalidate キャッシュ + 強制更新対応）。
+    Airtable の offset を辿って全ページ（最大 MONTH_MAX_PAGES）を取得し、全件揃った時点でキャッシュに保存する。
+    キャッシュヒット時はキャッシュ内容（集計付きの MonthSnapshot）を1ページとして返す。
+    ページ数の上限で打ち切った場合は、取得できたページを yield した後に MonthTruncatedError を送出する。
+    ページを yield した後に取得が失敗した場合は MonthFetchError を送出する（1ページ目で失敗した場合は何も返さない）。
+    ローカルミラー（airtable_mirror）が追いついていれば Airtable には問い合わせずミラーから返す。
+    利用者の明示的な再読み込みなど、必ず Airtable から取り直したい場合は use_mirror=False。
+    """
+
+    # キーはどの経路（強制更新・ミラー・single-flight）でも使うので最初に決める
+    key = month_key(person_id, target_year, target_month)
 
     # ✅ まずキャッシュ（強制更新でなければ）
-    key = None
-    CACHE_TTL_SEC = 10  # ← まず10秒推奨（運用により 5〜30秒で調整）
     if not force_refresh:
         try:
-            from airtable_cache import cache_get, cache_set, month_key
-            key = month_key(person_id, target_year, target_month)
-            cached = cache_get(key)
-            if cached is not None:
-                logger.info(f"[CACHE HIT] {key}")
-                return cached
+            entry = cache_get_entry(key)
+            if entry is not None:
+                cached, stored_at = entry
+                age = time.time() - stored_at
+                if age <= MONTH_SOFT_TTL_SEC:
+                    logger.info(f"[CACHE HIT] {key}")
+                    yield cached
+                    return
+                if MONTH_SWR_ENABLED and age <= MONTH_HARD_TTL_SEC:
+                    # 古くなったが許容範囲内：すぐ返して裏で再取得
+                    scheduled = _schedule_month_refresh(person_id, target_year, target_month, key)
+                    logger.info(f"[CACHE STALE] {key} age={age:.0f}s revalidate={'scheduled' if scheduled else 'in-flight'}")
+                    yield cached
+                    return
+                logger.info(f"[CACHE EXPIRED] {key} age={age:.0f}s")
         except Exception as e:
             logger.warning(f"キャッシュ参照失敗（無視）: {e}")
 
+    # ✅ ローカルミラーが追いついていれば、月の範囲をインデックスで引いて返す
+    if use_mirror:
+        mirrored = airtable_mirror.mirror_month_rows(person_id, target_year, target_month)
+        if mirrored is not None:
+            rows, synced_at = mirrored
+            pending = _pending_rows_for_month(person_id, target_year, target_month)
+            if pending:
+                rows.extend(pending)
+                rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
+            try:
+                rows = month_cache_store(person_id, target_year, target_month, rows, MONTH_CACHE_RETAIN_SEC,
+                                         stored_at=synced_at)  # 鮮度はミラーの同期時刻
+                logger.info(f"[MIRROR HIT] {key} {len(rows)}件")
+            except Exception as e:
+                logger.warning(f"キャッシュ保存失敗（無視）: {e}")
+            yield rows
+            return
+
     url = _build_airtable_url(person_id)
     if not url:
-        return []
+        return
+
+    # ✅ 同じ月の取得が既に走っていれば、新たに取得せずその結果を待つ（single-flight）
+    call, leader = _month_flight.join_or_lead(key)
+    if not leader:
+        logger.info(f"[COALESCED] {key} 先行する取得の完了を待ちます")
+        try:
+            rows = call.wait(timeout=MONTH_COALESCE_WAIT_SEC)
+        except Exception:
+            rows = None
+        if rows is not None:
+            yield rows
+            return
+        # 先行取得が失敗/中断した場合は自分で取得する（他の呼び出し元とは合流しない）
+        logger.info(f"[COALESCED] {key} 先行取得が完了しなかったため単独で取得します")
 
     params = {
-        "filterByFormula": f"AND(YEAR({{WorkDay}})={target_year}, MONTH({{WorkDay}})={target_month})",
+        "filterByFormula": _month_formula(target_year, target_month),
         "fields[]": ["WorkDay","WorkCord","WorkName","WorkProcess","UnitPrice","WorkOutput","BookName"],
         "sort[0][field]": "WorkDay",
         "sort[0][direction]": "asc",
         "pageSize": 100
     }
 
+    processed_records = []
+    completed = None  # 全ページ取得できた場合のみ後続の呼び出し元に渡す
+    truncated = False
+    failed = None  # ページを yield した後の取得エラー
+    page_no = 0
+    fetch_started = time.time()  # 取得開始時刻を鮮度の基準にする（取得中の更新を見逃さないため）
     try:
-        response = requests.get(url, headers=HEADERS, params=params, timeout=15)
-        response.raise_for_status()
-        records_data = response.json().get("records", [])
-
-        processed_records = []
-        for record in records_data:
-            fields = record.get("fields", {})
-            processed_records.append({
-                "id": record.get("id", "不明なID"),
-                "WorkDay": fields.get("WorkDay", "9999-12-31"),
-                "WorkCD": fields.get("WorkCord", "不明"),
-                "WorkName": fields.get("WorkName", "不明"),
-                "WorkProcess": fields.get("WorkProcess", "不明"),
-                "UnitPrice": fields.get("UnitPrice", "不明"),
-                "WorkOutput": fields.get("WorkOutput", "0"),
-            })
-
-        # ✅ キャッシュ保存（短TTL）
-        try:
-            from airtable_cache import cache_set, month_key
-            key = month_key(person_id, target_year, target_month)
-            cache_set(key, processed_records, CACHE_TTL_SEC)
-            logger.info(f"[CACHE SET] {key} ttl={CACHE_TTL_SEC}s")
-        except Exception as e:
-            logger.warning(f"キャッシュ保存失敗（無視）: {e}")
+        # ✅ 古くなったキャッシュが残っていれば、全件ではなく差分だけ取り直す
+        if MONTH_DELTA_ENABLED:
+            entry = cache_get_entry(key)
+            if entry is not None:
+                try:
+                    delta_rows = _delta_refresh_month(person_id, target_year, target_month, url, entry[0], entry[1])
+                except Exception as e:
+                    logger.warning(f"[DELTA] 差分更新に失敗、全件取得します: {key} {e}")
+                    delta_rows = None
+                if delta_rows is not None:
+                    completed = delta_rows
+                    yield delta_rows
+                    return
+
+        while True:
+            page_no += 1
+            started = time.perf_counter()
+            response = airtable_request("GET", url, headers=HEADERS, params=params, read_timeout=15)
+            response.raise_for_status()
+            body = response.json()
+            page = [_process_month_record(record) for record in body.get("records", [])]
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            logger.info(f"Airtableレコード取得: PersonID={person_id}, {target_year}-{target_month:02d}, "
+                        f"page={page_no}, {len(page)}件, {elapsed_ms:.0f}ms")
+
+            processed_records.extend(page)
+            yield page
+
+            offset = body.get("offset")
+            if not offset:
+                break
+            if page_no >= MONTH_MAX_PAGES:
+                logger.warning(f"ページ数上限 ({MONTH_MAX_PAGES}) に達したため取得を打ち切ります（キャッシュしません）: "
+                               f"PersonID={person_id}, {target_year}-{target_month:02d}")
+                truncated = True
+                break
+            params["offset"] = offset
+
+        # ✅ write-behind の送信待ち行を重ねる（取り直しても一覧から消えないように）
+        pending = _pending_rows_for_month(person_id, target_year, target_month)
+        if pending:
+            processed_records.extend(pending)
+            processed_records.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
+            yield pending
+
+        # ✅ キャッシュ保存（HARD_TTL まで保持。鮮度は取得時刻で判定する）。打ち切った月は保存しない
+        if truncated:
+            # 強制更新で打ち切った場合、以前の（件数が少なかった頃の）キャッシュを新しいものとして出し続けないよう消す
+            try:
+                cache_delete(key)
+            except Exception as e:
+                logger.warning(f"キャッシュ削除失敗（無視）: {e}")
+        else:
+            try:
+                completed = month_cache_store(person_id, target_year, target_month, processed_records,
+                                              MONTH_CACHE_RETAIN_SEC, stored_at=fetch_started)
+                logger.info(f"[CACHE SET] {key} ttl={MONTH_CACHE_RETAIN_SEC}s pages={page_no}")
+            except Exception as e:
+                logger.warning(f"キャッシュ保存失敗（無視）: {e}")
+                completed = processed_records
+
+    except Exception as e:
+        logger.error(f"Airtableレコード取得エラー (page={page_no}): {e}", exc_info=True)
+        if not processed_records and page_no <= 1:
+            return  # まだ何も返していない：従来どおり空の月（キャッシュしない）
+        failed = e  # 途中まで返した月は、一部だけであることを呼び出し側に知らせる
+
+    finally:
+        if leader:
+            _month_flight.complete(key, call, result=completed)
 
-        return processed_records
+    if failed is not None:
+        raise MonthFetchError(f"{key} の取得が {page_no}ページ目で失敗しました: {failed}") from failed
+    if truncated:
+        raise MonthTruncatedError(f"{key} はページ数上限 ({MONTH_MAX_PAGES}) で打ち切られました")
 
+
+def get_airtable_records_for_month(person_id: str, target_year: int, target_month: int, force_refresh: bool = False,
+                                   use_mirror: bool = True):
+    """
+    指定されたPersonIDと年月のレコードをAirtableから取得（全ページ分をリストで返す）。
+    ページ数の上限で打ち切られた/途中のページで失敗した場合は取得できた分を返す（行を探す用途向け。集計には使わないこと）。
+    """
+    records = []
+    try:
+        for page in iter_airtable_records_for_month(person_id, target_year, target_month, force_refresh=force_refresh,
+                                                    use_mirror=use_mirror):
+            records.extend(page)
+    except (MonthTruncatedError, MonthFetchError) as e:
+        logger.warning(f"{e}（取得できた {len(records)}件を返します）")
+    return records
+
+
+# ==== 前後月の先読み（records 画面の「前月/次月」移動をキャッシュヒットにする） ====
+MONTH_PREFETCH_ENABLED = os.environ.get("AIRTABLE_PREFETCH", "1") != "0"
+# 1ユーザーあたりの先読み上限（Airtable のレート制限 5 req/s/base を画面操作に残すため）
+PREFETCH_MAX_PER_PERSON_PER_MIN = int(os.environ.get("AIRTABLE_PREFETCH_PER_PERSON_PER_MIN", "6"))
+PREFETCH_MAX_INFLIGHT_PER_PERSON = int(os.environ.get("AIRTABLE_PREFETCH_INFLIGHT_PER_PERSON", "2"))
+
+_prefetch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("AIRTABLE_PREFETCH_WORKERS", "2")),
+    thread_name_prefix="airtable-month-prefetch"
+)
+_prefetch_lock = Lock()
+_prefetch_inflight = {}  # person_id -> 実行中の先読み件数
+_prefetch_history = {}   # person_id -> 直近1分の先読み開始時刻のリスト
+
+def _prefetch_month(person_id: str, target_year: int, target_month: int):
+    try:
+        for _ in iter_airtable_records_for_month(person_id, target_year, target_month, force_refresh=True):
+            pass
     except Exception as e:
-        logger.error(f"Airtableレコード取得エラー: {e}", exc_info=True)
-        return []
+        logger.warning(f"先読みに失敗（無視）: PersonID={person_id}, {target_year}-{target_month:02d} {e}")
+    finally:
+        with _prefetch_lock:
+            _prefetch_inflight[person_id] = max(0, _prefetch_inflight.get(person_id, 1) - 1)
+
+def _reserve_prefetch_slot(person_id: str) -> bool:
+    """ユーザーごとの同時実行数・1分あたりの回数の上限内なら枠を確保して True。"""
+    now = time.time()
+    with _prefetch_lock:
+        history = [t for t in _prefetch_history.get(person_id, []) if now - t < 60]
+        if (len(history) >= PREFETCH_MAX_PER_PERSON_PER_MIN
+                or _prefetch_inflight.get(person_id, 0) >= PREFETCH_MAX_INFLIGHT_PER_PERSON):
+            _prefetch_history[person_id] = history
+            return False
+        history.append(now)
+        _prefetch_history[person_id] = history
+        _prefetch_inflight[person_id] = _prefetch_inflight.get(person_id, 0) + 1
+        return True
+
+def prefetch_months(person_id: str, months) -> int:
+    """
+    指定した (year, month) の月をバックグラウンドで取得してキャッシュに入れておく。
+    既に新しいキャッシュがある月・取得中の月・未来の月は飛ばす。予約した件数を返す。
+    """
+    if not MONTH_PREFETCH_ENABLED:
+        return 0
+    today = time.localtime()
+    scheduled = 0
+    for target_year, target_month in months:
+        if (target_year, target_month) > (today.tm_year, today.tm_mon):
+            continue  # 未来の月はまだ記録が無い
+        key = month_key(person_id, target_year, target_month)
+        entry = cache_get_entry(key)
+        if entry is not None and time.time() - entry[1] <= MONTH_SOFT_TTL_SEC:
+            continue
+        if _month_flight.in_flight(key):
+            continue
+        if not _reserve_prefetch_slot(person_id):
+            logger.info(f"[PREFETCH SKIP] PersonID={person_id} 先読みの上限に達しました")
+            break
+        try:
+            _prefetch_executor.submit(_prefetch_month, person_id, target_year, target_month)
+        except RuntimeError:  # インタプリタ終了中など
+            with _prefetch_lock:
+                _prefetch_inflight[person_id] = max(0, _prefetch_inflight.get(person_id, 1) - 1)
+            break
+        scheduled += 1
+        logger.info(f"[PREFETCH] {key}")
+    return scheduled
+
+
+# ==== 複数月の集計（年間サマリー用） ====
+# キャッシュに無い月は小さなスレッドプールで並列に取得する（Airtable への送信は送信枠で全体が抑えられる）
+SUMMARY_WORKERS = int(os.environ.get("AIRTABLE_SUMMARY_WORKERS", "4"))
+SUMMARY_TIMEOUT_SEC = float(os.environ.get("AIRTABLE_SUMMARY_TIMEOUT_SEC", "30"))  # 全月そろうまでの待ち上限
+
+_summary_executor = ThreadPoolExecutor(
+    max_workers=SUMMARY_WORKERS,
+    thread_name_prefix="airtable-month-summary"
+)
+
+def _month_snapshot(person_id: str, target_year: int, target_month: int, force_refresh: bool = False):
+    """1か月分の MonthSnapshot（キャッシュ→ミラー→Airtable の順）。取得に失敗した場合は None。"""
+    snapshot = None
+    rows = []
+    for page in iter_airtable_records_for_month(person_id, target_year, target_month, force_refresh=force_refresh,
+                                                use_mirror=not force_refresh):
+        if isinstance(page, MonthSnapshot):
+            snapshot = page
+        rows.extend(page)
+    if snapshot is not None:
+        return snapshot
+    # ページ単位で取得した場合は保存済みのキャッシュを使う（無ければ取得が途中で失敗した）
+    entry = cache_get_entry(month_key(person_id, target_year, target_month))
+    if entry is not None:
+        return entry[0] if isinstance(entry[0], MonthSnapshot) else MonthSnapshot(entry[0])
+    return None
+
+def get_month_summaries(person_id: str, months, force_refresh: bool = False) -> dict:
+    """
+    指定した (year, month) ごとの MonthAggregates を返す（{(year, month): MonthAggregates}）。
+    新しいキャッシュがある月はその集計をそのまま使い、無い月だけ並列に取得する。
+    取得に失敗した/時間内に終わらなかった月は None、未来の月は空の集計。
+    """
+    today = time.localtime()
+    results = {}
+    futures = {}
+    for target_year, target_month in months:
+        ym = (target_year, target_month)
+        if ym > (today.tm_year, today.tm_mon):
+            results[ym] = MonthAggregates()  # 未来の月はまだ記録が無い
+            continue
+        if not force_refresh:
+            entry = cache_get_entry(month_key(person_id, target_year, target_month))
+            if entry is not None and isinstance(entry[0], MonthSnapshot) \
+                    and time.time() - entry[1] <= MONTH_SOFT_TTL_SEC:
+                results[ym] = entry[0].aggregates
+                continue
+        futures[ym] = _summary_executor.submit(_month_snapshot, person_id, target_year, target_month, force_refresh)
+
+    deadline = time.monotonic() + SUMMARY_TIMEOUT_SEC
+    for ym, future in futures.items():
+        try:
+            snapshot = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except Exception as e:
+            logger.warning(f"[SUMMARY] PersonID={person_id} {ym[0]}-{ym[1]:02d} の取得に失敗: {e!r}")
+            snapshot = None
+        results[ym] = snapshot.aggregates if snapshot is not None else None
+    logger.info(f"[SUMMARY] PersonID={person_id} {len(results)}か月 (取得{len(futures)}件)")
+    return results
+
+# ==== 全員分の同じ月（管理画面用） ====
+# 人ごとのテーブルを並列に取得する。送信は airtable_client の送信枠（ベースごと）で抑えられるので、
+# ワーカー数は同時に待つ取得の数の上限。取得した月は通常の月キャッシュに入る
+FANOUT_WORKERS = int(os.environ.get("AIRTABLE_FANOUT_WORKERS", "4"))
+FANOUT_TIMEOUT_SEC = float(os.environ.get("AIRTABLE_FANOUT_TIMEOUT_SEC", "120"))
+
+_fanout_executor = ThreadPoolExecutor(
+    max_workers=FANOUT_WORKERS,
+    thread_name_prefix="airtable-month-fanout"
+)
+
+def iter_month_snapshots_for_persons(person_ids, target_year: int, target_month: int, force_refresh: bool = False):
+    """
+    複数人の同じ月を並列に取得し、終わった順に (person_id, MonthSnapshot または None) を yield する。
+    新しいキャッシュがある人は取得せず先に返す。呼び出し側が途中でやめたら、まだ始まっていない取得は取り消す。
+    """
+    futures = {}
+    for person_id in person_ids:
+        person_id = str(person_id)
+        if not force_refresh:
+            entry = cache_get_entry(month_key(person_id, target_year, target_month))
+            if entry is not None and isinstance(entry[0], MonthSnapshot) \
+                    and time.time() - entry[1] <= MONTH_SOFT_TTL_SEC:
+                yield person_id, entry[0]
+                continue
+        futures[_fanout_executor.submit(_month_snapshot, person_id, target_year, target_month, force_refresh)] = person_id
+
+    started = time.time()
+    try:
+        for future in as_completed(list(futures), timeout=FANOUT_TIMEOUT_SEC):
+            person_id = futures.pop(future)
+            try:
+                snapshot = future.result()
+            except Exception as e:
+                logger.warning(f"[FANOUT] PersonID={person_id} {target_year}-{target_month:02d} の取得に失敗: {e!r}")
+                snapshot = None
+            yield person_id, snapshot
+    except FuturesTimeoutError:
+        logger.warning(f"[FANOUT] {target_year}-{target_month:02d} {len(futures)}人分が時間内に終わりませんでした")
+        for person_id in list(futures.values()):
+            yield person_id, None
+        futures.clear()
+    finally:
+        for future in futures:
+            future.cancel()
+    logger.info(f"[FANOUT] {target_year}-{target_month:02d} 完了 {(time.time() - started) * 1000:.0f}ms")
+
+def get_year_summary(person_id: str, target_year: int, force_refresh: bool = False) -> dict:
+    """1年分の月ごとの金額・稼働日数・分給の合計と年間合計（画面と JSON API の共通形）。"""
+    summaries = get_month_summaries(person_id, [(target_year, m) for m in range(1, 13)], force_refresh)
+    months = []
+    totals = {"total_amount": 0, "workdays_count": 0, "workoutput_total": 0.0}
+    for m in range(1, 13):
+        aggregates = summaries.get((target_year, m))
+        item = {"month": m, "ok": aggregates is not None}
+        if aggregates is not None:
+            item.update(aggregates.as_dict())
+            for name in totals:
+                totals[name] += item[name]
+        months.append(item)
+    return {
+        "year": target_year,
+        "months": months,
+        "totals": totals,
+        "complete": all(item["ok"] for item in months),
+    }
 
 
 
@@ -210,9 +685,10 @@ def delete_airtable_record(person_id: str, record_id: str):
 
     try:
         logger.info(f"Airtableレコード削除開始: URL={url}, PersonID={person_id}, RecordID={record_id}")
-        response = requests.delete(url, headers=HEADERS, timeout=10)
+        response = airtable_request("DELETE", url, headers=HEADERS, read_timeout=10)
         response.raise_for_status()
         logger.info(f"Airtableレコード削除成功: RecordID={record_id}, PersonID={person_id}")
+        airtable_mirror.mirror_remove_records(person_id, [record_id])
         return True, "✅ レコードを削除しました！"
     except requests.exceptions.HTTPError as http_err:
         err_msg = "詳細不明"
@@ -235,7 +711,7 @@ def get_airtable_record_details(person_id: str, record_id: str):
 
     try:
         logger.info(f"Airtableレコード詳細取得開始: URL={url}, PersonID={person_id}, RecordID={record_id}")
-        response = requests.get(url, headers=HEADERS, timeout=10)
+        response = airtable_request("GET", url, headers=HEADERS, read_timeout=10)
         response.raise_for_status()
         record_data = response.json().get("fields", {})
         logger.info(f"Airtableレコード詳細取得成功: RecordID={record_id}, PersonID={person_id}")
@@ -253,6 +729,27 @@ def get_airtable_record_details(person_id: str, record_id: str):
         logger.error(f"Airtableレコード詳細取得エラー (RequestException): {str(e)} - URL: {url}", exc_info=True)
         return None, f"❌ レコード取得に失敗しました: {str(e)}"
 
+def get_record_details_cached(person_id: str, record_id: str, year: int = None, month: int = None):
+    """
+    編集画面用のレコード詳細。一覧で表示した月のキャッシュにあれば Airtable に問い合わせずに返し、
+    無ければ get_airtable_record_details で取得する（戻り値の形も同じ: (fields, エラーメッセージ)）。
+    キャッシュは取得から MONTH_HARD_TTL_SEC 以内のものだけ使う（一覧と同じ鮮度。それより古い月の値で
+    フォームを埋めると、他で更新された内容を古い値で上書きしてしまう）。
+    """
+    row = month_cache_find_record(person_id, record_id, year, month, max_age_sec=MONTH_HARD_TTL_SEC)
+    if row is not None and not row.get("pending"):
+        logger.info(f"[CACHE HIT] record {record_id} (PersonID={person_id})")
+        # 一覧用の行は WorkCD、Airtable の fields は WorkCord
+        return {
+            "WorkDay": row.get("WorkDay"),
+            "WorkCord": row.get("WorkCD"),
+            "WorkName": row.get("WorkName"),
+            "WorkProcess": row.get("WorkProcess"),
+            "UnitPrice": row.get("UnitPrice"),
+            "WorkOutput": row.get("WorkOutput"),
+        }, None
+    return get_airtable_record_details(person_id, record_id)
+
 def update_airtable_record_fields(person_id: str, record_id: str, fields_to_update: dict):
     """Airtableの既存レコードの指定されたフィールドを更新します。"""
     url = _build_airtable_url(person_id, record_id)
@@ -262,9 +759,12 @@ def update_airtable_record_fields(person_id: str, record_id: str, fields_to_upda
     data = {"fields": fields_to_update}
     try:
         logger.info(f"Airtableレコード更新開始: URL={url}, Data={data}, PersonID={person_id}, RecordID={record_id}")
-        response = requests.patch(url, headers=HEADERS, json=data, timeout=10)
+        response = airtable_request("PATCH", url, headers=HEADERS, json=data, read_timeout=10)
         response.raise_for_status()
         logger.info(f"Airtableレコード更新成功: RecordID={record_id}, PersonID={person_id}")
+        airtable_mirror.mirror_patch_record(
+            person_id, record_id, {("WorkCD" if k == "WorkCord" else k): v for k, v in fields_to_update.items()}
+        )
         return True, "✅ レコードを更新しました！" # 成功時はメッセージのみを返す
     except requests.exceptions.HTTPError as http_err:
         err_msg = "詳細不明"
@@ -277,4 +777,140 @@ def update_airtable_record_fields(person_id: str, record_id: str, fields_to_upda
         return False, f"❌ 更新に失敗しました (HTTP {http_err.response.status_code}): {err_msg}"
     except requests.RequestException as e:
         logger.error(f"Airtableレコード更新エラー (RequestException): {str(e)} - URL: {url}", exc_info=True)
-        return False, f"❌ 更新に失敗しました: {str(e)}"
\ No newline at end of file
+        return False, f"❌ 更新に失敗しました: {str(e)}"
+
+# ==== 一括書き込み（Airtable は create/update/delete とも1リクエスト最大10件） ====
+AIRTABLE_BATCH_SIZE = 10
+
+def _chunks(items: list, size: int = AIRTABLE_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _http_error_message(http_err) -> str:
+    try:
+        err_detail = http_err.response.json().get('error', {})
+        if isinstance(err_detail, dict): return err_detail.get('message', '詳細不明')
+        if isinstance(err_detail, str): return err_detail
+        return '詳細不明'
+    except ValueError:
+        return http_err.response.text if http_err.response.text else '詳細不明'
+
+def month_of_row(row: dict):
+    """一覧の行の (year, month)。"""
+    workday = str(row.get("WorkDay", "9999-12-31"))
+    return int(workday[:4]), int(workday[5:7])
+
+def _group_rows_by_month(rows) -> dict:
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(month_of_row(row), []).append(row)
+    return grouped
+
+def create_airtable_records_batch(person_id: str, fields_list: list):
+    """
+    複数レコードを10件ずつまとめて作成する（fields は build_record_fields の形）。
+    戻り値: (成功したか, メッセージ, 作成できた行のリスト)。途中で失敗した場合もそれまでに作成できた行を返す。
+    作成できた行は当月キャッシュがあれば月ごとに1回でまとめて反映する。
+    """
+    url = _build_airtable_url(person_id)
+    if not url:
+        return False, "⚠ AirtableのURL構築に失敗しました（設定不備の可能性）。", []
+
+    fields_list = list(fields_list)
+    created_rows = []
+    message = None
+    try:
+        for chunk in _chunks(fields_list):
+            logger.info(f"Airtableへのレコード一括作成: URL={url}, PersonID={person_id}, {len(chunk)}件")
+            response = airtable_request("POST", url, headers=HEADERS,
+                                        json={"records": [{"fields": f} for f in chunk]}, read_timeout=15)
+            response.raise_for_status()
+            records = response.json().get("records", [])
+            # 返却順は送信順と同じ。一覧用の行は送った値から作る（空の項目は返却に含まれないため）
+            created_rows.extend(month_row_from_fields(rec.get("id"), f) for rec, f in zip(records, chunk))
+    except requests.exceptions.HTTPError as http_err:
+        err_msg = _http_error_message(http_err)
+        logger.error(f"Airtableレコード一括作成エラー (HTTPError): {http_err.response.status_code} {err_msg} - URL: {url}")
+        message = (f"⚠ {len(fields_list)}件中 {len(created_rows)}件を登録した時点で失敗しました "
+                   f"(HTTP {http_err.response.status_code}): {err_msg}")
+    except requests.RequestException as e:
+        logger.error(f"Airtableレコード一括作成エラー (RequestException): {str(e)} - URL: {url}", exc_info=True)
+        message = f"⚠ {len(fields_list)}件中 {len(created_rows)}件を登録した時点で失敗しました: {str(e)}"
+
+    try:
+        airtable_mirror.mirror_upsert_rows(person_id, created_rows)
+        for (y, m), rows in _group_rows_by_month(created_rows).items():
+            if month_cache_apply(person_id, y, m, upserts=rows, ttl_sec=MONTH_CACHE_RETAIN_SEC):
+                logger.info(f"[CACHE WRITE-THROUGH] appended {len(rows)} records to {month_key(person_id, y, m)}")
+    except Exception as e:
+        logger.warning(f"キャッシュ差分更新に失敗（無視して継続）: {e}")
+
+    if message:
+        return False, message, created_rows
+    logger.info(f"Airtableへのレコード一括作成成功: {len(created_rows)}件, PersonID={person_id}")
+    return True, f"✅ {len(created_rows)}件を Airtable に送信しました！", created_rows
+
+def update_airtable_records_batch(person_id: str, updates: list):
+    """
+    複数レコードの指定フィールドを10件ずつまとめて更新する。updates は [(record_id, fields), ...]。
+    戻り値: (成功したか, メッセージ, 更新後の行のリスト)。行は Airtable が返した更新後の全項目から作る。
+    月キャッシュへの反映は呼び出し側で行う（更新前の月が分かるのは呼び出し側のため）。
+    """
+    url = _build_airtable_url(person_id)
+    if not url:
+        return False, "⚠ AirtableのURL構築に失敗しました（設定不備の可能性）。", []
+
+    updates = list(updates)
+    updated_rows = []
+    try:
+        for chunk in _chunks(updates):
+            logger.info(f"Airtableレコード一括更新: URL={url}, PersonID={person_id}, {len(chunk)}件")
+            response = airtable_request("PATCH", url, headers=HEADERS,
+                                        json={"records": [{"id": rid, "fields": f} for rid, f in chunk]},
+                                        read_timeout=15)
+            response.raise_for_status()
+            chunk_rows = [_process_month_record(rec) for rec in response.json().get("records", [])]
+            airtable_mirror.mirror_upsert_rows(person_id, chunk_rows)
+            updated_rows.extend(chunk_rows)
+    except requests.exceptions.HTTPError as http_err:
+        err_msg = _http_error_message(http_err)
+        logger.error(f"Airtableレコード一括更新エラー (HTTPError): {http_err.response.status_code} {err_msg} - URL: {url}")
+        return False, (f"❌ {len(updates)}件中 {len(updated_rows)}件を更新した時点で失敗しました "
+                       f"(HTTP {http_err.response.status_code}): {err_msg}"), updated_rows
+    except requests.RequestException as e:
+        logger.error(f"Airtableレコード一括更新エラー (RequestException): {str(e)} - URL: {url}", exc_info=True)
+        return False, f"❌ {len(updates)}件中 {len(updated_rows)}件を更新した時点で失敗しました: {str(e)}", updated_rows
+
+    logger.info(f"Airtableレコード一括更新成功: {len(updated_rows)}件, PersonID={person_id}")
+    return True, f"✅ {len(updated_rows)}件のレコードを更新しました！", updated_rows
+
+def delete_airtable_records_batch(person_id: str, record_ids: list):
+    """
+    複数レコードを10件ずつまとめて削除する。
+    戻り値: (成功したか, メッセージ, 削除できたIDのリスト)。月キャッシュへの反映は呼び出し側で行う。
+    """
+    url = _build_airtable_url(person_id)
+    if not url:
+        return False, "⚠ AirtableのURL構築に失敗しました（設定不備の可能性）。", []
+
+    record_ids = list(record_ids)
+    deleted_ids = []
+    try:
+        for chunk in _chunks(record_ids):
+            logger.info(f"Airtableレコード一括削除: URL={url}, PersonID={person_id}, {len(chunk)}件")
+            response = airtable_request("DELETE", url, headers=HEADERS, params={"records[]": chunk}, read_timeout=15)
+            response.raise_for_status()
+            chunk_ids = [rec.get("id") for rec in response.json().get("records", []) if rec.get("deleted")]
+            airtable_mirror.mirror_remove_records(person_id, chunk_ids)
+            deleted_ids.extend(chunk_ids)
+    except requests.exceptions.HTTPError as http_err:
+        err_msg = _http_error_message(http_err)
+        logger.error(f"Airtableレコード一括削除エラー (HTTPError): {http_err.response.status_code} {err_msg} - URL: {url}")
+        return False, (f"❌ {len(record_ids)}件中 {len(deleted_ids)}件を削除した時点で失敗しました "
+                       f"(HTTP {http_err.response.status_code}): {err_msg}"), deleted_ids
+    except requests.RequestException as e:
+        logger.error(f"Airtableレコード一括削除エラー (RequestException): {str(e)} - URL: {url}", exc_info=True)
+        return False, f"❌ {len(record_ids)}件中 {len(deleted_ids)}件を削除した時点で失敗しました: {str(e)}", deleted_ids
+
+    logger.info(f"Airtableレコード一括削除成功: {len(deleted_ids)}件, PersonID={person_id}")
+    return True, f"✅ {len(deleted_ids)}件のレコードを削除しました！", deleted_ids
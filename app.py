@@ -1,46 +1,7 @@
 # app.py
-from flask import Flask
 import os
 import logging
 
-# データサービスモジュールから初期ロード用関数をインポート
-from data_services import (
-    load_personid_data,
-    load_workcord_data,
-    load_workprocess_data
-)
-
-# Blueprint をインポート
-from blueprints.api import api_bp  # 既存のAPI Blueprint
-from blueprints.ui import ui_bp    # 新しく作成したUI Blueprint
-from blueprints.auth import auth_bp # ★★★ auth_bp をインポート ★★★
-app = Flask(__name__)
-# 環境変数からSECRET_KEYを読み込む
-app.secret_key = os.environ.get("FLASK_SECRET_KEY", "a_very_strong_default_secret_key_for_dev_only_CHANGE_ME")
-
-# ===== ロギング設定 =====
-# (既存のロギング設定はそのまま、または必要に応じて調整)
-for handler in app.logger.handlers[:]: 
-    app.logger.removeHandler(handler)
-stream_handler = logging.StreamHandler()
-formatter = logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(module)s:%(lineno)d]'
-)
-stream_handler.setFormatter(formatter)
-app.logger.addHandler(stream_handler)
-if os.environ.get('FLASK_DEBUG') == '1':
-    app.debug = True
-    app.logger.setLevel(logging.DEBUG)
-    stream_handler.setLevel(logging.DEBUG)
-else:
-    app.debug = False
-    app.logger.setLevel(logging.INFO)
-    stream_handler.setLevel(logging.INFO)
-app.logger.info("アプリケーションのロギングが初期化されました。")
-app.logger.info(f"FLASK_DEBUG: {os.environ.get('FLASK_DEBUG')}, app.debug: {app.debug}")
-# ===== ロギング設定ここまで =====
-
-
 # --- Airtable関連の設定や直接的な関数定義は airtable_service.py に移動したのでここからは削除 ---
 # AIRTABLE_TOKEN = ... (削除)
 # AIRTABLE_BASE_ID = ... (削除)
@@ -66,10 +27,56 @@ app.logger.info(f"FLASK_DEBUG: {os.environ.get('FLASK_DEBUG')}, app.debug: {app.
 # @app.route("/get_unitprice", methods=["GET"]) def get_unitprice(): ... (削除)
 
 
-# Blueprint を登録
-app.register_blueprint(api_bp)  # 既存のAPI Blueprint (通常 /api プレフィックス付き)
-app.register_blueprint(ui_bp)   # 新しいUI Blueprint (プレフィックスなし)
-app.register_blueprint(auth_bp) # ★★★ auth_bp を登録 ★★★
+def create_app():
+    """アプリを組み立てる。Flask・Blueprint 等の import（参照データのスナップショット読み込みなどが走る）もここで行う。"""
+    from flask import Flask
+    import static_assets # 応答の圧縮と静的ファイルの指紋付き配信
+
+    # Blueprint をインポート
+    from blueprints.api import api_bp  # 既存のAPI Blueprint
+    from blueprints.ui import ui_bp    # 新しく作成したUI Blueprint
+    from blueprints.auth import auth_bp # ★★★ auth_bp をインポート ★★★
+    from blueprints.admin import admin_bp # 管理画面（ADMIN_PERSON_IDS のみ）
+    app = Flask(__name__)
+    # 環境変数からSECRET_KEYを読み込む
+    app.secret_key = os.environ.get("FLASK_SECRET_KEY", "a_very_strong_default_secret_key_for_dev_only_CHANGE_ME")
+
+    # ===== ロギング設定 =====
+    # (既存のロギング設定はそのまま、または必要に応じて調整)
+    for handler in app.logger.handlers[:]: 
+        app.logger.removeHandler(handler)
+    stream_handler = logging.StreamHandler()
+    formatter = logging.Formatter(
+        '%(asctime)s %(levelname)s: %(message)s [in %(module)s:%(lineno)d]'
+    )
+    stream_handler.setFormatter(formatter)
+    app.logger.addHandler(stream_handler)
+    if os.environ.get('FLASK_DEBUG') == '1':
+        app.debug = True
+        app.logger.setLevel(logging.DEBUG)
+        stream_handler.setLevel(logging.DEBUG)
+    else:
+        app.debug = False
+        app.logger.setLevel(logging.INFO)
+        stream_handler.setLevel(logging.INFO)
+    app.logger.info("アプリケーションのロギングが初期化されました。")
+    app.logger.info(f"FLASK_DEBUG: {os.environ.get('FLASK_DEBUG')}, app.debug: {app.debug}")
+    # ===== ロギング設定ここまで =====
+
+    # Blueprint を登録
+    app.register_blueprint(api_bp)  # 既存のAPI Blueprint (通常 /api プレフィックス付き)
+    app.register_blueprint(ui_bp)   # 新しいUI Blueprint (プレフィックスなし)
+    app.register_blueprint(auth_bp) # ★★★ auth_bp を登録 ★★★
+    app.register_blueprint(admin_bp) # 管理画面 (/admin)
+
+    static_assets.init_app(app) # debug 判定の後に呼ぶ（debug 中は静的ファイルに指紋を付けない）
+    return app
+
+
+# PIN 照合用の子プロセス（auth_service のプロセスプール。forkserver/spawn）は、起動したスクリプト
+# （python app.py のときはこのファイル）を __mp_main__ として import し直す。子で動くのは pin_worker だけなので、
+# その場合はアプリを組み立てない（Blueprint・参照データのスナップショット・静的ファイルの指紋を子ごとに作らない）
+app = create_app() if __name__ != "__mp_main__" else None
 
 if __name__ == "__main__":
     app.logger.info("アプリケーション起動: 初期データキャッシュを開始します...")
@@ -78,10 +85,9 @@ if __name__ == "__main__":
         # (本番環境のGunicorn/Waitressでは通常この環境変数は設定されません)
         if os.environ.get("WERKZEUG_RUN_MAIN") != "true":
             app.logger.info("メインプロセスでのみ初期データロードを実行します。")
+            from data_services import refresh_reference_data # 3シート一括ロード（失敗時はシートごとに個別ロード）
             with app.app_context(): # アプリケーションコンテキスト内で実行
-                load_personid_data()
-                load_workcord_data()
-                load_workprocess_data()
+                refresh_reference_data()
             app.logger.info("初期データキャッシュが完了しました。")
         else:
             # Werkzeugのリローダーの子プロセスの場合など
@@ -91,6 +97,9 @@ if __name__ == "__main__":
         app.logger.critical(f"アプリケーション起動時の初期データロードに失敗しました: {e}", exc_info=True)
         # 状況に応じて exit(1) などで終了させることも検討
 
+    from write_behind import ensure_flusher # write-behind 有効時の送信スレッド
+    ensure_flusher()  # 前回送り残した write-behind の行があれば送る
+
     from waitress import serve
     port = int(os.environ.get("PORT", 10000))
     app.logger.info(f"Waitressサーバをポート {port} で起動します...")
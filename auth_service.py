@@ -0,0 +1,224 @@
+# auth_service.py
+import os
+import time
+import logging
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+
+from werkzeug.security import check_password_hash
+
+import pin_worker
+
+logger = logging.getLogger(__name__)
+if not logger.hasHandlers():
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+# ==== PIN ハッシュ照合（scrypt/pbkdf2 は意図的に重いので、リクエストスレッドでは計算しない） ====
+AUTH_HASH_WORKERS = int(os.environ.get("AUTH_HASH_WORKERS", "2"))
+# 照合待ちの上限（実行中 + 待ち）。溢れたら計算せずに「混雑中」で返す
+AUTH_HASH_QUEUE_MAX = int(os.environ.get("AUTH_HASH_QUEUE_MAX", str(AUTH_HASH_WORKERS * 4)))
+AUTH_HASH_QUEUE_WAIT_SEC = float(os.environ.get("AUTH_HASH_QUEUE_WAIT_SEC", "0.5"))
+AUTH_HASH_TIMEOUT_SEC = float(os.environ.get("AUTH_HASH_TIMEOUT_SEC", "10"))
+
+# ==== ログイン試行の制限（失敗回数。窓の中で上限に達したら、照合せずに断る） ====
+# 失敗回数はワーカープロセスごとに数える（共有しない）。gunicorn のワーカーが WEB_CONCURRENCY 個あれば、
+# 同じ PersonID / IP の失敗は振り分け次第で各ワーカーに分かれるので、実質の上限は最大で「上限 × ワーカー数」になる。
+AUTH_FAILURE_WINDOW_SEC = int(os.environ.get("AUTH_FAILURE_WINDOW_SEC", "900"))
+AUTH_MAX_FAILURES_PER_ID = int(os.environ.get("AUTH_MAX_FAILURES_PER_ID", "5"))
+# 職場の端末は同じ IP からまとめてログインするので、IP ごとの上限は大きめにする
+AUTH_MAX_FAILURES_PER_IP = int(os.environ.get("AUTH_MAX_FAILURES_PER_IP", "30"))
+AUTH_THROTTLE_MAX_KEYS = int(os.environ.get("AUTH_THROTTLE_MAX_KEYS", "10000"))
+# 前段のプロキシ（Render 等）の段数。1 以上なら X-Forwarded-For の右から数えた位置を利用者の IP とみなす。
+# 0 はプロキシなし（接続元アドレスがそのまま利用者）。
+# 未設定の場合は利用者の IP が分からないので IP ごとの制限はかけない（プロキシの後ろでは接続元が全員同じ
+# プロキシのアドレスになり、誰かの失敗で全員がログインできなくなるため）。
+_proxy_hops = os.environ.get("AUTH_TRUSTED_PROXY_HOPS", "").strip()
+AUTH_TRUSTED_PROXY_HOPS = int(_proxy_hops) if _proxy_hops else None
+if AUTH_TRUSTED_PROXY_HOPS is None:
+    logger.warning("AUTH_TRUSTED_PROXY_HOPS が未設定のため、IP ごとのログイン制限は無効です（PersonID ごとの制限のみ）。")
+
+_pool = None
+_pool_pid = None
+_pool_lock = Lock()
+_queue_slots = BoundedSemaphore(AUTH_HASH_QUEUE_MAX)
+
+_failures_lock = Lock()
+_failures = OrderedDict()  # ("id", pid) / ("ip", addr) -> 失敗時刻の deque。末尾ほど最近失敗した
+
+_stats_lock = Lock()
+_stats = {"verified": 0, "busy": 0, "timeouts": 0, "throttled": 0, "failures": 0, "inline": 0}
+
+
+def _count(name: str):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _pool_context():
+    """
+    照合用の子プロセスの起動方式。ワーカーは既に複数のスレッド（参照データ更新・キャッシュ掃除・
+    write-behind 送信など）を動かしているので、そのまま fork すると子プロセスがロックを持ったまま固まりうる。
+    forkserver（使えない環境では spawn）で、スレッドを持たないプロセスから子を作る。
+    子プロセスは起動したスクリプト（python app.py ならそのファイル）を __mp_main__ として読み込み直すので、
+    app.py はその場合にアプリを組み立てない。子で動くのは pin_worker だけ。
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        # forkserver 自体には照合に必要なモジュールだけを読み込ませておく
+        ctx.set_forkserver_preload(["pin_worker"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _get_pool():
+    """プロセス共通の照合用プロセスプール（fork 後の子プロセスでは作り直す）。作れない環境では None。"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            try:
+                _pool = ProcessPoolExecutor(max_workers=AUTH_HASH_WORKERS, mp_context=_pool_context(),
+                                            initializer=pin_worker.init_worker)
+                _pool_pid = pid
+                logger.info(f"PIN照合用プロセスプールを作成しました (workers={AUTH_HASH_WORKERS}, pid={pid})")
+            except (OSError, NotImplementedError) as e:
+                logger.warning(f"PIN照合用プロセスプールを作成できません。スレッド内で照合します: {e}")
+                _pool = None
+        return _pool
+
+
+def client_ip(remote_addr: str, forwarded_for: str = None):
+    """
+    ログイン制限に使う利用者の IP。信頼するプロキシの段数ぶんだけ X-Forwarded-For を辿る（偽装された左側は見ない）。
+    段数が未設定、またはヘッダが段数に足りず利用者の IP が分からない場合は None（IP ごとの制限をかけない）。
+    """
+    if AUTH_TRUSTED_PROXY_HOPS is None:
+        return None
+    if AUTH_TRUSTED_PROXY_HOPS == 0:
+        return remote_addr or None
+    hops = [h.strip() for h in (forwarded_for or "").split(",") if h.strip()]
+    if len(hops) >= AUTH_TRUSTED_PROXY_HOPS:
+        return hops[-AUTH_TRUSTED_PROXY_HOPS]
+    return None  # プロキシを経由していない/段数の設定違い。プロキシのアドレスで全員をまとめて数えない
+
+
+def verify_pin(pin_hash: str, pin: str):
+    """
+    PIN をハッシュと照合する。一致で True、不一致で False。
+    照合待ちが上限を超えている/時間内に終わらない場合は None（呼び出し側で「混雑中」を返す）。
+    """
+    global _pool
+    if not _queue_slots.acquire(timeout=AUTH_HASH_QUEUE_WAIT_SEC):
+        _count("busy")
+        logger.warning("PIN照合の待ちが上限に達したため受け付けませんでした")
+        return None
+    future = None
+    release_on_done = False  # True なら枠は照合が終わった時点で返す（タイムアウト後も計算が続いている）
+    try:
+        pool = _get_pool()
+        if pool is None:
+            _count("inline")
+            result = check_password_hash(pin_hash, pin)  # 同時実行数はセマフォで抑えられている
+        else:
+            future = pool.submit(pin_worker.verify, pin_hash, pin)
+            result = future.result(timeout=AUTH_HASH_TIMEOUT_SEC)
+        _count("verified")
+        return bool(result)
+    except BrokenProcessPool as e:
+        # 子プロセスが落ちた。次回は作り直し、今回はこのスレッドで照合する
+        with _pool_lock:
+            _pool = None
+        logger.warning(f"PIN照合用プロセスプールが停止していたため作り直します: {e}")
+        _count("inline")
+        return bool(check_password_hash(pin_hash, pin))
+    except FuturesTimeoutError:
+        _count("timeouts")
+        logger.warning(f"PIN照合が {AUTH_HASH_TIMEOUT_SEC:.0f} 秒以内に終わりませんでした")
+        if not future.cancel():
+            # 既に子プロセスで計算中なので止められない。終わるまで待ち数の上限に数えておく
+            future.add_done_callback(lambda _: _queue_slots.release())
+            release_on_done = True
+        return None
+    finally:
+        if not release_on_done:
+            _queue_slots.release()
+
+
+def _recent_failures(key, now: float) -> deque:
+    # 呼び出し側で _failures_lock を取っていること
+    times = _failures.get(key)
+    if times is None:
+        return deque()
+    while times and now - times[0] >= AUTH_FAILURE_WINDOW_SEC:
+        times.popleft()
+    if not times:
+        _failures.pop(key, None)
+    return times
+
+
+def _limit_keys(person_id, ip):
+    """制限をかけるキーと上限。ip が None（利用者の IP が分からない）なら PersonID ごとの制限だけ。"""
+    keys = [(("id", str(person_id)), AUTH_MAX_FAILURES_PER_ID)]
+    if ip is not None:
+        keys.append((("ip", ip), AUTH_MAX_FAILURES_PER_IP))
+    return keys
+
+
+def check_login_allowed(person_id, ip):
+    """
+    照合の前に呼ぶ。(許可するか, 次に試せるまでの秒数) を返す。
+    PersonID ごと・IP ごとの失敗回数が窓の中で上限に達していれば、ハッシュ計算をせずに断る。
+    """
+    now = time.time()
+    limits = _limit_keys(person_id, ip)
+    retry_after = 0
+    with _failures_lock:
+        for key, limit in limits:
+            times = _recent_failures(key, now)
+            if limit > 0 and len(times) >= limit:
+                # 窓の中で上限-1件まで減る時刻（= 古い方から数えた失敗が窓から出る時刻）
+                retry_after = max(retry_after, times[len(times) - limit] + AUTH_FAILURE_WINDOW_SEC - now)
+    if retry_after > 0:
+        _count("throttled")
+        return False, int(retry_after) + 1
+    return True, 0
+
+
+def record_login_failure(person_id, ip):
+    now = time.time()
+    _count("failures")
+    with _failures_lock:
+        for key, _ in _limit_keys(person_id, ip):
+            times = _recent_failures(key, now)
+            times.append(now)
+            _failures[key] = times
+            _failures.move_to_end(key)
+        while len(_failures) > AUTH_THROTTLE_MAX_KEYS:
+            _failures.popitem(last=False)
+
+
+def record_login_success(person_id, ip):
+    """成功したら PersonID の失敗回数は消す（IP 側は他の人の失敗も含むので残す）。"""
+    with _failures_lock:
+        _failures.pop(("id", str(person_id)), None)
+
+
+def auth_stats() -> dict:
+    """PIN照合・ログイン制限の状況（このプロセス分）。/api/metrics 用。"""
+    with _stats_lock:
+        stats = dict(_stats)
+    with _failures_lock:
+        stats["tracked_keys"] = len(_failures)
+    stats["hash_workers"] = AUTH_HASH_WORKERS
+    stats["hash_queue_max"] = AUTH_HASH_QUEUE_MAX
+    stats["ip_limit_enabled"] = AUTH_TRUSTED_PROXY_HOPS is not None
+    return stats
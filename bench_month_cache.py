@@ -0,0 +1,139 @@
+# bench_month_cache.py
+"""
+月キャッシュの行操作のマイクロベンチマーク。
+従来の「行のリストを id で全件走査 → コピー → WorkDay で再ソート」と、
+MonthSnapshot（id 索引 + 二分探索で挿入/削除）の1件あたりの処理時間を月の行数ごとに比べる。
+変更だけの時間と、実際の書き込みと同じく変更後の値をキャッシュに保存する（cache_set）までの時間を出す。
+speedup は後者（保存まで含めた書き込み1回）の比。
+計測の前に、MonthSnapshot の変更結果（行・作業日順・集計）が従来の実装と一致することを確かめる。
+
+    python bench_month_cache.py                 # 結果を表示
+    python bench_month_cache.py bench_output.txt  # ファイルにも書き出す
+"""
+import sys
+import random
+import timeit
+
+from airtable_cache import MonthSnapshot, MemoryCacheBackend, cache_set, set_cache_backend
+
+SIZES = (100, 1000, 5000, 20000)
+REPEAT = 5
+TTL_SEC = 3600
+
+
+def make_rows(n: int, year: int = 2026, month: int = 1) -> list:
+    rnd = random.Random(n)
+    rows = [{
+        "id": f"rec{i:014d}",
+        "WorkDay": f"{year:04d}-{month:02d}-{rnd.randint(1, 28):02d}",
+        "WorkCD": str(rnd.randint(100, 99999)),
+        "WorkName": f"品名{i}",
+        "WorkProcess": rnd.choice(["製本", "分給", "検品"]),
+        "UnitPrice": rnd.choice(["1.5", "2", "不明"]),
+        "WorkOutput": str(rnd.randint(0, 500)),
+    } for i in range(n)]
+    rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
+    return rows
+
+
+# --- 従来の実装（リスト走査 + 再ソート）---
+def list_add(rows, row):
+    new_rows = [r for r in rows if str(r.get("id")) != str(row.get("id"))]
+    new_rows.append(row)
+    new_rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
+    return new_rows
+
+def list_remove(rows, record_id):
+    new_rows = [r for r in rows if str(r.get("id")) != str(record_id)]
+    new_rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
+    return new_rows
+
+def list_update(rows, record_id, fields):
+    new_rows = []
+    for r in rows:
+        if str(r.get("id")) == str(record_id):
+            rr = dict(r)
+            rr.update(fields)
+            new_rows.append(rr)
+        else:
+            new_rows.append(r)
+    new_rows.sort(key=lambda x: x.get("WorkDay", "9999-12-31"))
+    return new_rows
+
+
+def check(n: int = 200):
+    """
+    with_changes の結果が従来の実装と同じ行・集計で、WorkDay 順に並んでいるか確かめる（一致しなければ AssertionError）。
+    同じ作業日の中の順序は比べない（作業日を変えた行は移動先の日の末尾に入る）。
+    """
+    rows = make_rows(n)
+    snapshot = MonthSnapshot(rows)
+    target = rows[n // 2]["id"]
+    new_row = {"id": "recNEW", "WorkDay": "2026-01-15", "WorkProcess": "製本", "UnitPrice": "2", "WorkOutput": "3"}
+    fields = {"WorkDay": "2026-01-20", "WorkOutput": "7"}
+
+    def ids(seq) -> list:
+        return sorted((r["WorkDay"], str(r["id"])) for r in seq)
+
+    for expected, changed in (
+        (list_add(rows, new_row), snapshot.with_changes([new_row])),
+        (list_remove(rows, target), snapshot.with_changes(remove_ids=[target])),
+        (list_update(rows, target, fields), snapshot.with_changes([dict(snapshot.find(target), **fields)])),
+        # upserts と remove_ids に同じ id がある場合は削除が優先（既存の行・新しい行のどちらでも）
+        (list_remove(rows, target),
+         snapshot.with_changes([dict(snapshot.find(target), **fields)], remove_ids=[target])),
+        (rows, snapshot.with_changes([new_row], remove_ids=["recNEW"])),
+    ):
+        assert ids(changed) == ids(expected), "行が従来の実装と一致しません"
+        assert list(changed.keys) == [r["WorkDay"] for r in changed.rows] == sorted(changed.keys), \
+            "行が WorkDay 順に並んでいません"
+        assert set(changed.index) == {str(r["id"]) for r in expected}, "id 索引が行と一致しません"
+        assert changed.check_aggregates(), "差分更新した集計が全件再計算と一致しません"
+
+
+def bench(n: int) -> dict:
+    rows = make_rows(n)
+    snapshot = MonthSnapshot(rows)
+    target = rows[n // 2]["id"]
+    new_row = {"id": "recNEW", "WorkDay": "2026-01-15", "WorkProcess": "製本", "UnitPrice": "2", "WorkOutput": "3"}
+    fields = {"WorkDay": "2026-01-20", "WorkOutput": "7"}
+    loops = max(3, 20000 // n)
+
+    set_cache_backend(MemoryCacheBackend())
+    cases = {
+        "add": (lambda: list_add(rows, new_row), lambda: snapshot.with_changes([new_row])),
+        "remove": (lambda: list_remove(rows, target), lambda: snapshot.with_changes(remove_ids=[target])),
+        "update": (lambda: list_update(rows, target, fields),
+                   lambda: snapshot.with_changes([dict(snapshot.find(target), **fields)])),
+    }
+
+    def timed(fn) -> float:
+        return min(timeit.repeat(fn, number=loops, repeat=REPEAT)) / loops * 1e6
+
+    result = {}
+    for name, (old, new) in cases.items():
+        # 変更のみ / 変更 + 保存（上限管理のサイズ見積もりを含む cache_set）。実際の書き込みは後者
+        result[name] = (
+            timed(old), timed(new),
+            timed(lambda: cache_set("list", old(), TTL_SEC)), timed(lambda: cache_set("snapshot", new(), TTL_SEC)),
+        )
+    return result
+
+
+def main():
+    check()
+    lines = [f"{'rows':>7} {'op':<7} {'list(us)':>10} {'snapshot(us)':>13} "
+             f"{'list+set(us)':>13} {'snapshot+set(us)':>17} {'speedup':>8}"]
+    for n in SIZES:
+        for name, (old_us, new_us, old_set_us, new_set_us) in bench(n).items():
+            lines.append(f"{n:>7} {name:<7} {old_us:>10.1f} {new_us:>13.1f} "
+                         f"{old_set_us:>13.1f} {new_set_us:>17.1f} {old_set_us / new_set_us:>7.1f}x")
+    text = "\n".join(lines)
+    print(text)
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# blueprints/admin.py
+from flask import (
+    Blueprint, render_template, request, flash, redirect, url_for, session, current_app,
+    Response, stream_with_context
+)
+from functools import wraps
+from datetime import date
+import os
+import json
+
+from data_services import get_cached_personid_data
+from airtable_service import iter_month_snapshots_for_persons
+from .auth import login_required
+
+admin_bp = Blueprint(
+    'admin_bp', __name__,
+    url_prefix='/admin',
+    template_folder='../templates'
+)
+
+# 管理画面を使える PersonID（カンマ区切り）。未設定なら誰も使えない
+ADMIN_PERSON_IDS = {
+    pid.strip() for pid in os.environ.get("ADMIN_PERSON_IDS", "").split(",") if pid.strip()
+}
+
+
+def is_admin(person_id=None) -> bool:
+    if person_id is None:
+        person_id = session.get('logged_in_personid')
+    return person_id is not None and str(person_id) in ADMIN_PERSON_IDS
+
+
+def admin_required(f):
+    """
+    管理者（ADMIN_PERSON_IDS に含まれる PersonID）のみが使えるルートに適用するデコレータ。
+    login_required と組み合わせて使う。
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not is_admin():
+            current_app.logger.warning(f"管理画面へのアクセスを拒否: PersonID={session.get('logged_in_personid')}")
+            flash("このページを表示する権限がありません。", "error")
+            return redirect(url_for('ui_bp.index'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@admin_bp.app_context_processor
+def inject_is_admin():
+    # 一覧画面などで管理画面へのリンクを出すかどうか
+    return {"is_admin": is_admin()}
+
+
+def _resolve_month(year, month):
+    if year is None or month is None:
+        today = date.today()
+        return today.year, today.month
+    date(year, month, 1)  # 無効な年月は ValueError
+    return year, month
+
+
+@admin_bp.route("/")
+@admin_bp.route("/month/<int:year>/<int:month>")
+@login_required
+@admin_required
+def month_overview(year=None, month=None):
+    """全員分の指定月の集計。表は先に出し、各人の結果は stream から届いた順に埋める。"""
+    try:
+        year, month = _resolve_month(year, month)
+    except ValueError:
+        flash("⚠ 無効な年月が指定されました。今月を表示します。", "warning")
+        return redirect(url_for('.month_overview'))
+
+    personid_dict, personid_list = get_cached_personid_data()
+    persons = [(pid, personid_dict.get(pid, {}).get('name', "不明")) for pid in personid_list]
+    prev_date = date(year - 1, 12, 1) if month == 1 else date(year, month - 1, 1)
+    next_date = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return render_template(
+        "admin_month.html",
+        persons=persons,
+        year=year, month=month,
+        display_month=f"{year}年{month}月",
+        prev_year=prev_date.year, prev_month=prev_date.month,
+        next_year=next_date.year, next_month=next_date.month,
+        refresh=(request.args.get("refresh") == "1")
+    )
+
+
+@admin_bp.route("/month/<int:year>/<int:month>/stream")
+@login_required
+@admin_required
+def month_overview_stream(year, month):
+    """全員分の指定月の集計を、取得できた人から1行ずつ NDJSON で返す。"""
+    try:
+        year, month = _resolve_month(year, month)
+    except ValueError:
+        return Response(json.dumps({"error": "無効な年月です"}, ensure_ascii=False), status=400,
+                        mimetype="application/json")
+
+    personid_dict, personid_list = get_cached_personid_data()
+    force_refresh = (request.args.get("refresh") == "1")
+    admin_pid = session.get('logged_in_personid')
+    current_app.logger.info(f"管理画面: {year}-{month:02d} 全{len(personid_list)}人分を取得 (PersonID={admin_pid})")
+
+    def generate():
+        done = 0
+        for person_id, snapshot in iter_month_snapshots_for_persons(personid_list, year, month, force_refresh):
+            done += 1
+            item = {
+                "personid": person_id,
+                "name": personid_dict.get(int(person_id), {}).get('name', "不明"),
+                "ok": snapshot is not None,
+            }
+            if snapshot is not None:
+                item.update(snapshot.aggregates.as_dict())
+                item["records"] = len(snapshot)
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+        yield json.dumps({"done": True, "count": done}) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}  # プロキシにため込ませない
+    )
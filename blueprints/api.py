@@ -1,14 +1,25 @@
-from flask import Blueprint, jsonify, request, current_app # current_app をインポート
+import os
+import hmac
+from flask import Blueprint, jsonify, request, current_app, session, Response # current_app をインポート
 # data_services.py から必要な関数をインポート
 # `your_flask_app` は実際のプロジェクトルートフォルダ名に置き換えてください
 # もし `blueprints` フォルダが `data_services.py` と同じ階層の `your_flask_app` 内にある場合
-from data_services import get_cached_workcord_data, get_cached_workprocess_data
+from data_services import (
+    get_cached_workprocess_data, search_workcord_prefix, reference_data_status, reference_bundle,
+    WORKCORD_SEARCH_LIMIT
+)
+from airtable_cache import cache_stats
+from airtable_service import get_year_summary
+from airtable_client import airtable_client_stats
+from write_behind import write_behind_stats
+from airtable_mirror import mirror_stats
+from auth_service import auth_stats
+from .admin import is_admin
 
 api_bp = Blueprint('api_bp', __name__, url_prefix='/api')
 
 @api_bp.route("/get_worknames", methods=["GET"])
 def get_worknames():
-    data = get_cached_workcord_data()
     workcd = request.args.get("workcd", "").strip()
     results = []
 
@@ -22,26 +33,13 @@ def get_worknames():
         current_app.logger.warning(f"/api/get_worknames - 無効なWorkCDが指定されました: {workcd}")
         return jsonify({"worknames": [], "error": "WorkCDは数値で入力してください"})
 
-    # 部分一致検索ロジック
+    # 返却件数の上限（?limit= で指定可、未指定/不正値は既定値）
+    limit = request.args.get("limit", type=int) or WORKCORD_SEARCH_LIMIT
+    limit = max(1, min(limit, WORKCORD_SEARCH_LIMIT))
+
+    # 前方一致検索（完全一致優先・コード順）。ソート済みインデックスを使うので全件走査しない
     if len(workcd) >= 3:
-        # 完全一致を優先
-        if workcd in data:
-            for item in data[workcd]:
-                results.append({
-                    "code": workcd,
-                    "workname": item["workname"],
-                    "bookname": item["bookname"]
-                })
-        
-        # 部分一致検索（前方一致）
-        for key in data.keys():
-            if key.startswith(workcd) and key != workcd: # 完全一致の結果と重複しないように
-                for item in data[key]:
-                    results.append({
-                        "code": key,
-                        "workname": item["workname"],
-                        "bookname": item["bookname"]
-                    })
+        results = search_workcord_prefix(workcd, limit=limit)
     
     current_app.logger.info(f"/api/get_worknames - WorkCD: {workcd}, Results: {len(results)}件")
     return jsonify({"worknames": results, "error": ""})
@@ -62,4 +60,79 @@ def get_unitprice():
     
     unitprice = up_dict[workprocess]
     current_app.logger.info(f"/api/get_unitprice - WorkProcess: {workprocess}, UnitPrice: {unitprice}")
-    return jsonify({"unitprice": unitprice})
\ No newline at end of file
+    return jsonify({"unitprice": unitprice})
+
+
+# 版付き URL（?v=<version>）は内容が変わらないので、ブラウザに長期間キャッシュさせる
+REFERENCE_MAX_AGE_SEC = int(os.environ.get("REFERENCE_MAX_AGE_SEC", str(365 * 24 * 3600)))
+
+@api_bp.route("/reference", methods=["GET"])
+def reference():
+    """
+    入力画面用の参照データ一式（品番索引・工程・単価）。ETag は内容のハッシュ（版）。
+    ?v= が現在の版と一致すれば immutable で長期キャッシュ、それ以外は毎回 If-None-Match で確認させる。
+    """
+    version, json_bytes, gzip_bytes = reference_bundle()
+    use_gzip = request.accept_encodings["gzip"] > 0
+    etag = f"{version}-gzip" if use_gzip else version  # 表現（圧縮の有無）ごとに別の強い ETag
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(gzip_bytes if use_gzip else json_bytes, mimetype="application/json")
+        if use_gzip:
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    if request.args.get("v") == version:
+        response.headers["Cache-Control"] = f"private, max-age={REFERENCE_MAX_AGE_SEC}, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@api_bp.route("/records/summary/<int:year>", methods=["GET"])
+def records_summary(year):
+    """ログイン中のユーザーの1年分の月ごとの集計（?refresh=1 で Airtable から取り直す）。"""
+    person_id = session.get('logged_in_personid')
+    if not person_id:
+        return jsonify({"error": "ログインが必要です"}), 401
+    if not 2000 <= year <= 9999:
+        return jsonify({"error": "無効な年です"}), 400
+    summary = get_year_summary(str(person_id), year, force_refresh=(request.args.get("refresh") == "1"))
+    current_app.logger.info(f"/api/records/summary - PersonID: {person_id}, Year: {year}, complete={summary['complete']}")
+    return jsonify(summary)
+
+
+# 監視ツールから /api/metrics を読むためのトークン（Authorization: Bearer <token>）。未設定ならトークンでは読めない
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+
+def _metrics_allowed() -> bool:
+    """管理者としてログイン中、または METRICS_TOKEN と一致するトークン付きのリクエストなら True。"""
+    if is_admin():
+        return True
+    auth = request.headers.get("Authorization", "")
+    if METRICS_TOKEN and auth.startswith("Bearer "):
+        return hmac.compare_digest(auth[len("Bearer "):].strip().encode(), METRICS_TOKEN.encode())
+    return False
+
+
+@api_bp.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    キャッシュ等の稼働状況（このワーカープロセス分）を返す。サイズ調整・監視用。
+    ファイルの場所やログイン制限の状況を含むので、管理者か METRICS_TOKEN を持つ監視ツールのみ。
+    """
+    if not _metrics_allowed():
+        current_app.logger.warning(f"/api/metrics - 権限のないアクセスを拒否しました: {request.remote_addr}")
+        return jsonify({"error": "権限がありません"}), 403
+    return jsonify({
+        "pid": os.getpid(),
+        "airtable_cache": cache_stats(),
+        "airtable_client": airtable_client_stats(),
+        "write_behind": write_behind_stats(),
+        "airtable_mirror": mirror_stats(),
+        "auth": auth_stats(),
+        "reference_data": reference_data_status()
+    })
@@ -3,7 +3,10 @@ from flask import (
     Blueprint, render_template, request, flash, redirect, url_for, session, current_app
 )
 from functools import wraps
-from werkzeug.security import check_password_hash # PINのハッシュ比較に使用
+# PINのハッシュ比較は auth_service のプロセスプールで行う（リクエストスレッドを重い計算で塞がない）
+from auth_service import (
+    verify_pin, client_ip, check_login_allowed, record_login_failure, record_login_success
+)
 
 # data_services.py から PersonID とPINハッシュ情報を取得する関数をインポート
 from data_services import get_cached_personid_data
@@ -45,12 +48,25 @@ def login():
             flash("無効なPersonID形式です。", "error")
             return redirect(url_for('.login'))
 
+        # 失敗が続いている PersonID / IP はハッシュを計算する前に断る
+        ip = client_ip(request.remote_addr, request.headers.get("X-Forwarded-For"))
+        allowed, retry_after = check_login_allowed(person_id, ip)
+        if not allowed:
+            current_app.logger.warning(f"ログイン試行を制限中: PersonID={person_id}, IP={ip or request.remote_addr}, retry_after={retry_after}s")
+            flash(f"ログインの失敗が続いたため、一時的にログインできません。{(retry_after + 59) // 60}分ほど待ってから再度お試しください。", "error")
+            return redirect(url_for('.login', next=next_url))
+
         person_data_dict, _ = get_cached_personid_data() # PERSON_ID_DICT を取得
         user_account_info = person_data_dict.get(person_id)
 
         if user_account_info and user_account_info.get('pin_hash'):
-            # PINハッシュを比較
-            if check_password_hash(user_account_info['pin_hash'], pin_entered):
+            # PINハッシュを比較（混雑中は None）
+            pin_ok = verify_pin(user_account_info['pin_hash'], pin_entered)
+            if pin_ok is None:
+                flash("ただいまログインが混み合っています。少し待ってから再度お試しください。", "warning")
+                return redirect(url_for('.login', next=next_url))
+            if pin_ok:
+                record_login_success(person_id, ip)
                 session['logged_in_personid'] = person_id
                 session['logged_in_personname'] = user_account_info['name']
                 session.permanent = True # セッションを持続させる場合（設定による）
@@ -64,9 +80,11 @@ def login():
                      return redirect(next_url)
                 return redirect(url_for('ui_bp.index')) # デフォルトはメインページへ
             else:
-                current_app.logger.warning(f"PIN不一致: PersonID={person_id}")
+                record_login_failure(person_id, ip)
+                current_app.logger.warning(f"PIN不一致: PersonID={person_id}, IP={ip or request.remote_addr}")
                 flash("PersonIDまたはPINが間違っています。", "error")
         else:
+            record_login_failure(person_id, ip)
             current_app.logger.warning(f"アカウント情報またはPINハッシュが見つかりません: PersonID={person_id}")
             flash("PersonIDまたはPINが間違っています。", "error")
         
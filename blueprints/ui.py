@@ -4,19 +4,34 @@ from flask import (
     Blueprint, render_template, request, flash, redirect, url_for, session, current_app
 )
 from datetime import datetime, date, timedelta
+import os
 import json
 
 # サービスモジュールから必要な関数をインポート
-from data_services import get_cached_personid_data, get_cached_workprocess_data # forms.pyは使わないので削除
+from data_services import get_cached_personid_data, get_cached_workprocess_data, reference_bundle # forms.pyは使わないので削除
 
 # ★★★ airtable_serviceからのインポートを再確認 ★★★
 from airtable_service import (
+    build_record_fields,
     create_airtable_record,
-    get_airtable_records_for_month,  # ← この行が重要です！
+    create_airtable_records_batch,
+    get_airtable_records_for_month,
+    iter_airtable_records_for_month,  # ← 一覧はページ単位で受け取る
+    prefetch_months,
     delete_airtable_record,
-    get_airtable_record_details,
-    update_airtable_record_fields
+    get_record_details_cached,
+    get_year_summary,
+    update_airtable_record_fields,
+    update_airtable_records_batch,
+    delete_airtable_records_batch,
+    month_of_row,
+    MonthFetchError,
+    MonthTruncatedError,
+    MONTH_MAX_PAGES,
+    MONTH_CACHE_RETAIN_SEC
 )
+from airtable_cache import MonthSnapshot, month_cache_apply
+from write_behind import WRITE_BEHIND_ENABLED, PENDING_ID_PREFIX, enqueue_record, retry_failed, dismiss_failed
 from .auth import login_required # auth.py が同じ blueprints フォルダにあると仮定
 
 # UI用 Blueprint を作成 (変更なし)
@@ -26,6 +41,42 @@ ui_bp = Blueprint(
     static_folder='../static'
 )
 
+# 複数行入力フォームの行数
+BULK_ENTRY_ROWS = int(os.environ.get("BULK_ENTRY_ROWS", "10"))
+
+
+def _validate_entry(workcd, workoutput, workprocess, workday, selected_option, bookname_from_hidden):
+    """入力1件分の検証。(エラーメッセージのリスト, workname, bookname, workoutput_val) を返す。"""
+    errors = []
+    workname, bookname = "", ""
+    workoutput_val = 0
+    if workcd and not workcd.isdigit():
+        errors.append("⚠ WorkCD は数値で入力してください！")
+    try:
+        workoutput_val = int(workoutput)
+    except ValueError:
+        errors.append("⚠ 数量は数値を入力してください！"); workoutput_val = 0
+    if not workprocess or not workday:
+        errors.append("⚠ 行程と作業日は入力してください！")
+    else:
+        try: datetime.strptime(workday, "%Y-%m-%d")
+        except ValueError: errors.append("⚠ 作業日はYYYY-MM-DDの形式で入力してください！")
+    if not selected_option and workcd:
+        errors.append("⚠ WorkCDを入力した場合は品名も選択してください！")
+    elif selected_option:
+        workname = selected_option
+        bookname = bookname_from_hidden
+    return errors, workname, bookname, workoutput_val
+
+
+def _reference_version():
+    try:
+        return reference_bundle()[0]
+    except Exception as e:
+        current_app.logger.warning(f"参照データの版を取得できません（品番検索はサーバーで行います）: {e}")
+        return None
+
+
 # -------------------------------
 # Flask のルート (入力フォーム) - "/"
 @ui_bp.route("/", methods=["GET", "POST"])
@@ -48,7 +99,9 @@ def index():
         "workprocess_selected": "",
         "selected_workname_option": "",
         "bookname_hidden": "",
-        "unitprice": "" 
+        "unitprice": "",
+        # 品番検索をブラウザ内で行うための参照データの版（/api/reference?v=... を長期キャッシュさせる）
+        "reference_version": _reference_version()
     }
 
     if request.method == "POST":
@@ -65,27 +118,13 @@ def index():
             "bookname_hidden": bookname_from_hidden
         })
 
-        workname, bookname = "", ""
-        workoutput_val = 0
-        error_occurred = False
+        errors, workname, bookname, workoutput_val = _validate_entry(
+            workcd, workoutput, workprocess, workday, selected_option, bookname_from_hidden
+        )
+        for message in errors:
+            flash(message, "error")
+        error_occurred = bool(errors)
 
-        if workcd and not workcd.isdigit():
-            flash("⚠ WorkCD は数値で入力してください！", "error"); error_occurred = True
-        try:
-            workoutput_val = int(workoutput)
-        except ValueError:
-            flash("⚠ 数量は数値を入力してください！", "error"); error_occurred = True; workoutput_val = 0
-        if not workprocess or not workday:
-            flash("⚠ 行程と作業日は入力してください！", "error"); error_occurred = True
-        else:
-            try: datetime.strptime(workday, "%Y-%m-%d")
-            except ValueError: flash("⚠ 作業日はYYYY-MM-DDの形式で入力してください！", "error"); error_occurred = True
-        if not selected_option and workcd:  
-            flash("⚠ WorkCDを入力した場合は品名も選択してください！", "error"); error_occurred = True
-        elif selected_option:
-            workname = selected_option
-            bookname = bookname_from_hidden
-        
         if error_occurred:
             current_app.logger.warning(f"UI index POST - 入力エラー: LoggedInPersonID={logged_in_pid}, WorkCD={workcd}")
             # unitprice_data_for_js も渡す
@@ -93,10 +132,22 @@ def index():
 
         unitprice = unitprice_dict_data.get(workprocess, 0.0)
 
-        current_app.logger.info(f"UI index POST - Airtable送信準備: LoggedInPersonID={logged_in_pid}, WorkCD={workcd or 'N/A'}")
-        status_code, response_text, new_record_id = create_airtable_record(
-            str(logged_in_pid), workcd, workname, bookname, workoutput_val, workprocess, unitprice, workday
-        )
+        # ✅ write-behind 有効時はジャーナルに記録した時点で完了（Airtable へは裏で送信）
+        status_code, response_text, new_record_id = None, None, None
+        if WRITE_BEHIND_ENABLED:
+            try:
+                fields = build_record_fields(workcd, workname, bookname, workoutput_val, workprocess, unitprice,
+                                             workday, person_id=str(logged_in_pid))
+                new_record_id = enqueue_record(str(logged_in_pid), fields)
+                status_code, response_text = 201, "✅ 受け付けました（Airtable へは自動で送信されます）"
+            except Exception as e:
+                current_app.logger.error(f"write-behind の記録に失敗、直接送信します: {e}", exc_info=True)
+
+        if new_record_id is None:
+            current_app.logger.info(f"UI index POST - Airtable送信準備: LoggedInPersonID={logged_in_pid}, WorkCD={workcd or 'N/A'}")
+            status_code, response_text, new_record_id = create_airtable_record(
+                str(logged_in_pid), workcd, workname, bookname, workoutput_val, workprocess, unitprice, workday
+            )
 
         flash(response_text, "success" if status_code in (200, 201) and new_record_id else "error")
         session['selected_personid'] = str(logged_in_pid) 
@@ -118,6 +169,89 @@ def index():
     return render_template("index.html", **template_context)
 
 
+# -------------------------------
+# 複数行まとめて入力 - "/bulk_entry"（Airtable へは10件ずつまとめて送信）
+@ui_bp.route("/bulk_entry", methods=["GET", "POST"])
+@login_required
+def bulk_entry():
+    logged_in_pid = session.get('logged_in_personid')
+    logged_in_pname = session.get('logged_in_personname', '不明なユーザー')
+    workprocess_list_data, unitprice_dict_data = get_cached_workprocess_data()
+    default_workday = session.get('workday', (date.today() - timedelta(days=30)).strftime("%Y-%m-%d"))
+
+    rows = [
+        {"workcd": "", "workname": "", "bookname_hidden": "", "workprocess": "", "workoutput": "", "workday": default_workday}
+        for _ in range(BULK_ENTRY_ROWS)
+    ]
+    template_context = {
+        "logged_in_personid": logged_in_pid,
+        "logged_in_personname": logged_in_pname,
+        "workprocess_list": workprocess_list_data,
+        "rows": rows,
+    }
+
+    if request.method == "GET":
+        return render_template("bulk_entry.html", **template_context)
+
+    rows = [
+        {name: request.form.get(f"{name}_{i}", "").strip() for name in rows[0]}
+        for i in range(BULK_ENTRY_ROWS)
+    ]
+    template_context["rows"] = rows
+
+    fields_list = []
+    error_occurred = False
+    for row_no, row in enumerate(rows, start=1):
+        if not (row["workcd"] or row["workoutput"] or row["workprocess"]):
+            continue  # 未入力の行は無視
+        errors, workname, bookname, workoutput_val = _validate_entry(
+            row["workcd"], row["workoutput"] or "0", row["workprocess"], row["workday"],
+            row["workname"], row["bookname_hidden"]
+        )
+        for message in errors:
+            flash(f"{row_no}行目: {message}", "error")
+        if errors:
+            error_occurred = True
+            continue
+        unitprice = unitprice_dict_data.get(row["workprocess"], 0.0)
+        fields_list.append(build_record_fields(
+            row["workcd"], workname, bookname, workoutput_val, row["workprocess"], unitprice, row["workday"],
+            person_id=str(logged_in_pid)
+        ))
+
+    if not error_occurred and not fields_list:
+        flash("⚠ 入力された行がありません。", "error")
+    if error_occurred or not fields_list:
+        current_app.logger.warning(f"UI bulk_entry POST - 入力エラー: LoggedInPersonID={logged_in_pid}")
+        return render_template("bulk_entry.html", **template_context)
+
+    # ✅ write-behind 有効時はジャーナルへ。記録できなかった分はまとめて直接送信する
+    queued = 0
+    if WRITE_BEHIND_ENABLED:
+        try:
+            for fields in fields_list:
+                enqueue_record(str(logged_in_pid), fields)
+                queued += 1
+        except Exception as e:
+            current_app.logger.error(f"write-behind の記録に失敗、直接送信します: {e}", exc_info=True)
+
+    success, created_count = True, queued
+    if queued:
+        flash(f"✅ {queued}件を受け付けました（Airtable へは自動で送信されます）", "success")
+    if queued < len(fields_list):
+        success, response_text, created_rows = create_airtable_records_batch(str(logged_in_pid), fields_list[queued:])
+        created_count += len(created_rows)
+        flash(response_text, "success" if success else "error")
+
+    session['selected_personid'] = str(logged_in_pid)
+    session['workday'] = fields_list[0]["WorkDay"]
+    if not success and created_count == 0:
+        return render_template("bulk_entry.html", **template_context)
+    # 一部でも登録できた場合は一覧へ（再送信で二重登録しないよう入力画面には戻さない）
+    first_year, first_month = month_of_row(fields_list[0])
+    return redirect(url_for(".records", year=first_year, month=first_month))
+
+
 # ----------------------------------------------------------------------------------
 # 以下、records, edit_record, delete_record ルートは変更なし (前回のUI Blueprint化時点のまま)
 # ----------------------------------------------------------------------------------
@@ -178,38 +312,48 @@ def records(year=None, month=None):
     
    
     force_refresh = (request.args.get("refresh") == "1")
-    records_data = get_airtable_records_for_month(person_id_to_use, year, month, force_refresh=force_refresh)
-
-    
-    if records_data is None: records_data = []
 
-    total_amount = 0
-    for record_item in records_data:
-        try:
-            unit_price_str = str(record_item.get("UnitPrice", "0")).strip()
-            unit_price = float(unit_price_str) if unit_price_str and unit_price_str != "不明" else 0.0
-            work_output_str = str(record_item.get("WorkOutput", "0")).strip()
-            work_output = int(work_output_str) if work_output_str else 0
-            record_item["subtotal"] = unit_price * work_output
-        except ValueError: record_item["subtotal"] = 0
-        total_amount += record_item["subtotal"]
-
-    unique_workdays = set(r["WorkDay"] for r in records_data if r.get("WorkDay") != "9999-12-31")
-    workdays_count = len(unique_workdays)
-    
-    workoutput_total = 0
-    for r_item in records_data:
-        if "分給" in r_item.get("WorkProcess", ""):
-            work_output_value = str(r_item.get("WorkOutput", "0")).strip()
-            if work_output_value and work_output_value.replace('.', '', 1).isdigit():
-                try: workoutput_total += float(work_output_value)
-                except ValueError: pass # ログは既に出力されていると仮定
+    # キャッシュ済みの月は集計も一緒に保存されているので、そのまま使う（行を走査しない）
+    records_data = []
+    snapshot = None
+    try:
+        for page in iter_airtable_records_for_month(person_id_to_use, year, month, force_refresh=force_refresh,
+                                                    use_mirror=not force_refresh):
+            if isinstance(page, MonthSnapshot):
+                snapshot = page
+            records_data.extend(page)
+    except MonthTruncatedError as e:
+        # 打ち切られた月はキャッシュされない。表示はするが、一部であることを必ず知らせる
+        current_app.logger.warning(f"UI records - {e}")
+        flash(f"⚠ この月は記録が多いため、先頭の {MONTH_MAX_PAGES * 100:,}件のみ表示しています。"
+              f"合計金額・稼働日数は表示している分だけの集計です。", "warning")
+    except MonthFetchError as e:
+        # 途中のページで失敗した月もキャッシュされない。途中までの一覧と合計であることを知らせる
+        current_app.logger.warning(f"UI records - {e}")
+        flash(f"⚠ Airtable からの取得が途中で失敗したため、この月の記録は {len(records_data):,}件のみ表示しています。"
+              f"合計金額・稼働日数は表示している分だけの集計です。再読み込みしてください。", "warning")
+    if snapshot is None:
+        # Airtable からページ単位で取得した場合（小計もここで付く）。送信待ちの行は最後のページで届くので、
+        # 表示はページを連結した順ではなくスナップショット（WorkDay 順）の行で行う
+        snapshot = MonthSnapshot(records_data)
+    elif current_app.debug:
+        snapshot.check_aggregates()  # 差分更新した集計を全件再計算と突き合わせる
+
+    total_amount = snapshot.aggregates.total_amount
+    workdays_count = snapshot.aggregates.workdays_count
+    workoutput_total = snapshot.aggregates.workoutput_total
 
     first_day_of_current_month = date(year, month, 1)
     prev_month_date = first_day_of_current_month - timedelta(days=1)
     prev_year, prev_month = prev_month_date.year, prev_month_date.month
     next_month_date = (first_day_of_current_month.replace(day=28) + timedelta(days=4)).replace(day=1)
     next_year, next_month = next_month_date.year, next_month_date.month
+
+    # 前月/次月への移動がキャッシュヒットになるよう裏で先読みしておく
+    try:
+        prefetch_months(person_id_to_use, [(prev_year, prev_month), (next_year, next_month)])
+    except Exception as e:
+        current_app.logger.warning(f"先読みの予約に失敗（無視）: {e}")
     
     new_record_id_from_session = session.pop('new_record_id', None)
     edited_record_id_from_session = session.pop('edited_record_id', None)
@@ -222,7 +366,7 @@ def records(year=None, month=None):
             current_person_name = person_info['name']
     return render_template(
         "records.html",
-        records=records_data,
+        records=snapshot.rows,
         current_person_name_for_display=current_person_name, # ★追加
         personid=person_id_to_use, # ログイン中のユーザーID
         personid_dict=personid_dict_data_for_template,
@@ -237,6 +381,32 @@ def records(year=None, month=None):
         next_year=next_year, next_month=next_month
     )
 
+@ui_bp.route("/records/summary")
+@ui_bp.route("/records/summary/<int:year>")
+@login_required
+def records_summary(year=None):
+    """1年分の月ごとの集計（金額・稼働日数・分給）。キャッシュに無い月だけ並列に取得する。"""
+    logged_in_pid = str(session.get('logged_in_personid'))
+    if year is None:
+        year = session.get('current_display_year') or date.today().year
+    if not 2000 <= year <= date.today().year + 1:
+        flash("⚠ 無効な年が指定されました。今年の集計を表示します。", "warning")
+        return redirect(url_for('.records_summary', year=date.today().year))
+
+    force_refresh = (request.args.get("refresh") == "1")
+    summary = get_year_summary(logged_in_pid, year, force_refresh=force_refresh)
+    if not summary["complete"]:
+        flash("⚠ 一部の月の記録を取得できませんでした。時間をおいて再読み込みしてください。", "warning")
+
+    personid_dict_all, _ = get_cached_personid_data()
+    person_info = personid_dict_all.get(int(logged_in_pid)) or {}
+    return render_template(
+        "records_summary.html",
+        summary=summary,
+        current_person_name_for_display=person_info.get('name', "不明なユーザー"),
+        year=year, prev_year=year - 1, next_year=year + 1
+    )
+
 @ui_bp.route("/delete_record/<record_id>", methods=["POST"])
 @login_required
 def delete_record(record_id):
@@ -256,7 +426,7 @@ def delete_record(record_id):
     if success:
         try:
             from airtable_cache import month_cache_remove_record
-            ok = month_cache_remove_record(logged_in_pid, year, month, record_id)
+            ok = month_cache_remove_record(logged_in_pid, year, month, record_id, ttl_sec=MONTH_CACHE_RETAIN_SEC)
             if ok:
                 current_app.logger.info(f"[CACHE] removed record {record_id} from {year}-{month:02d}")
         except Exception as e:
@@ -265,6 +435,40 @@ def delete_record(record_id):
     return redirect(url_for(".records", year=year, month=month))
 
 
+def _form_year_month():
+    try:
+        return int(request.form.get("year")), int(request.form.get("month"))
+    except (TypeError, ValueError):
+        return (session.get("current_display_year", date.today().year),
+                session.get("current_display_month", date.today().month))
+
+
+@ui_bp.route("/pending_record/<record_id>/retry", methods=["POST"])
+@login_required
+def retry_pending_record(record_id):
+    """送信に失敗した write-behind の行を再送する。"""
+    logged_in_pid = str(session.get("logged_in_personid"))
+    year, month = _form_year_month()
+    if retry_failed(logged_in_pid, record_id):
+        flash("✅ 再送を受け付けました（Airtable へは自動で送信されます）", "success")
+    else:
+        flash("⚠ 再送できる行が見つかりませんでした。", "warning")
+    return redirect(url_for(".records", year=year, month=month))
+
+
+@ui_bp.route("/pending_record/<record_id>/dismiss", methods=["POST"])
+@login_required
+def dismiss_pending_record(record_id):
+    """送信に失敗した write-behind の行を取り消す（一覧から消す）。"""
+    logged_in_pid = str(session.get("logged_in_personid"))
+    year, month = _form_year_month()
+    if dismiss_failed(logged_in_pid, record_id):
+        flash("送信に失敗した入力を取り消しました。", "info")
+    else:
+        flash("⚠ 取り消せる行が見つかりませんでした。", "warning")
+    return redirect(url_for(".records", year=year, month=month))
+
+
 @ui_bp.route("/edit_record/<record_id>", methods=["GET", "POST"])
 @login_required
 def edit_record(record_id):
@@ -286,7 +490,7 @@ def edit_record(record_id):
             new_output_val = int(new_output_str)
         except ValueError:
             flash("❌ 作業量は数値で入力してください。", "error")
-            record_data_for_render, _ = get_airtable_record_details(logged_in_pid, record_id)
+            record_data_for_render, _ = get_record_details_cached(logged_in_pid, record_id, original_year, original_month)
             return render_template(
                 "edit_record.html",
                 record=record_data_for_render,
@@ -310,14 +514,16 @@ def edit_record(record_id):
                 patch_fields = {"WorkDay": new_day, "WorkOutput": new_output_val}
 
                 if (new_y == original_year) and (new_m == original_month):
-                    month_cache_update_record(logged_in_pid, original_year, original_month, record_id, patch_fields)
+                    month_cache_update_record(logged_in_pid, original_year, original_month, record_id, patch_fields,
+                                              ttl_sec=MONTH_CACHE_RETAIN_SEC)
                 else:
                     month_cache_move_record(
                         logged_in_pid,
                         original_year, original_month,
                         new_y, new_m,
                         record_id,
-                        patch_fields
+                        patch_fields,
+                        ttl_sec=MONTH_CACHE_RETAIN_SEC
                     )
                 current_app.logger.info(f"[CACHE] updated/moved record {record_id}")
             except Exception as e:
@@ -327,7 +533,7 @@ def edit_record(record_id):
             return redirect(url_for(".records", year=new_y, month=new_m))  # ← ★これが重要
 
         # 更新失敗時：編集画面に留まる
-        record_data_for_render, _ = get_airtable_record_details(logged_in_pid, record_id)
+        record_data_for_render, _ = get_record_details_cached(logged_in_pid, record_id, original_year, original_month)
         return render_template(
             "edit_record.html",
             record=record_data_for_render,
@@ -337,7 +543,7 @@ def edit_record(record_id):
         )
 
     # --- GET ---
-    record_data, error_message = get_airtable_record_details(logged_in_pid, record_id)
+    record_data, error_message = get_record_details_cached(logged_in_pid, record_id, original_year, original_month)
     if error_message or record_data is None:
         flash(error_message or "❌ レコード取得に失敗しました。", "error")
         return redirect(url_for(".records", year=original_year, month=original_month))
@@ -349,3 +555,114 @@ def edit_record(record_id):
         original_year=original_year,
         original_month=original_month
     )
+
+
+# -------------------------------
+# 一覧で選択したレコードの一括削除・一括編集（Airtable へは10件ずつまとめて送信）
+def _selected_record_ids(values) -> list:
+    # 送信待ち（write-behind）の仮行はまだ Airtable に無いので対象外
+    return [v for v in values if v and not v.startswith(PENDING_ID_PREFIX)]
+
+
+@ui_bp.route("/delete_records", methods=["POST"])
+@login_required
+def delete_records():
+    logged_in_pid = str(session.get("logged_in_personid"))
+    record_ids = _selected_record_ids(request.form.getlist("record_ids"))
+
+    try:
+        year  = int(request.form.get("year"))
+        month = int(request.form.get("month"))
+    except (TypeError, ValueError):
+        year  = session.get("current_display_year", date.today().year)
+        month = session.get("current_display_month", date.today().month)
+
+    if not record_ids:
+        flash("⚠ 削除するレコードを選択してください。", "warning")
+        return redirect(url_for(".records", year=year, month=month))
+
+    success, message, deleted_ids = delete_airtable_records_batch(logged_in_pid, record_ids)
+    flash(message, "success" if success else "error")
+
+    # ✅ 削除できた分をキャッシュの当月からまとめて消す
+    if deleted_ids:
+        try:
+            if month_cache_apply(logged_in_pid, year, month, remove_ids=deleted_ids, ttl_sec=MONTH_CACHE_RETAIN_SEC):
+                current_app.logger.info(f"[CACHE] removed {len(deleted_ids)} records from {year}-{month:02d}")
+        except Exception as e:
+            current_app.logger.warning(f"delete cache update skipped: {e}")
+
+    return redirect(url_for(".records", year=year, month=month))
+
+
+@ui_bp.route("/edit_records", methods=["GET", "POST"])
+@login_required
+def edit_records():
+    logged_in_pid = str(session.get("logged_in_personid"))
+    source = request.form if request.method == "POST" else request.args
+    original_year  = source.get("year", type=int)  or session.get("current_display_year", date.today().year)
+    original_month = source.get("month", type=int) or session.get("current_display_month", date.today().month)
+    record_ids = _selected_record_ids(source.getlist("record_ids"))
+
+    if not record_ids:
+        flash("⚠ 編集するレコードを選択してください。", "warning")
+        return redirect(url_for(".records", year=original_year, month=original_month))
+
+    # 一覧と同じ月データ（通常はキャッシュ）から対象行を取り出す
+    month_rows = {str(r.get("id")): r for r in get_airtable_records_for_month(logged_in_pid, original_year, original_month)}
+    rows = [month_rows[rid] for rid in record_ids if rid in month_rows]
+    if not rows:
+        flash("❌ 選択したレコードが見つかりませんでした。", "error")
+        return redirect(url_for(".records", year=original_year, month=original_month))
+
+    template_context = {"rows": rows, "original_year": original_year, "original_month": original_month}
+    if request.method == "GET":
+        return render_template("edit_records.html", **template_context)
+
+    # --- POST: 変更された行だけをまとめて更新 ---
+    updates = []
+    edited_rows = []
+    error_occurred = False
+    for row in rows:
+        rid = str(row["id"])
+        new_day = request.form.get(f"WorkDay_{rid}", "").strip()
+        new_output_str = request.form.get(f"WorkOutput_{rid}", "").strip()
+        edited_rows.append(dict(row, WorkDay=new_day, WorkOutput=new_output_str))
+        try:
+            datetime.strptime(new_day, "%Y-%m-%d")
+            new_output_val = int(new_output_str)
+        except ValueError:
+            flash(f"❌ {row.get('WorkDay')} {row.get('WorkName')}: 作業日と作業量を正しく入力してください。", "error")
+            error_occurred = True
+            continue
+        if new_day != str(row.get("WorkDay")) or str(new_output_val) != str(row.get("WorkOutput")):
+            updates.append((rid, {"WorkDay": new_day, "WorkOutput": new_output_val}))
+
+    if error_occurred:
+        template_context["rows"] = edited_rows
+        return render_template("edit_records.html", **template_context)
+    if not updates:
+        flash("変更はありませんでした。", "info")
+        return redirect(url_for(".records", year=original_year, month=original_month))
+
+    success, message, updated_rows = update_airtable_records_batch(logged_in_pid, updates)
+    flash(message, "success" if success else "error")
+
+    # ✅ キャッシュ反映：月ごとに1回。月が変わった行は元の月から外して移動先の月へ入れる
+    if updated_rows:
+        try:
+            by_month = {}
+            for updated in updated_rows:
+                by_month.setdefault(month_of_row(updated), []).append(updated)
+            moved_ids = [r["id"] for ym, rs in by_month.items() if ym != (original_year, original_month) for r in rs]
+            month_cache_apply(logged_in_pid, original_year, original_month,
+                              upserts=by_month.pop((original_year, original_month), []), remove_ids=moved_ids,
+                              ttl_sec=MONTH_CACHE_RETAIN_SEC)
+            for (y, m), rs in by_month.items():
+                month_cache_apply(logged_in_pid, y, m, upserts=rs, ttl_sec=MONTH_CACHE_RETAIN_SEC)
+            current_app.logger.info(f"[CACHE] updated/moved {len(updated_rows)} records")
+        except Exception as e:
+            current_app.logger.warning(f"edit cache update skipped: {e}")
+        session["edited_record_id"] = updated_rows[0]["id"]
+
+    return redirect(url_for(".records", year=original_year, month=original_month))
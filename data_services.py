@@ -4,7 +4,17 @@ import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import time
 import os
+import gzip
+import json
+import random
+import hashlib
 import logging
+from bisect import bisect_left
+import gc
+from types import MappingProxyType
+from threading import Event, Lock, Thread
+
+from singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 if not logger.hasHandlers():
@@ -24,158 +34,742 @@ WORKPROCESS_WORKSHEET_NAME = "wsWorkProcess"
 scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 
 # ★★★ Google Sheets API Client Initialization - ADD THIS BLOCK ★★★
+# クライアントは最初に必要になった時点で作る（import 時には認証しない）。
+# gunicorn のプリロードで master が import した後に fork したワーカーは、親の HTTP 接続を共有しないよう自分用に作り直す。
 client = None # Initialize client to None
-try:
-    if os.path.exists(SERVICE_ACCOUNT_FILE):
-        creds = ServiceAccountCredentials.from_json_keyfile_name(SERVICE_ACCOUNT_FILE, scope)
-        client = gspread.authorize(creds)
-        logger.info("Google Sheets client initialized successfully.")
-    else:
-        logger.critical(f"サービスアカウントファイルが見つかりません: {SERVICE_ACCOUNT_FILE}")
-        # client remains None, functions using it will log errors and return early
-except Exception as e:
-    logger.critical(f"Google Sheets クライアントの初期化に失敗しました: {e}", exc_info=True)
-    # client remains None
+_client_pid = None
+_client_lock = Lock()
+
+def _get_client():
+    global client, _client_pid
+    pid = os.getpid()
+    if _client_pid == pid:
+        return client
+    with _client_lock:
+        if _client_pid == pid:
+            return client
+        client = None
+        try:
+            if os.path.exists(SERVICE_ACCOUNT_FILE):
+                creds = ServiceAccountCredentials.from_json_keyfile_name(SERVICE_ACCOUNT_FILE, scope)
+                client = gspread.authorize(creds)
+                logger.info(f"Google Sheets client initialized successfully. (pid={pid})")
+            else:
+                logger.critical(f"サービスアカウントファイルが見つかりません: {SERVICE_ACCOUNT_FILE}")
+                # client remains None, functions using it will log errors and return early
+        except Exception as e:
+            logger.critical(f"Google Sheets クライアントの初期化に失敗しました: {e}", exc_info=True)
+            # client remains None
+        _client_pid = pid
+        return client
 # ★★★ END OF CLIENT INITIALIZATION BLOCK ★★★
 
 
 CACHE_TTL = 300  # 300秒 (5分間)
 
+# 再ロードは種類ごとに同時に1回だけ実行し、同時に期限切れを検知した他のリクエストはその完了を待つ
+_reload_flight = SingleFlight()
+
+# 開いたスプレッドシートのハンドル（client.open は名前検索の API 呼び出しを伴うので使い回す）
+_spreadsheet = None
+_spreadsheet_pid = None
+_spreadsheet_lock = Lock()
+
+def _get_spreadsheet():
+    global _spreadsheet, _spreadsheet_pid
+    with _spreadsheet_lock:
+        if _spreadsheet is None or _spreadsheet_pid != os.getpid():
+            _spreadsheet = _get_client().open(SPREADSHEET_NAME)
+            _spreadsheet_pid = os.getpid()
+        return _spreadsheet
+
+def _reset_spreadsheet():
+    """取得に失敗したときに呼ぶ。次回はスプレッドシートを開き直す。"""
+    global _spreadsheet
+    with _spreadsheet_lock:
+        _spreadsheet = None
+
+def _values_to_records(values):
+    """1行目を見出しとして行データを dict のリストにする（worksheet.get_all_records と同じ数値変換）。"""
+    if not values:
+        return []
+    values = gspread.utils.fill_gaps(values)
+    headers, rows = values[0], values[1:]
+    return gspread.utils.to_records(headers, [gspread.utils.numericise_all(row) for row in rows])
+
 # ===== PersonID データ =====
 PERSON_ID_DICT = {}
 # ... (rest of your data_services.py code, like load_personid_data, etc.) ...
 # The load_* functions will now correctly find the 'client' variable defined above.
 
 # ===== PersonID データ =====
-PERSON_ID_DICT = {} # 構造変更: { pid: {"name": "pname", "pin_hash": "hash_value"}, ... }
-PERSON_ID_LIST = [] # これはPIDの数値リストのままでOK
+PERSON_ID_DICT = MappingProxyType({}) # 構造変更: { pid: {"name": "pname", "pin_hash": "hash_value"}, ... }
+PERSON_ID_LIST = () # これはPIDの数値リストのままでOK
 last_personid_load_time = 0
 
-def load_personid_data():
+def _build_personid_data(records):
+    """wsPersonID の行データから (PERSON_ID_DICT, PERSON_ID_LIST) を組み立てる。"""
+    temp_dict = {}
+    temp_id_list = [] # PersonIDの数値リストもここで再構築
+    for row in records:
+        pid_str = str(row.get("PersonID", "")).strip()
+        pname = str(row.get("PersonName", "")).strip()
+        pin_hash = str(row.get("PINHash", "")).strip() # ★★★ PINHash列を読み込む ★★★
+
+        if pid_str and pname: # PINHashは空でも許容するかもしれないが、ログイン機能には必須
+            try:
+                pid_int = int(pid_str)
+                if not pin_hash: # PINHashが設定されていないユーザーはログインできない
+                    logger.warning(f"PersonID '{pid_int}' にPINHashが設定されていません。このユーザーはログインできません。")
+                    # ログインさせないユーザーは辞書に含めないか、特別なマークを付ける
+                    # ここでは、ログイン機能のためPINHashが必須であるとして、なければスキップする例
+                    # continue 
+                    # もしくは、辞書には含めておき、ログイン時にPINHashの有無をチェックする
+                
+                # ★★★ PERSON_ID_DICTの構造を変更 ★★★
+                temp_dict[pid_int] = {"name": pname, "pin_hash": pin_hash}
+                temp_id_list.append(pid_int)
+
+            except ValueError:
+                logger.warning(f"PersonID '{pid_str}' を整数に変換できませんでした。スキップします。")
+                continue
+        elif pid_str: # IDはあるが名前がない場合など（通常はないはず）
+             logger.warning(f"PersonID '{pid_str}' のデータが不完全です（名前がないなど）。")
+    return temp_dict, sorted(temp_id_list) # IDリストをソートしておく
+
+def _publish_personid_data(person_dict, person_list, loaded_at: float = None):
+    # 公開する参照データは読み取り専用のビュー（MappingProxyType / タプル）にする。
+    # 全スレッドで共有し、gc.freeze() 後は fork したワーカー間でもページを共有するので、呼び出し側で書き換えさせない
     global PERSON_ID_DICT, PERSON_ID_LIST, last_personid_load_time
-    if not client:
+    PERSON_ID_DICT = MappingProxyType({pid: MappingProxyType(info) for pid, info in person_dict.items()})
+    PERSON_ID_LIST = tuple(person_list)
+    last_personid_load_time = loaded_at or time.time()
+
+def load_personid_data():
+    if not _get_client():
         logger.error("Google Sheets クライアントが初期化されていません。PersonIDデータをロードできません。")
-        return
+        return False
     try:
-        sheet = client.open(SPREADSHEET_NAME).worksheet(PERSONID_WORKSHEET_NAME)
+        sheet = _get_spreadsheet().worksheet(PERSONID_WORKSHEET_NAME)
         records = sheet.get_all_records()
-        temp_dict = {}
-        temp_id_list = [] # PersonIDの数値リストもここで再構築
-        for row in records:
-            pid_str = str(row.get("PersonID", "")).strip()
-            pname = str(row.get("PersonName", "")).strip()
-            pin_hash = str(row.get("PINHash", "")).strip() # ★★★ PINHash列を読み込む ★★★
-
-            if pid_str and pname: # PINHashは空でも許容するかもしれないが、ログイン機能には必須
-                try:
-                    pid_int = int(pid_str)
-                    if not pin_hash: # PINHashが設定されていないユーザーはログインできない
-                        logger.warning(f"PersonID '{pid_int}' にPINHashが設定されていません。このユーザーはログインできません。")
-                        # ログインさせないユーザーは辞書に含めないか、特別なマークを付ける
-                        # ここでは、ログイン機能のためPINHashが必須であるとして、なければスキップする例
-                        # continue 
-                        # もしくは、辞書には含めておき、ログイン時にPINHashの有無をチェックする
-                    
-                    # ★★★ PERSON_ID_DICTの構造を変更 ★★★
-                    temp_dict[pid_int] = {"name": pname, "pin_hash": pin_hash}
-                    temp_id_list.append(pid_int)
-
-                except ValueError:
-                    logger.warning(f"PersonID '{pid_str}' を整数に変換できませんでした。スキップします。")
-                    continue
-            elif pid_str: # IDはあるが名前がない場合など（通常はないはず）
-                 logger.warning(f"PersonID '{pid_str}' のデータが不完全です（名前がないなど）。")
-
-
-        PERSON_ID_DICT = temp_dict
-        PERSON_ID_LIST = sorted(temp_id_list) # IDリストをソートしておく
-        last_personid_load_time = time.time()
+        _publish_personid_data(*_build_personid_data(records))
         logger.info(f"Google Sheets から {len(PERSON_ID_DICT)} 件の PersonID/PersonName/PINHash レコードをロードしました！")
+        return True
     except Exception as e:
+        # 読み込み途中のデータは公開しない。前回ロード分をそのまま使い続ける（初回なら空のまま）
         logger.error(f"Google Sheets の PersonID データ取得に失敗: {e}", exc_info=True)
-        PERSON_ID_DICT = {} # エラー時は空にする
-        PERSON_ID_LIST = []
+        _reset_spreadsheet()
+        return False
 
 def get_cached_personid_data():
     # この関数は PERSON_ID_DICT と PERSON_ID_LIST を返すので、
     # PERSON_ID_DICT の構造が変わったことを呼び出し元が意識する必要があるかもしれない。
     # 今回は、PersonID選択ドロップダウンで名前も表示するために辞書も返す。
-    if not PERSON_ID_DICT or (time.time() - last_personid_load_time > CACHE_TTL):
-        logger.info("PersonIDキャッシュが無効または期限切れです。再ロードします。")
-        load_personid_data()
+    _ensure_reference_refresher()
+    if not PERSON_ID_DICT:
+        logger.info("PersonIDキャッシュが未ロードです。ロードします。")
+        _load_reference("personid")
+    elif time.time() - last_personid_load_time > CACHE_TTL:
+        _request_reference_refresh("personid")
     return PERSON_ID_DICT, PERSON_ID_LIST
 
 # ... (WorkCord, WorkProcess関連の関数は変更なし) ...
 
 # ===== WorkCord/WorkName/BookName キャッシュ =====
-workcord_dict = {}
+workcord_dict = MappingProxyType({})
+workcord_sorted_keys = () # 前方一致検索用: workcord_dict のキーを文字列順にソートしたもの
 last_workcord_load_time = 0
 
+WORKCORD_SEARCH_LIMIT = int(os.environ.get("WORKCORD_SEARCH_LIMIT", "50")) # 前方一致検索の既定の最大件数
+
+def _build_workcord_data(records):
+    """wsTableCD の行データから (workcord_dict, workcord_sorted_keys) を組み立てる。"""
+    temp_dict = {}
+    for row in records:
+        workcord = str(row.get("WorkCord", "")).strip()
+        workname = str(row.get("WorkName", "")).strip()
+        bookname = str(row.get("BookName", "")).strip()
+        if workcord and workname: # BookNameは空でも許容するかもしれないので条件から外す場合も
+            if workcord not in temp_dict:
+                temp_dict[workcord] = []
+            temp_dict[workcord].append({"workname": workname, "bookname": bookname})
+    return temp_dict, sorted(temp_dict.keys()) # 前方一致インデックスも一緒に作る
+
+def _publish_workcord_data(new_dict, new_sorted_keys, loaded_at: float = None):
+    # 新しい辞書を別に組み立ててから差し替える（読み込み中に空の辞書が見えないように）
+    global workcord_dict, workcord_sorted_keys, last_workcord_load_time
+    workcord_dict = MappingProxyType({code: tuple(MappingProxyType(item) for item in items)
+                                      for code, items in new_dict.items()})
+    workcord_sorted_keys = tuple(new_sorted_keys)
+    last_workcord_load_time = loaded_at or time.time()
+
 def load_workcord_data():
-    global workcord_dict, last_workcord_load_time
-    if not client:
+    if not _get_client():
         logger.error("Google Sheets クライアントが初期化されていません。WorkCordデータをロードできません。")
-        return
-    workcord_dict = {} # 毎回初期化
+        return False
     try:
-        sheet = client.open(SPREADSHEET_NAME).worksheet(WORKSHEET_NAME)
+        sheet = _get_spreadsheet().worksheet(WORKSHEET_NAME)
         records = sheet.get_all_records()
-        for row in records:
-            workcord = str(row.get("WorkCord", "")).strip()
-            workname = str(row.get("WorkName", "")).strip()
-            bookname = str(row.get("BookName", "")).strip()
-            if workcord and workname: # BookNameは空でも許容するかもしれないので条件から外す場合も
-                if workcord not in workcord_dict:
-                    workcord_dict[workcord] = []
-                workcord_dict[workcord].append({"workname": workname, "bookname": bookname})
+        _publish_workcord_data(*_build_workcord_data(records))
         total_records = sum(len(lst) for lst in workcord_dict.values())
         logger.info(f"Google Sheets から {total_records} 件の WorkCD/WorkName/BookName レコードをロードしました！")
-        last_workcord_load_time = time.time()
+        return True
     except Exception as e:
         logger.error(f"Google Sheets の WorkCordデータ取得に失敗: {e}", exc_info=True)
+        _reset_spreadsheet()
+        return False
 
 def get_cached_workcord_data():
-    if not workcord_dict or (time.time() - last_workcord_load_time > CACHE_TTL):
-        logger.info("WorkCordキャッシュが無効または期限切れです。再ロードします。")
-        load_workcord_data()
+    _ensure_reference_refresher()
+    if not workcord_dict:
+        logger.info("WorkCordキャッシュが未ロードです。ロードします。")
+        _load_reference("workcord")
+    elif time.time() - last_workcord_load_time > CACHE_TTL:
+        _request_reference_refresh("workcord")
     return workcord_dict
 
+def search_workcord_prefix(prefix: str, limit: int = None):
+    """
+    WorkCD の前方一致検索。ソート済みキー配列を bisect で範囲検索するため、件数に依らずほぼ一定時間で返る。
+    完全一致を先頭に、残りはキーの文字列順（安定した順序）で最大 limit 件の
+    [{"code", "workname", "bookname"}, ...] を返す。
+    """
+    data = get_cached_workcord_data()
+    keys = workcord_sorted_keys
+    if limit is None:
+        limit = WORKCORD_SEARCH_LIMIT
+    results = []
+    if not prefix or limit <= 0:
+        return results
+
+    # prefix で始まるキーは [bisect_left(prefix), bisect_left(prefix + 最大文字)) に連続して並ぶ
+    start = bisect_left(keys, prefix)
+    end = bisect_left(keys, prefix + "\U0010ffff", lo=start)
+
+    # ソート順では完全一致（= prefix 自身）が範囲の先頭に来るので、そのまま並べれば完全一致優先になる
+    for i in range(start, end):
+        key = keys[i]
+        for item in data.get(key, ()):
+            results.append({
+                "code": key,
+                "workname": item["workname"],
+                "bookname": item["bookname"]
+            })
+            if len(results) >= limit:
+                return results
+    return results
+
 # ===== WorkProcess/UnitPrice データ =====
-workprocess_list_cache = []
-unitprice_dict_cache = {}
+workprocess_list_cache = ()
+unitprice_dict_cache = MappingProxyType({})
 last_workprocess_load_time = 0
 
-def load_workprocess_data():
+def _build_workprocess_data(records):
+    """wsWorkProcess の行データから (workprocess_list_cache, unitprice_dict_cache) を組み立てる。"""
+    temp_list = []
+    temp_dict = {}
+    for row in records:
+        wp = str(row.get("WorkProcess", "")).strip()
+        up_str = str(row.get("UnitPrice", "0")).strip() # 文字列として取得
+        if wp:
+            temp_list.append(wp)
+            try:
+                # UnitPriceをfloatに変換しようと試みる
+                up = float(up_str)
+            except ValueError:
+                logger.warning(f"WorkProcess '{wp}' の UnitPrice '{up_str}' をfloatに変換できませんでした。0として扱います。")
+                up = 0.0 # エラーの場合は0または他のデフォルト値
+            temp_dict[wp] = up
+    return temp_list, temp_dict
+
+def _publish_workprocess_data(new_list, new_dict, loaded_at: float = None):
     global workprocess_list_cache, unitprice_dict_cache, last_workprocess_load_time
-    if not client:
+    workprocess_list_cache = tuple(new_list)
+    unitprice_dict_cache = MappingProxyType(new_dict)
+    last_workprocess_load_time = loaded_at or time.time()
+
+def load_workprocess_data():
+    if not _get_client():
         logger.error("Google Sheets クライアントが初期化されていません。WorkProcessデータをロードできません。")
-        return
+        return False
     try:
-        sheet = client.open(SPREADSHEET_NAME).worksheet(WORKPROCESS_WORKSHEET_NAME)
+        sheet = _get_spreadsheet().worksheet(WORKPROCESS_WORKSHEET_NAME)
         records = sheet.get_all_records()
-        temp_list = []
-        temp_dict = {}
-        for row in records:
-            wp = str(row.get("WorkProcess", "")).strip()
-            up_str = str(row.get("UnitPrice", "0")).strip() # 文字列として取得
-            if wp:
-                temp_list.append(wp)
-                try:
-                    # UnitPriceをfloatに変換しようと試みる
-                    up = float(up_str)
-                except ValueError:
-                    logger.warning(f"WorkProcess '{wp}' の UnitPrice '{up_str}' をfloatに変換できませんでした。0として扱います。")
-                    up = 0.0 # エラーの場合は0または他のデフォルト値
-                temp_dict[wp] = up
-        workprocess_list_cache = temp_list
-        unitprice_dict_cache = temp_dict
-        last_workprocess_load_time = time.time()
+        _publish_workprocess_data(*_build_workprocess_data(records))
         logger.info(f"Google Sheets から {len(workprocess_list_cache)} 件の WorkProcess/UnitPrice レコードをロードしました！")
+        return True
     except Exception as e:
         logger.error(f"Google Sheets の WorkProcessデータ取得に失敗: {e}", exc_info=True)
+        _reset_spreadsheet()
+        return False
 
 def get_cached_workprocess_data():
-    if not workprocess_list_cache or (time.time() - last_workprocess_load_time > CACHE_TTL):
-        logger.info("WorkProcessキャッシュが無効または期限切れです。再ロードします。")
-        load_workprocess_data()
-    return workprocess_list_cache, unitprice_dict_cache
\ No newline at end of file
+    _ensure_reference_refresher()
+    if not workprocess_list_cache:
+        logger.info("WorkProcessキャッシュが未ロードです。ロードします。")
+        _load_reference("workprocess")
+    elif time.time() - last_workprocess_load_time > CACHE_TTL:
+        _request_reference_refresh("workprocess")
+    return workprocess_list_cache, unitprice_dict_cache
+
+
+# ===== 入力画面用の参照データ一式（/api/reference） =====
+# 品番索引・工程・単価を1つの JSON にまとめ、gzip 済みのバイト列と内容のハッシュ（版）を持っておく。
+# ブラウザは版付き URL で一度だけ取得し、品番の前方一致はローカルで引く。PINHash は含めない。
+_bundle_lock = Lock()
+_bundle = None  # (元データの組, version, json_bytes, gzip_bytes)
+
+def _bundle_sources():
+    return (workcord_dict, workcord_sorted_keys, workprocess_list_cache, unitprice_dict_cache)
+
+def reference_bundle():
+    """(version, json_bytes, gzip_bytes) を返す。参照データが差し替わったときだけ作り直す。"""
+    global _bundle
+    get_cached_workcord_data()
+    get_cached_workprocess_data()
+    sources = _bundle_sources()
+    bundle = _bundle
+    if bundle is not None and all(a is b for a, b in zip(bundle[0], sources)):
+        return bundle[1:]
+    with _bundle_lock:
+        sources = _bundle_sources()
+        bundle = _bundle
+        if bundle is not None and all(a is b for a, b in zip(bundle[0], sources)):
+            return bundle[1:]
+        codes_dict, sorted_keys, process_list, price_dict = sources
+        payload = {
+            # キー順（前方一致は連続した範囲になる。サーバー側の search_workcord_prefix と同じ並び）
+            "workcord": [[code, [[item["workname"], item["bookname"]] for item in codes_dict[code]]]
+                         for code in sorted_keys if code in codes_dict],
+            "workprocess": [[wp, price_dict.get(wp, 0.0)] for wp in process_list],
+            "search_limit": WORKCORD_SEARCH_LIMIT,
+        }
+        version = _payload_version(payload)
+        payload["version"] = version
+        json_bytes = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        gzip_bytes = gzip.compress(json_bytes, compresslevel=9, mtime=0)  # 同じ内容なら同じバイト列
+        _bundle = (sources, version, json_bytes, gzip_bytes)
+        logger.info(f"参照データのバンドルを作成しました: version={version}, "
+                    f"{len(json_bytes)} bytes -> gzip {len(gzip_bytes)} bytes")
+        return version, json_bytes, gzip_bytes
+
+
+# ===== 3シート一括ロード =====
+def load_all_reference_data():
+    """
+    wsPersonID / wsTableCD / wsWorkProcess を1回の values:batchGet でまとめて読み、3種類のデータを組み立てて差し替える。
+    （シートごとに open + get_all_records する場合の API 呼び出し 6 回が 1〜2 回になる）
+    3シートすべて組み立てられた場合のみ公開する。
+    """
+    if not _get_client():
+        logger.error("Google Sheets クライアントが初期化されていません。参照データをロードできません。")
+        return False
+    try:
+        started = time.perf_counter()
+        sheet_names = [PERSONID_WORKSHEET_NAME, WORKSHEET_NAME, WORKPROCESS_WORKSHEET_NAME]
+        response = _get_spreadsheet().values_batch_get(
+            [gspread.utils.absolute_range_name(name) for name in sheet_names]
+        )
+        value_ranges = response.get("valueRanges", [])
+        if len(value_ranges) != len(sheet_names):
+            raise ValueError(f"batchGet の応答シート数が一致しません: {len(value_ranges)}")
+        person_records, workcord_records, workprocess_records = (
+            _values_to_records(vr.get("values", [])) for vr in value_ranges
+        )
+
+        person_data = _build_personid_data(person_records)
+        workcord_data = _build_workcord_data(workcord_records)
+        workprocess_data = _build_workprocess_data(workprocess_records)
+
+        _publish_personid_data(*person_data)
+        _publish_workcord_data(*workcord_data)
+        _publish_workprocess_data(*workprocess_data)
+        logger.info(
+            f"Google Sheets から参照データを一括ロードしました: PersonID {len(PERSON_ID_DICT)} 件, "
+            f"WorkCD {len(workcord_dict)} 件, WorkProcess {len(workprocess_list_cache)} 件 "
+            f"({(time.perf_counter() - started) * 1000:.0f}ms)"
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Google Sheets の参照データ一括取得に失敗: {e}", exc_info=True)
+        _reset_spreadsheet()
+        return False
+
+
+# ===== 参照データのスナップショット（起動直後用） =====
+# 最後に Google Sheets から正常にロードした3種類のデータを gzip 圧縮 JSON で保存しておき、
+# 起動時（import 時）にまずそれを読み込む。Sheets が遅い/落ちていてもすぐにログイン・入力できるようにする。
+# PINHash を含むため、ファイルは所有者のみ読み書き可 (0600) で作成する。空文字で無効。
+REFERENCE_SNAPSHOT_PATH = os.environ.get("REFERENCE_SNAPSHOT_PATH", "reference_snapshot.json.gz")
+REFERENCE_SNAPSHOT_FORMAT = 1
+
+REFERENCE_DATA_VERSION = None # 現在公開中の参照データのチェックサム（内容が同じなら同じ値）
+
+def _reference_payload() -> dict:
+    """現在の参照データをスナップショット用の素の構造（JSON化できる形）にする。"""
+    return {
+        "personid": [[pid, info["name"], info["pin_hash"]] for pid, info in PERSON_ID_DICT.items()],  # シートの並び順を保つ
+        "workcord": [[code, [[item["workname"], item["bookname"]] for item in workcord_dict[code]]]
+                     for code in workcord_sorted_keys if code in workcord_dict],
+        "workprocess": [[wp, unitprice_dict_cache.get(wp, 0.0)] for wp in workprocess_list_cache],
+    }
+
+def _payload_version(payload: dict) -> str:
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+def _update_reference_version(save_snapshot: bool = False):
+    """公開中データのバージョンを計算し直し、変わっていればスナップショットに書き出す。"""
+    global REFERENCE_DATA_VERSION
+    if not (PERSON_ID_DICT and workcord_dict and workprocess_list_cache):
+        return  # 一部でも未ロードのデータは保存しない（不完全なスナップショットで上書きしない）
+    payload = _reference_payload()
+    version = _payload_version(payload)
+    changed = version != REFERENCE_DATA_VERSION
+    REFERENCE_DATA_VERSION = version
+    if not (save_snapshot and REFERENCE_SNAPSHOT_PATH):
+        return
+    if changed or read_snapshot_version() != version:
+        save_reference_snapshot(payload, version)
+    else:
+        # 内容は同じ：更新日時だけ進めて「この時刻に最新を確認した」ことをスナップショットを読む側に伝える
+        try:
+            os.utime(REFERENCE_SNAPSHOT_PATH)
+        except OSError:
+            pass
+
+def save_reference_snapshot(payload: dict = None, version: str = None) -> bool:
+    """参照データをスナップショットファイルへ書き出す（一時ファイル経由で置き換えるので読み手は壊れたファイルを見ない）。"""
+    if not REFERENCE_SNAPSHOT_PATH:
+        return False
+    if payload is None:
+        payload = _reference_payload()
+    if version is None:
+        version = _payload_version(payload)
+    document = {"format": REFERENCE_SNAPSHOT_FORMAT, "version": version, "saved_at": time.time(), "data": payload}
+    tmp_path = f"{REFERENCE_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with gzip.open(os.fdopen(fd, "wb"), "wt", encoding="utf-8") as f:
+            json.dump(document, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, REFERENCE_SNAPSHOT_PATH)
+        logger.info(f"参照データのスナップショットを保存しました: {REFERENCE_SNAPSHOT_PATH} (version={version})")
+        return True
+    except Exception as e:
+        logger.warning(f"参照データのスナップショット保存に失敗（無視）: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+
+def _read_snapshot_document():
+    with gzip.open(REFERENCE_SNAPSHOT_PATH, "rt", encoding="utf-8") as f:
+        document = json.load(f)
+    if document.get("format") != REFERENCE_SNAPSHOT_FORMAT:
+        raise ValueError(f"未対応のスナップショット形式です: {document.get('format')}")
+    if _payload_version(document["data"]) != document.get("version"):
+        raise ValueError("スナップショットのチェックサムが一致しません（破損の可能性）")
+    return document
+
+def read_snapshot_version():
+    """スナップショットファイルのバージョンを返す。無い/読めない場合は None。"""
+    if not REFERENCE_SNAPSHOT_PATH or not os.path.exists(REFERENCE_SNAPSHOT_PATH):
+        return None
+    try:
+        return _read_snapshot_document()["version"]
+    except Exception:
+        return None
+
+def snapshot_is_outdated() -> bool:
+    """このプロセスが公開中のデータとスナップショットファイルの内容が異なるかどうか。"""
+    file_version = read_snapshot_version()
+    return file_version is not None and file_version != REFERENCE_DATA_VERSION
+
+_snapshot_mtime_seen = None # 最後に読んだスナップショットファイルの更新日時
+
+def load_reference_snapshot() -> bool:
+    """
+    スナップショットファイルから参照データを読み込んで公開する。
+    ロード時刻には保存（最終確認）時刻を使うので、古いスナップショットならすぐにバックグラウンド更新の対象になる。
+    """
+    global REFERENCE_DATA_VERSION, _snapshot_mtime_seen
+    if not REFERENCE_SNAPSHOT_PATH or not os.path.exists(REFERENCE_SNAPSHOT_PATH):
+        return False
+    try:
+        started = time.perf_counter()
+        mtime = os.path.getmtime(REFERENCE_SNAPSHOT_PATH)
+        document = _read_snapshot_document()
+        data = document["data"]
+        saved_at = max(document.get("saved_at") or 0, mtime)
+        _snapshot_mtime_seen = mtime
+
+        person_dict = {int(pid): {"name": name, "pin_hash": pin_hash} for pid, name, pin_hash in data["personid"]}
+        workcord_data = {code: [{"workname": workname, "bookname": bookname} for workname, bookname in items]
+                         for code, items in data["workcord"]}
+        workprocess_list = [wp for wp, _ in data["workprocess"]]
+        unitprice_dict = {wp: float(up) for wp, up in data["workprocess"]}
+
+        _publish_personid_data(person_dict, sorted(person_dict), loaded_at=saved_at)
+        _publish_workcord_data(workcord_data, sorted(workcord_data), loaded_at=saved_at)
+        _publish_workprocess_data(workprocess_list, unitprice_dict, loaded_at=saved_at)
+        REFERENCE_DATA_VERSION = document["version"]
+        logger.info(
+            f"参照データをスナップショットから読み込みました: version={REFERENCE_DATA_VERSION}, "
+            f"保存から {time.time() - saved_at:.0f}秒経過 ({(time.perf_counter() - started) * 1000:.0f}ms)"
+        )
+        return True
+    except Exception as e:
+        logger.warning(f"参照データのスナップショット読み込みに失敗（Google Sheets からロードします）: {e}")
+        return False
+
+def reload_snapshot_if_changed() -> bool:
+    """
+    スナップショットファイルが前回読んだ後に更新されていれば読み直す（ファイルの更新日時だけを見るので軽い）。
+    内容が同じ（バージョンが同じ）なら、データは差し替えずロード時刻だけ進める。
+    """
+    global _snapshot_mtime_seen, last_personid_load_time, last_workcord_load_time, last_workprocess_load_time
+    if not REFERENCE_SNAPSHOT_PATH:
+        return False
+    try:
+        mtime = os.path.getmtime(REFERENCE_SNAPSHOT_PATH)
+    except OSError:
+        return False
+    if mtime == _snapshot_mtime_seen:
+        return False
+    if read_snapshot_version() == REFERENCE_DATA_VERSION:
+        _snapshot_mtime_seen = mtime
+        last_personid_load_time = last_workcord_load_time = last_workprocess_load_time = mtime
+        return False
+    return load_reference_snapshot()
+
+
+# ===== 参照データのバックグラウンド更新 =====
+# 期限切れ前にタイマーで3種類のデータを再ロードする。リクエスト処理はロード済みのデータを読むだけで、
+# Google Sheets の待ち時間がログインや入力画面に乗らないようにする（初回の未ロード時のみ同期ロード）。
+REFERENCE_REFRESH_ENABLED = os.environ.get("REFERENCE_BACKGROUND_REFRESH", "1") != "0"
+REFERENCE_REFRESH_INTERVAL_SEC = int(os.environ.get("REFERENCE_REFRESH_INTERVAL_SEC", str(int(CACHE_TTL * 0.8))))
+REFERENCE_REFRESH_JITTER_SEC = int(os.environ.get("REFERENCE_REFRESH_JITTER_SEC", "30")) # ワーカー間で再ロード時刻をずらす
+# 更新に失敗したら、次の Google Sheets 取得まで待つ（連続失敗ごとに倍、上限あり）。その間の期限切れ通知は無視する
+REFERENCE_RETRY_BACKOFF_SEC = int(os.environ.get("REFERENCE_RETRY_BACKOFF_SEC", "15"))
+REFERENCE_RETRY_BACKOFF_MAX_SEC = int(os.environ.get("REFERENCE_RETRY_BACKOFF_MAX_SEC", "300"))
+
+# スナップショット追従モード（gunicorn プリロード時のワーカー用）：
+# Google Sheets へは代表の1ワーカーだけがアクセスしてスナップショットを書き、他のワーカーはその更新を検知して読み込む。
+REFERENCE_FOLLOW_SNAPSHOT = False
+REFERENCE_SNAPSHOT_POLL_SEC = int(os.environ.get("REFERENCE_SNAPSHOT_POLL_SEC", "15"))
+
+_REFERENCE_LOADERS = {
+    "personid": load_personid_data,
+    "workcord": load_workcord_data,
+    "workprocess": load_workprocess_data,
+}
+_refresh_status_lock = Lock()
+_refresh_status = {
+    name: {"last_attempt_at": 0, "last_success_at": 0, "failures": 0, "consecutive_failures": 0, "last_error": None}
+    for name in _REFERENCE_LOADERS
+}
+_refresh_wakeup = Event()
+_refresher_lock = Lock()
+_refresher_pid = None
+_refresher_failures = 0     # 更新スレッドの連続失敗回数
+_refresher_retry_at = 0.0   # この時刻までは Google Sheets からの再取得を試みない（失敗後のバックオフ）
+
+def _record_refresher_result(ok: bool):
+    """更新スレッドの1回分の結果を記録する。失敗が続くほど次の再取得を遅らせる。"""
+    global _refresher_failures, _refresher_retry_at
+    if ok:
+        _refresher_failures = 0
+        _refresher_retry_at = 0.0
+        return
+    _refresher_failures += 1
+    backoff = min(REFERENCE_RETRY_BACKOFF_MAX_SEC, REFERENCE_RETRY_BACKOFF_SEC * (2 ** (_refresher_failures - 1)))
+    _refresher_retry_at = time.time() + backoff
+    logger.warning(f"参照データの更新に失敗しました（連続{_refresher_failures}回）。{backoff}秒後に再試行します")
+
+def _record_refresh_result(name: str, ok: bool, error: str = None):
+    with _refresh_status_lock:
+        status = _refresh_status[name]
+        status["last_attempt_at"] = time.time()
+        if ok:
+            status["last_success_at"] = status["last_attempt_at"]
+            status["consecutive_failures"] = 0
+            status["last_error"] = None
+        else:
+            status["failures"] += 1
+            status["consecutive_failures"] += 1
+            status["last_error"] = error or "ロードに失敗しました（詳細はログ参照）"
+
+def _load_reference_single(name: str) -> bool:
+    """参照データ1種類を（同時に1回だけ）個別にロードし、結果を更新状況に記録する。"""
+    try:
+        ok = bool(_reload_flight.do(name, _REFERENCE_LOADERS[name]))
+        _record_refresh_result(name, ok)
+        return ok
+    except Exception as e:
+        logger.error(f"参照データ '{name}' のロードに失敗: {e}", exc_info=True)
+        _record_refresh_result(name, False, str(e))
+        return False
+
+def _load_reference(name: str = None) -> bool:
+    """
+    参照データをロードする。まず3シート一括ロードを試し、失敗した場合は
+    name で指定した1種類（省略時は3種類すべて）を個別ロードで取り直す。
+    """
+    try:
+        ok = bool(_reload_flight.do("all", load_all_reference_data))
+    except Exception as e:
+        logger.error(f"参照データの一括ロードに失敗: {e}", exc_info=True)
+        ok = False
+    if ok:
+        for dataset in _REFERENCE_LOADERS:
+            _record_refresh_result(dataset, True)
+    else:
+        names = [name] if name else list(_REFERENCE_LOADERS)
+        ok = all([_load_reference_single(dataset) for dataset in names])
+    if ok:
+        _update_reference_version(save_snapshot=True)
+    return ok
+
+def refresh_reference_data():
+    """3種類の参照データを再ロードする（更新スレッドから定期的に呼ばれる）。"""
+    return _load_reference()
+
+def _follow_snapshot_once():
+    """
+    スナップショット追従モードの1回分。他のワーカーが書いたスナップショットが更新されていれば読み込む。
+    データが更新間隔より古くなったら、ロックファイルを取れた1ワーカーだけが Google Sheets から取得して
+    スナップショットを書き直す（全ワーカーが同時に Sheets を読まないように）。
+    """
+    reload_snapshot_if_changed()
+    oldest = min(last_personid_load_time, last_workcord_load_time, last_workprocess_load_time)
+    if time.time() - oldest <= REFERENCE_REFRESH_INTERVAL_SEC:
+        return
+    if time.time() < _refresher_retry_at:
+        return  # 前回の失敗からのバックオフ中（スナップショットの読み込みだけ続ける）
+    try:
+        import fcntl
+    except ImportError:  # Windows 等（gunicorn は動かないので通常ここには来ない）
+        _record_refresher_result(refresh_reference_data())
+        return
+    with open(f"{REFERENCE_SNAPSHOT_PATH}.lock", "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return  # 他のワーカーが更新中。次回のポーリングで結果を読み込む
+        try:
+            if reload_snapshot_if_changed():
+                return  # ロック待ちの間に他のワーカーが更新していた
+            _record_refresher_result(refresh_reference_data())
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _reference_refresher_loop():
+    while True:
+        if REFERENCE_FOLLOW_SNAPSHOT:
+            delay = REFERENCE_SNAPSHOT_POLL_SEC
+        elif _refresher_retry_at:
+            delay = _refresher_retry_at - time.time()  # 失敗後はバックオフ明けに取り直す
+        else:
+            delay = REFERENCE_REFRESH_INTERVAL_SEC + random.uniform(-REFERENCE_REFRESH_JITTER_SEC, REFERENCE_REFRESH_JITTER_SEC)
+        # 期限切れを検知したリクエストがあれば待たずに起きる
+        _refresh_wakeup.wait(max(1.0, delay))
+        _refresh_wakeup.clear()
+        if not REFERENCE_FOLLOW_SNAPSHOT and time.time() < _refresher_retry_at:
+            continue  # バックオフ中の起床は無視する
+        # 1回の失敗（ロックファイルが開けない・スナップショットが読めない等）でスレッドを終わらせない
+        try:
+            if REFERENCE_FOLLOW_SNAPSHOT:
+                _follow_snapshot_once()
+            else:
+                _record_refresher_result(refresh_reference_data())
+        except Exception as e:
+            logger.error(f"参照データの更新スレッドでエラー（継続します）: {e}", exc_info=True)
+            _record_refresher_result(False)
+
+def _ensure_reference_refresher():
+    """このプロセスで更新スレッドが未起動なら起動する（fork 後のワーカーでも1回ずつ起動される）。"""
+    global _refresher_pid
+    if not REFERENCE_REFRESH_ENABLED or _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        Thread(target=_reference_refresher_loop, name="reference-data-refresher", daemon=True).start()
+        _refresher_pid = os.getpid()
+        logger.info(f"参照データのバックグラウンド更新を開始しました (間隔 {REFERENCE_REFRESH_INTERVAL_SEC}s ±{REFERENCE_REFRESH_JITTER_SEC}s)")
+
+def _request_reference_refresh(name: str):
+    """
+    期限切れを検知したときに呼ぶ。リクエスト処理はロードせず、更新スレッドを起こすだけ。
+    更新スレッドを使わない設定の場合は従来通りその場で再ロードする。
+    """
+    if REFERENCE_REFRESH_ENABLED:
+        if time.time() >= _refresher_retry_at:  # 失敗後のバックオフ中はリクエストごとに起こさない
+            _refresh_wakeup.set()
+    else:
+        logger.info(f"参照データ '{name}' が期限切れです。再ロードします。")
+        _load_reference(name)
+
+def reference_data_status() -> dict:
+    """参照データごとの最終更新からの経過秒数・失敗回数などを返す（/api/metrics 用）。"""
+    now = time.time()
+    loaded_at = {
+        "personid": last_personid_load_time,
+        "workcord": last_workcord_load_time,
+        "workprocess": last_workprocess_load_time,
+    }
+    counts = {
+        "personid": len(PERSON_ID_DICT),
+        "workcord": len(workcord_dict),
+        "workprocess": len(workprocess_list_cache),
+    }
+    with _refresh_status_lock:
+        result = {}
+        for name, status in _refresh_status.items():
+            result[name] = dict(status)
+            result[name]["age_sec"] = round(now - loaded_at[name], 1) if loaded_at[name] else None
+            result[name]["entries"] = counts[name]
+    return {
+        "background_refresh": REFERENCE_REFRESH_ENABLED and _refresher_pid == os.getpid(),
+        "follow_snapshot": REFERENCE_FOLLOW_SNAPSHOT,
+        "interval_sec": REFERENCE_REFRESH_INTERVAL_SEC,
+        "consecutive_failures": _refresher_failures,
+        "retry_in_sec": max(0.0, round(_refresher_retry_at - now, 1)),
+        "version": REFERENCE_DATA_VERSION,
+        "snapshot_path": REFERENCE_SNAPSHOT_PATH or None,
+        "datasets": result,
+    }
+
+
+# ===== gunicorn プリロード（master で1回ロードしてワーカーと共有） =====
+def preload_reference_data():
+    """
+    gunicorn master で fork 前に呼ぶ。スナップショット（import 時に読み込み済み）が無いか古ければ
+    Google Sheets から同期ロードする。master ではスレッドを起動しない（fork 時のロック競合を避ける）。
+    ロードしたオブジェクトは gc.freeze() で永続世代に移し、fork 後のワーカーで GC による
+    書き込み（コピーオンライトの解除）が起きないようにする。
+    """
+    oldest = min(last_personid_load_time, last_workcord_load_time, last_workprocess_load_time)
+    if not (PERSON_ID_DICT and workcord_dict and workprocess_list_cache) or time.time() - oldest > CACHE_TTL:
+        refresh_reference_data()
+    gc.freeze()
+    logger.info(f"参照データをプリロードしました (version={REFERENCE_DATA_VERSION}, pid={os.getpid()})")
+
+def enable_snapshot_follower():
+    """
+    gunicorn の post_fork から呼ぶ。このワーカーは基本的に Google Sheets を直接読まず、
+    スナップショットの更新を検知して差し替える（ワーカーの再起動なしで最新化される）。
+    Sheets からの再取得は、その時点でロックを取れた1ワーカーだけが行う。
+    """
+    global REFERENCE_FOLLOW_SNAPSHOT
+    if not REFERENCE_SNAPSHOT_PATH:
+        logger.warning("REFERENCE_SNAPSHOT_PATH が未設定のため、ワーカーは各自 Google Sheets から更新します。")
+        return
+    REFERENCE_FOLLOW_SNAPSHOT = True
+    _ensure_reference_refresher()
+
+
+# 起動時（import 時）に前回のスナップショットを読み込んでおく。最新化はバックグラウンド更新に任せる
+load_reference_snapshot()
+
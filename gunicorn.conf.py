@@ -0,0 +1,27 @@
+# gunicorn.conf.py
+# gunicorn はカレントディレクトリの gunicorn.conf.py を自動で読み込む（Procfile の `gunicorn app:app` のままで有効）。
+import os
+
+# master でアプリを import してから fork する。参照データ（Google Sheets）は master で1回だけロードされ、
+# ワーカーはそれをコピーオンライトで共有する。GUNICORN_PRELOAD=0 で従来通りワーカーごとにロード。
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+
+def when_ready(server):
+    # ワーカーの fork 前（master）に参照データを揃え、GC の対象から外しておく
+    if preload_app:
+        import data_services
+        data_services.preload_reference_data()
+
+
+def post_fork(server, worker):
+    # ワーカーはスナップショットの更新を検知して参照データを差し替える（再起動不要）
+    if preload_app:
+        import data_services
+        data_services.enable_snapshot_follower()
+    # 前回の起動で送り残した write-behind の行を、入力を待たずに送り始める
+    import write_behind
+    write_behind.ensure_flusher()
+    # ミラー有効時は同期スレッドを起動（同期するのはロックを取れた1ワーカーだけ）
+    import airtable_mirror
+    airtable_mirror.ensure_syncer()
@@ -0,0 +1,17 @@
+# pin_worker.py
+"""
+PIN ハッシュ照合用の子プロセス（auth_service のプロセスプール）で動かすものだけを置く小さなモジュール。
+子プロセスはこのモジュールと werkzeug.security だけを読み込む（Flask アプリや参照データは読み込まない）。
+"""
+import signal
+
+from werkzeug.security import check_password_hash
+
+
+def init_worker():
+    """プールの子プロセスの初期化。Ctrl+C は親（サーバー）が受けて後始末するので、子では無視する。"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def verify(pin_hash: str, pin: str) -> bool:
+    return bool(check_password_hash(pin_hash, pin))
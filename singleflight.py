@@ -0,0 +1,72 @@
+# singleflight.py
+from threading import Event, Lock
+
+
+class _Call:
+    """実行中の1回分の処理。完了するまで後続の呼び出し元はこれを待つ。"""
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, timeout: float = None):
+        """
+        先行処理の結果を返す。先行処理が例外で終わった場合は同じ例外を送出する。
+        timeout 内に終わらなければ TimeoutError。
+        """
+        if not self.done.wait(timeout):
+            raise TimeoutError("先行処理の完了待ちがタイムアウトしました")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """
+    同じキーの重い処理（Airtable取得・Google Sheets再ロードなど）を同時に1回だけ実行する。
+    実行中に来た同じキーの呼び出しは、新たに実行せず先行処理の結果を待って受け取る。
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def join_or_lead(self, key):
+        """
+        (call, is_leader) を返す。is_leader が True の呼び出し元は処理を実行し、
+        必ず complete() を呼ぶこと。False の場合は call.wait() で結果を待つ。
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                return call, False
+            call = _Call()
+            self._calls[key] = call
+            return call, True
+
+    def complete(self, key, call: _Call, result=None, error: BaseException = None):
+        """先行処理の結果を登録し、待っている呼び出し元を起こす。"""
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.result = result
+        call.error = error
+        call.done.set()
+
+    def do(self, key, fn, *args, **kwargs):
+        """fn(*args, **kwargs) をキーごとに1回だけ実行し、その結果を全呼び出し元に返す。"""
+        call, leader = self.join_or_lead(key)
+        if not leader:
+            return call.wait()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.complete(key, call, error=e)
+            raise
+        self.complete(key, call, result=result)
+        return result
+
+    def in_flight(self, key) -> bool:
+        with self._lock:
+            return key in self._calls
@@ -0,0 +1,162 @@
+# static_assets.py
+"""
+レスポンス圧縮と静的ファイルの配信（ビルド手順なし）。
+
+- HTML / JSON / CSS / JS の応答を gzip（brotli が入っていれば br）で圧縮する
+- 起動時に static/ 配下のファイルの内容ハッシュから「指紋付きファイル名」の対応表（マニフェスト）を作り、
+  url_for('static', filename='styles.css') が /static/styles.<hash>.css を返すようにする
+- 指紋付き URL は内容が変わらないので immutable で長期キャッシュさせ、圧縮できるファイルは
+  圧縮済みのバイト列を起動時に作っておいてそのまま返す
+"""
+import os
+import gzip
+import hashlib
+import logging
+import mimetypes
+
+from flask import Response, request, send_from_directory
+
+try:
+    import brotli  # 任意（pip install brotli）。無ければ gzip のみ
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+if not logger.hasHandlers():
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+COMPRESS_ENABLED = os.environ.get("COMPRESS_RESPONSES", "1") != "0"
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "500"))  # これより小さい応答は圧縮しない
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", "5"))
+COMPRESS_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+    "application/json", "image/svg+xml",
+}
+
+STATIC_FINGERPRINT_ENABLED = os.environ.get("STATIC_FINGERPRINT", "1") != "0"
+STATIC_MAX_AGE_SEC = int(os.environ.get("STATIC_MAX_AGE_SEC", str(365 * 24 * 3600)))
+
+_manifest = {}    # 元のファイル名 -> 指紋付きファイル名
+_originals = {}   # 指紋付きファイル名 -> (元のファイル名, 内容ハッシュ)
+_precompressed = {}  # 元のファイル名 -> {"br": bytes, "gzip": bytes}
+
+
+def _accepted_encoding():
+    """クライアントが受け取れる圧縮方式（br を優先）。無ければ None。"""
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"] > 0:
+        return "br"
+    if accept["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+def _compress(data: bytes, encoding: str, best: bool = False) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if best else COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def _fingerprinted_name(filename: str, digest: str) -> str:
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{digest}{ext}"
+
+
+def build_manifest(static_folder: str):
+    """static_folder 配下を走査して、指紋付きファイル名の対応表と圧縮済みの内容を作り直す。"""
+    global _manifest, _originals, _precompressed
+    manifest, originals, precompressed = {}, {}, {}
+    for dirpath, _, filenames in os.walk(static_folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, "/")
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()[:10]
+            fingerprinted = _fingerprinted_name(filename, digest)
+            manifest[filename] = fingerprinted
+            originals[fingerprinted] = (filename, digest)
+            mimetype = mimetypes.guess_type(filename)[0]
+            if mimetype in COMPRESS_MIMETYPES and len(data) >= COMPRESS_MIN_SIZE:
+                variants = {"gzip": _compress(data, "gzip", best=True)}
+                if brotli is not None:
+                    variants["br"] = _compress(data, "br", best=True)
+                precompressed[filename] = variants
+    # 組み立ててから差し替える（配信中のリクエストが作りかけの表を見ないように）
+    _manifest, _originals, _precompressed = manifest, originals, precompressed
+    logger.info(f"静的ファイルのマニフェストを作成しました: {len(manifest)}件 (圧縮済み {len(precompressed)}件, "
+                f"brotli={'有効' if brotli is not None else '無効'})")
+
+
+def static_manifest() -> dict:
+    return dict(_manifest)
+
+
+def _static_url_defaults(endpoint, values):
+    # url_for('static', filename=...) を指紋付きのファイル名に置き換える
+    if endpoint == "static" and "filename" in values:
+        fingerprinted = _manifest.get(values["filename"])
+        if fingerprinted:
+            values["filename"] = fingerprinted
+
+
+def _serve_static(app, filename):
+    original = _originals.get(filename)
+    if original is None:
+        # 指紋なしの URL（古いページ・直接指定）は通常どおり。内容が変わりうるので毎回確認させる
+        response = send_from_directory(app.static_folder, filename, max_age=0)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    filename, digest = original
+    encoding = _accepted_encoding()
+    variants = _precompressed.get(filename, {})
+    if encoding in variants:
+        response = Response(variants[encoding], mimetype=mimetypes.guess_type(filename)[0])
+        response.headers["Content-Encoding"] = encoding
+        response.set_etag(f"{digest}-{encoding}")
+        response.make_conditional(request)
+    else:
+        response = send_from_directory(app.static_folder, filename, max_age=STATIC_MAX_AGE_SEC)
+    if variants:
+        response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = f"public, max-age={STATIC_MAX_AGE_SEC}, immutable"
+    return response
+
+
+def compress_response(response):
+    """テンプレート/JSON などの応答を、クライアントが対応していれば圧縮する（after_request）。"""
+    if (response.status_code < 200 or response.status_code >= 300 or response.status_code == 204
+            or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = _accepted_encoding()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(_compress(data, encoding))  # Content-Length も更新される
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f"{etag}-{encoding}")  # 圧縮前と同じ強い ETag を付けたままにしない
+    return response
+
+
+def init_app(app):
+    """圧縮と静的ファイル配信を app に組み込む。"""
+    if COMPRESS_ENABLED:
+        app.after_request(compress_response)
+    # 開発中（debug）はファイルを書き換えながら確認するので指紋を付けない
+    if STATIC_FINGERPRINT_ENABLED and not app.debug and app.static_folder:
+        build_manifest(app.static_folder)
+        app.url_defaults(_static_url_defaults)
+        app.view_functions["static"] = lambda filename: _serve_static(app, filename)
@@ -0,0 +1,446 @@
+# write_behind.py
+"""
+レコード作成の write-behind（AIRTABLE_WRITE_BEHIND=1 のときのみ使用）。
+
+入力フォームの送信は SQLite のジャーナルに記録した時点で完了とし、一覧には「送信待ち」の仮行
+（id が "pending-<uuid>"）として月キャッシュ経由ですぐ表示する。Airtable への送信はバックグラウンドの
+フラッシャーが行い、失敗しても再試行する。プロセスが落ちてもジャーナルに残った行は次回起動後に送られる。
+
+二重作成の防止：送信結果が不明になった行（タイムアウト・送信中の停止など）は、再送前に Airtable を検索し、
+既に作成済みならそのレコードを採用する。照合には AIRTABLE_IDEMPOTENCY_FIELD の列に書き込んだ uuid を使うので、
+write-behind を使うにはこの列（各 TablePersonID_* に1行テキストの列）の設定が必須。
+（項目の値での照合は、同じ日・品番・工程・数量の別の入力を作成済みと誤認して取りこぼすため行わない）
+"""
+import os
+import json
+import time
+import uuid
+import random
+import sqlite3
+import logging
+from threading import Event, Lock, Thread, local
+
+import requests
+
+from airtable_cache import month_cache_add_record, month_cache_remove_record, month_cache_update_record
+from airtable_mirror import mirror_upsert_rows
+from airtable_client import (
+    AIRTABLE_BACKOFF_MAX_SEC, AIRTABLE_CONNECT_TIMEOUT, AIRTABLE_MAX_RETRIES, AIRTABLE_RATE_MAX_WAIT_SEC,
+    AirtableRateLimitTimeout, airtable_request
+)
+from airtable_service import (
+    HEADERS, MONTH_CACHE_RETAIN_SEC, _build_airtable_url, month_row_from_fields
+)
+
+logger = logging.getLogger(__name__)
+if not logger.hasHandlers():
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+# ==== 設定 ====
+AIRTABLE_IDEMPOTENCY_FIELD = os.environ.get("AIRTABLE_IDEMPOTENCY_FIELD", "").strip()
+WRITE_BEHIND_ENABLED = os.environ.get("AIRTABLE_WRITE_BEHIND", "0") == "1"
+if WRITE_BEHIND_ENABLED and not AIRTABLE_IDEMPOTENCY_FIELD:
+    # 照合する列が無いと、送信結果が不明な行を作成済みかどうか判別できない
+    logger.critical("AIRTABLE_WRITE_BEHIND=1 ですが AIRTABLE_IDEMPOTENCY_FIELD が未設定です。"
+                    "write-behind を無効にし、入力は従来どおり直接 Airtable に送信します。")
+    WRITE_BEHIND_ENABLED = False
+WRITE_BEHIND_JOURNAL_PATH = os.environ.get("AIRTABLE_WRITE_BEHIND_JOURNAL", "write_behind.sqlite3")
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("AIRTABLE_WRITE_BEHIND_MAX_ATTEMPTS", "10"))
+WRITE_BEHIND_RETRY_BASE_SEC = float(os.environ.get("AIRTABLE_WRITE_BEHIND_RETRY_BASE_SEC", "2"))
+WRITE_BEHIND_RETRY_MAX_SEC = float(os.environ.get("AIRTABLE_WRITE_BEHIND_RETRY_MAX_SEC", "300"))
+WRITE_BEHIND_POLL_SEC = float(os.environ.get("AIRTABLE_WRITE_BEHIND_POLL_SEC", "5"))
+WRITE_BEHIND_READ_TIMEOUT_SEC = 10
+# Airtable へのリクエスト1回にかかりうる最長の秒数（送信枠待ち・接続・読み取りを再試行の回数分 + Retry-After の待ち）
+_REQUEST_WORST_CASE_SEC = (
+    (AIRTABLE_MAX_RETRIES + 1) * (AIRTABLE_RATE_MAX_WAIT_SEC + AIRTABLE_CONNECT_TIMEOUT + WRITE_BEHIND_READ_TIMEOUT_SEC)
+    + AIRTABLE_MAX_RETRIES * AIRTABLE_BACKOFF_MAX_SEC
+)
+# "sending" のまま止まった行（送信中にワーカーが落ちた等）を別のフラッシャーが引き取るまでの秒数。
+# 引き取りはリクエストごとに更新する（_renew_claim）ので、リクエスト1回の最長時間より長くなければならない
+WRITE_BEHIND_CLAIM_TIMEOUT_SEC = float(
+    os.environ.get("AIRTABLE_WRITE_BEHIND_CLAIM_TIMEOUT_SEC") or _REQUEST_WORST_CASE_SEC + 60
+)
+if WRITE_BEHIND_CLAIM_TIMEOUT_SEC <= _REQUEST_WORST_CASE_SEC:
+    logger.warning(f"AIRTABLE_WRITE_BEHIND_CLAIM_TIMEOUT_SEC ({WRITE_BEHIND_CLAIM_TIMEOUT_SEC:.0f}秒) は送信1回の最長時間 "
+                   f"({_REQUEST_WORST_CASE_SEC:.0f}秒) より短いため、{_REQUEST_WORST_CASE_SEC + 60:.0f}秒にします。")
+    WRITE_BEHIND_CLAIM_TIMEOUT_SEC = _REQUEST_WORST_CASE_SEC + 60
+WRITE_BEHIND_KEEP_DONE_SEC = 7 * 24 * 3600  # 送信済みの行はこの期間だけ残す（調査用）
+
+PENDING_ID_PREFIX = "pending-"
+
+_local = local()
+_schema_lock = Lock()
+_schema_ready = False
+
+_wake = Event()
+_flusher_pid = None
+_flusher_lock = Lock()
+
+
+def _conn() -> sqlite3.Connection:
+    """スレッドごとの接続（fork 後は作り直す）。送信待ちを失わないよう synchronous=FULL。"""
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        conn = sqlite3.connect(WRITE_BEHIND_JOURNAL_PATH, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        _local.conn = conn
+        _local.pid = os.getpid()
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS journal ("
+                    " id TEXT PRIMARY KEY,"
+                    " person_id TEXT NOT NULL,"
+                    " workday TEXT NOT NULL,"
+                    " fields TEXT NOT NULL,"
+                    " state TEXT NOT NULL,"            # pending / sending / done / failed / dismissed
+                    " attempts INTEGER NOT NULL DEFAULT 0,"
+                    " uncertain INTEGER NOT NULL DEFAULT 0,"  # 1: 送信済みかどうか不明（再送前に照合する）
+                    " next_attempt_at REAL NOT NULL,"
+                    " claimed_at REAL,"
+                    " created_at REAL NOT NULL,"
+                    " airtable_id TEXT,"
+                    " last_error TEXT)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS journal_due ON journal (state, next_attempt_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS journal_month ON journal (person_id, workday)")
+                _schema_ready = True
+    return conn
+
+
+def _pending_row(entry_id: str, fields: dict, state: str) -> dict:
+    row = month_row_from_fields(f"{PENDING_ID_PREFIX}{entry_id}", fields)
+    row["pending"] = True
+    row["pending_state"] = state
+    return row
+
+
+def _split_month(workday: str):
+    return int(workday[:4]), int(workday[5:7])
+
+
+def enqueue_record(person_id: str, fields: dict) -> str:
+    """
+    作成するレコードをジャーナルに記録し、当月キャッシュに送信待ちの仮行を追加する。
+    仮行の id（"pending-<uuid>"）を返す。記録に失敗した場合は sqlite3.Error。
+    """
+    entry_id = uuid.uuid4().hex
+    now = time.time()
+    _conn().execute(
+        "INSERT INTO journal (id, person_id, workday, fields, state, next_attempt_at, created_at)"
+        " VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+        (entry_id, str(person_id), fields["WorkDay"], json.dumps(fields, ensure_ascii=False), now, now)
+    )
+    logger.info(f"[WRITE-BEHIND] 受付: {entry_id} PersonID={person_id} WorkDay={fields['WorkDay']}")
+
+    try:
+        y, m = _split_month(fields["WorkDay"])
+        month_cache_add_record(str(person_id), y, m, _pending_row(entry_id, fields, "pending"),
+                               ttl_sec=MONTH_CACHE_RETAIN_SEC)
+    except Exception as e:
+        logger.warning(f"送信待ち行のキャッシュ反映に失敗（無視）: {e}")
+
+    ensure_flusher()
+    _wake.set()
+    return f"{PENDING_ID_PREFIX}{entry_id}"
+
+
+def pending_rows_for_month(person_id: str, year: int, month: int) -> list:
+    """
+    指定月の未送信（送信中・失敗を含む）の仮行。Airtable から取り直した一覧に重ねて表示する。
+    失敗した行は利用者が再送（retry_failed）するか取り消す（dismiss_failed）まで表示し続ける。
+    """
+    ensure_flusher()
+    rows = _conn().execute(
+        "SELECT id, fields, state FROM journal"
+        " WHERE person_id = ? AND workday LIKE ? AND state IN ('pending', 'sending', 'failed') ORDER BY created_at",
+        (str(person_id), f"{year:04d}-{month:02d}-%")
+    ).fetchall()
+    return [_pending_row(entry_id, json.loads(fields), state) for entry_id, fields, state in rows]
+
+
+def _entry_id(record_id: str) -> str:
+    return record_id[len(PENDING_ID_PREFIX):] if record_id.startswith(PENDING_ID_PREFIX) else record_id
+
+
+def _failed_entry_workday(conn, person_id: str, entry_id: str):
+    row = conn.execute(
+        "SELECT workday FROM journal WHERE id = ? AND person_id = ? AND state = 'failed'", (entry_id, str(person_id))
+    ).fetchone()
+    return row[0] if row else None
+
+
+def retry_failed(person_id: str, record_id: str) -> bool:
+    """
+    送信を断念した行（state='failed'）を送信待ちに戻す。record_id は仮行の id（"pending-<uuid>"）。
+    本人の失敗行でなければ False。送信済みか不明な行は、再送前に照合用の列で作成済みかを確かめる。
+    """
+    if not WRITE_BEHIND_ENABLED:
+        return False
+    entry_id = _entry_id(record_id)
+    conn = _conn()
+    workday = _failed_entry_workday(conn, person_id, entry_id)
+    if workday is None:
+        return False
+    updated = conn.execute(
+        "UPDATE journal SET state = 'pending', attempts = 0, next_attempt_at = ? WHERE id = ? AND state = 'failed'",
+        (time.time(), entry_id)
+    ).rowcount
+    if not updated:
+        return False
+    logger.info(f"[WRITE-BEHIND] 失敗した行を再送します: {entry_id} PersonID={person_id}")
+    try:
+        y, m = _split_month(workday)
+        month_cache_update_record(str(person_id), y, m, f"{PENDING_ID_PREFIX}{entry_id}",
+                                  {"pending_state": "pending"}, ttl_sec=MONTH_CACHE_RETAIN_SEC)
+    except Exception as e:
+        logger.warning(f"再送する行のキャッシュ反映に失敗（無視）: {e}")
+    ensure_flusher()
+    _wake.set()
+    return True
+
+
+def dismiss_failed(person_id: str, record_id: str) -> bool:
+    """
+    送信を断念した行（state='failed'）を取り消し、一覧に出さないようにする。本人の失敗行でなければ False。
+    ジャーナルには 'dismissed' として送信済みの行と同じ期間だけ残す（調査用）。
+    """
+    if not WRITE_BEHIND_ENABLED:
+        return False
+    entry_id = _entry_id(record_id)
+    conn = _conn()
+    workday = _failed_entry_workday(conn, person_id, entry_id)
+    if workday is None:
+        return False
+    updated = conn.execute(
+        "UPDATE journal SET state = 'dismissed' WHERE id = ? AND state = 'failed'", (entry_id,)
+    ).rowcount
+    if not updated:
+        return False
+    logger.info(f"[WRITE-BEHIND] 失敗した行を取り消しました: {entry_id} PersonID={person_id}")
+    try:
+        y, m = _split_month(workday)
+        month_cache_remove_record(str(person_id), y, m, f"{PENDING_ID_PREFIX}{entry_id}",
+                                  ttl_sec=MONTH_CACHE_RETAIN_SEC)
+    except Exception as e:
+        logger.warning(f"取り消した行のキャッシュ反映に失敗（無視）: {e}")
+    return True
+
+
+# ==== フラッシャー ====
+def _claim_due(limit: int = 10) -> list:
+    """送信期限の来た行を "sending" にして引き取る（ワーカー間で同じ行を二重に送らない）。"""
+    now = time.time()
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT id, person_id, fields, attempts, uncertain, state FROM journal"
+            " WHERE (state = 'pending' AND next_attempt_at <= ?)"
+            "    OR (state = 'sending' AND claimed_at < ?)"
+            " ORDER BY created_at LIMIT ?",
+            (now, now - WRITE_BEHIND_CLAIM_TIMEOUT_SEC, limit)
+        ).fetchall()
+        for entry_id, _, _, _, _, state in rows:
+            # 送信中のまま放置されていた行は、送れたかどうか分からない
+            conn.execute(
+                "UPDATE journal SET state = 'sending', claimed_at = ?,"
+                " uncertain = CASE WHEN ? = 'sending' THEN 1 ELSE uncertain END WHERE id = ?",
+                (now, state, entry_id)
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return [
+        {"id": r[0], "person_id": r[1], "fields": json.loads(r[2]), "attempts": r[3],
+         "uncertain": bool(r[4]) or r[5] == "sending", "claimed_at": now}
+        for r in rows
+    ]
+
+
+def _renew_claim(entry: dict) -> bool:
+    """
+    Airtable へのリクエストの直前に引き取り時刻を更新する（送信中の行を他のフラッシャーに引き取らせない）。
+    既に他のフラッシャーが引き取っていた場合は False（この行は送らない）。
+    """
+    now = time.time()
+    renewed = _conn().execute(
+        "UPDATE journal SET claimed_at = ? WHERE id = ? AND state = 'sending' AND claimed_at = ?",
+        (now, entry["id"], entry["claimed_at"])
+    ).rowcount
+    if not renewed:
+        logger.warning(f"[WRITE-BEHIND] 他のフラッシャーが引き取ったため送信を中止します: {entry['id']}")
+        return False
+    entry["claimed_at"] = now
+    return True
+
+
+def _formula_literal(value) -> str:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def _find_existing(url: str, entry: dict):
+    """送信結果が不明な行について、既に Airtable に作成済みならそのレコードIDを返す（照合用の列の uuid で探す）。"""
+    formula = f"{{{AIRTABLE_IDEMPOTENCY_FIELD}}}={_formula_literal(entry['id'])}"
+    response = airtable_request(
+        "GET", url, headers=HEADERS, read_timeout=WRITE_BEHIND_READ_TIMEOUT_SEC,
+        params={"filterByFormula": formula, "maxRecords": 1, "fields[]": ["WorkDay"]}
+    )
+    response.raise_for_status()
+    records = response.json().get("records", [])
+    return records[0]["id"] if records else None
+
+
+def _mark_done(entry: dict, airtable_id: str):
+    _conn().execute(
+        "UPDATE journal SET state = 'done', airtable_id = ?, last_error = NULL WHERE id = ?",
+        (airtable_id, entry["id"])
+    )
+    try:
+        fields = entry["fields"]
+        y, m = _split_month(fields["WorkDay"])
+        row = month_row_from_fields(airtable_id, fields)
+        mirror_upsert_rows(entry["person_id"], [row])
+        month_cache_add_record(entry["person_id"], y, m, row,
+                               replace_id=f"{PENDING_ID_PREFIX}{entry['id']}", ttl_sec=MONTH_CACHE_RETAIN_SEC)
+    except Exception as e:
+        logger.warning(f"送信済み行のキャッシュ反映に失敗（無視）: {e}")
+    logger.info(f"[WRITE-BEHIND] 送信完了: {entry['id']} -> {airtable_id}")
+
+
+def _mark_retry(entry: dict, error: str, uncertain: bool, permanent: bool = False):
+    attempts = entry["attempts"] + 1
+    if permanent or attempts >= WRITE_BEHIND_MAX_ATTEMPTS:
+        _conn().execute(
+            "UPDATE journal SET state = 'failed', attempts = ?, uncertain = ?, last_error = ? WHERE id = ?",
+            (attempts, int(uncertain), error, entry["id"])
+        )
+        logger.error(f"[WRITE-BEHIND] 送信を断念しました: {entry['id']} PersonID={entry['person_id']} {error}")
+        try:
+            y, m = _split_month(entry["fields"]["WorkDay"])
+            month_cache_update_record(entry["person_id"], y, m, f"{PENDING_ID_PREFIX}{entry['id']}",
+                                      {"pending_state": "failed"}, ttl_sec=MONTH_CACHE_RETAIN_SEC)
+        except Exception as e:
+            logger.warning(f"送信失敗行のキャッシュ反映に失敗（無視）: {e}")
+        return
+    delay = random.uniform(0, min(WRITE_BEHIND_RETRY_MAX_SEC, WRITE_BEHIND_RETRY_BASE_SEC * (2 ** attempts)))
+    _conn().execute(
+        "UPDATE journal SET state = 'pending', attempts = ?, uncertain = ?, next_attempt_at = ?, last_error = ?"
+        " WHERE id = ?",
+        (attempts, int(uncertain), time.time() + delay, error, entry["id"])
+    )
+    logger.warning(f"[WRITE-BEHIND] 送信失敗、{delay:.0f}秒後に再試行します ({attempts}/{WRITE_BEHIND_MAX_ATTEMPTS}): "
+                   f"{entry['id']} {error}")
+
+
+def _flush_entry(entry: dict):
+    url = _build_airtable_url(entry["person_id"])
+    if not url:
+        _mark_retry(entry, "AirtableのURL構築に失敗", uncertain=entry["uncertain"])
+        return
+
+    fields = dict(entry["fields"], **{AIRTABLE_IDEMPOTENCY_FIELD: entry["id"]})
+
+    try:
+        if entry["uncertain"]:
+            if not _renew_claim(entry):
+                return
+            existing = _find_existing(url, entry)
+            if existing:
+                logger.info(f"[WRITE-BEHIND] 作成済みのレコードを検出したため再送しません: {entry['id']}")
+                _mark_done(entry, existing)
+                return
+        if not _renew_claim(entry):
+            return
+        response = airtable_request("POST", url, headers=HEADERS, json={"fields": fields},
+                                    read_timeout=WRITE_BEHIND_READ_TIMEOUT_SEC)
+        response.raise_for_status()
+        new_id = response.json().get("id")
+        if not new_id:
+            _mark_retry(entry, "レスポンスにIDがありません", uncertain=True)
+            return
+        _mark_done(entry, new_id)
+    except requests.exceptions.HTTPError as http_err:
+        status = http_err.response.status_code
+        # 429/503 は未処理が確定。その他の 5xx は処理されたか不明。4xx は入力不備なので再送しない
+        uncertain = status >= 500 and status != 503
+        permanent = 400 <= status < 500 and status != 429
+        _mark_retry(entry, f"HTTP {status}: {http_err.response.text[:200]}", uncertain or entry["uncertain"], permanent)
+    except (AirtableRateLimitTimeout, requests.exceptions.ConnectTimeout) as e:
+        _mark_retry(entry, str(e), uncertain=entry["uncertain"])  # 送信していない
+    except requests.RequestException as e:
+        _mark_retry(entry, str(e), uncertain=True)
+
+
+def flush_pending() -> int:
+    """期限の来た送信待ちをすべて送る。送信を試みた件数を返す。"""
+    total = 0
+    while True:
+        entries = _claim_due()
+        if not entries:
+            return total
+        for entry in entries:
+            try:
+                _flush_entry(entry)
+            except Exception as e:
+                logger.error(f"[WRITE-BEHIND] 送信処理で予期しないエラー: {entry['id']} {e}", exc_info=True)
+                _mark_retry(entry, str(e), uncertain=True)
+            total += 1
+
+
+def _flusher_loop():
+    last_cleanup = 0.0
+    while True:
+        _wake.wait(WRITE_BEHIND_POLL_SEC)
+        _wake.clear()
+        try:
+            flush_pending()
+            if time.time() - last_cleanup > 3600:
+                _conn().execute("DELETE FROM journal WHERE state IN ('done', 'dismissed') AND created_at < ?",
+                                (time.time() - WRITE_BEHIND_KEEP_DONE_SEC,))
+                last_cleanup = time.time()
+        except Exception as e:
+            logger.error(f"[WRITE-BEHIND] フラッシャーでエラー: {e}", exc_info=True)
+
+
+def ensure_flusher():
+    """このプロセスのフラッシャースレッドを起動する（write-behind 無効時・起動済みなら何もしない）。"""
+    global _flusher_pid
+    if not WRITE_BEHIND_ENABLED:
+        return
+    pid = os.getpid()
+    if _flusher_pid == pid:
+        return
+    with _flusher_lock:
+        if _flusher_pid == pid:
+            return
+        Thread(target=_flusher_loop, name="airtable-write-behind", daemon=True).start()
+        _flusher_pid = pid
+        logger.info(f"[WRITE-BEHIND] フラッシャーを起動しました (pid={pid}, journal={WRITE_BEHIND_JOURNAL_PATH})")
+
+
+def write_behind_stats() -> dict:
+    """ジャーナルの状態別件数。/api/metrics 用。"""
+    if not WRITE_BEHIND_ENABLED:
+        return {"enabled": False}
+    counts = dict(_conn().execute("SELECT state, COUNT(*) FROM journal GROUP BY state").fetchall())
+    oldest = _conn().execute(
+        "SELECT MIN(created_at) FROM journal WHERE state IN ('pending', 'sending')"
+    ).fetchone()[0]
+    return {
+        "enabled": True,
+        "journal": WRITE_BEHIND_JOURNAL_PATH,
+        "states": counts,
+        "oldest_pending_age_sec": round(time.time() - oldest, 1) if oldest else 0,
+        "idempotency_field": AIRTABLE_IDEMPOTENCY_FIELD,
+    }